@@ -7,18 +7,56 @@ Arquitectura simplificada:
 
 import os
 import re
+import csv
+import codecs
 import json
+import io
+import math
+import gzip
+import time
 import base64
+import binascii
+import hashlib
+import tempfile
+import threading
+import queue
+import atexit
 import magic
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, Json, execute_values
 import requests
+import uuid
+import random
+import secrets
+import socket
+import select
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
 import logging
+import contextvars
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file
+from functools import wraps, lru_cache
+from itertools import islice
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, session, send_file, g
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 from config import Config
+from metrics import (
+    N8N_ENVIOS, REQUEST_SEGUNDOS, REQUESTS_EN_CURSO, generar_metricas, medir_etapa, observar_etapa
+)
 
 # ============================================================================
 # CONFIGURACIÓN DE FLASK
@@ -28,17 +66,214 @@ app = Flask(__name__)
 app.config.from_object(Config)
 app.secret_key = Config.SECRET_KEY
 
-# Configurar logging detallado
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('portal_facturacion.log'),
-        logging.StreamHandler()
-    ]
-)
+# Detrás del ingress/nginx la conexión viene del proxy: request.remote_addr
+# (límite de login por IP, historial_accesos) se toma de X-Forwarded-For,
+# confiando solo en los últimos PROXY_X_FOR saltos
+if Config.PROXY_X_FOR > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.PROXY_X_FOR)
+
+
+# ============================================================================
+# LOGGING ESTRUCTURADO (JSON LINES POR COLA)
+# ============================================================================
+
+# request_id y decisión de muestreo del request en curso
+_contexto_log = contextvars.ContextVar('contexto_log', default=None)
+
+_log_listener = None
+_log_listener_pid = None
+_log_handler = None
+
+
+class FormatoJson(logging.Formatter):
+    """Un objeto JSON por línea; los `extra=` del registro van como campos"""
+
+    CAMPOS_LOGRECORD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+    def format(self, record):
+        evento = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for clave, valor in vars(record).items():
+            if clave not in self.CAMPOS_LOGRECORD:
+                evento[clave] = valor
+        if record.exc_text:
+            evento['exc'] = record.exc_text
+        return json.dumps(evento, default=str, ensure_ascii=False)
+
+
+class ContextoLog(logging.Filter):
+    """
+    Corre en el hilo que genera el registro: agrega el request_id y aplica
+    el muestreo de DEBUG (todo el detalle de un request o nada).
+    """
+
+    def filter(self, record):
+        contexto = _contexto_log.get()
+        if contexto is not None:
+            record.request_id = contexto['request_id']
+        if record.levelno < logging.INFO and Config.LOG_LEVEL != 'DEBUG':
+            if contexto is not None:
+                return contexto['muestra']
+            return random.random() < Config.LOG_DEBUG_SAMPLE
+        return True
+
+
+class ColaLogHandler(QueueHandler):
+    """
+    QueueHandler con cola acotada: si el listener se atrasa se descartan
+    registros (y se cuentan) en lugar de bloquear el request.
+    """
+
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def prepare(self, record):
+        # El mensaje y la excepción se resuelven aquí; el listener solo serializa
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+def _iniciar_log_listener():
+    global _log_listener, _log_listener_pid
+
+    destinos = [logging.StreamHandler(sys.stdout)]
+    if Config.LOG_FILE:
+        destinos.append(RotatingFileHandler(
+            Config.LOG_FILE,
+            maxBytes=Config.LOG_MAX_BYTES,
+            backupCount=Config.LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        ))
+    formato = FormatoJson() if Config.LOG_FORMAT == 'json' else \
+        logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    for destino in destinos:
+        destino.setFormatter(formato)
+
+    _log_listener = QueueListener(_log_handler.queue, *destinos, respect_handler_level=True)
+    _log_listener.start()
+    _log_listener_pid = os.getpid()
+
+
+def _reiniciar_logging_en_hijo():
+    # Cola nueva: la heredada pudo quedar con su lock tomado durante el fork
+    _log_handler.queue = queue.Queue(Config.LOG_QUEUE_MAX)
+    _iniciar_log_listener()
+
+
+def _detener_log_listener():
+    """Vacía la cola al salir (solo el proceso dueño del listener)"""
+    if _log_listener is not None and _log_listener_pid == os.getpid():
+        _log_listener.stop()
+
+
+def configurar_logging():
+    """
+    Los registros se encolan en el hilo que los genera y un hilo aparte
+    (QueueListener) los escribe a stdout y, si LOG_FILE, a un archivo con
+    rotación por tamaño. Cada worker de gunicorn arranca su propio listener
+    después del fork.
+    """
+    global _log_handler
+
+    _log_handler = ColaLogHandler(queue.Queue(Config.LOG_QUEUE_MAX))
+    _log_handler.addFilter(ContextoLog())
+
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [_log_handler]
+    muestreo = Config.LOG_DEBUG_SAMPLE > 0 or Config.LOG_LEVEL == 'DEBUG'
+    raiz.setLevel(logging.DEBUG if muestreo else Config.LOG_LEVEL)
+    # Detalle de conexiones de urllib3 no entra en el muestreo
+    logging.getLogger('urllib3').setLevel(logging.INFO)
+
+    _iniciar_log_listener()
+    atexit.register(_detener_log_listener)
+    os.register_at_fork(after_in_child=_reiniciar_logging_en_hijo)
+
+
+def log_stats():
+    return {
+        'pendientes': _log_handler.queue.qsize() if _log_handler else 0,
+        'descartados': _log_handler.descartados if _log_handler else 0,
+    }
+
+
+configurar_logging()
 logger = logging.getLogger(__name__)
 
+
+@app.before_request
+def _iniciar_contexto_log():
+    request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex[:16]
+    _contexto_log.set({
+        'request_id': request_id,
+        'muestra': random.random() < Config.LOG_DEBUG_SAMPLE,
+    })
+
+
+@app.after_request
+def _responder_request_id(response):
+    contexto = _contexto_log.get()
+    if contexto is not None:
+        response.headers['X-Request-ID'] = contexto['request_id']
+    return response
+
+
+@app.teardown_request
+def _limpiar_contexto_log(error=None):
+    # Los hilos de gthread se reutilizan: no heredar el request anterior
+    _contexto_log.set(None)
+
+
+# ============================================================================
+# MÉTRICAS POR RUTA (PROMETHEUS, ver metrics.py)
+# ============================================================================
+
+@app.before_request
+def _iniciar_metricas_request():
+    g.metricas_endpoint = request.endpoint or 'desconocido'
+    g.metricas_inicio = time.perf_counter()
+    REQUESTS_EN_CURSO.labels(endpoint=g.metricas_endpoint).inc()
+
+
+@app.after_request
+def _registrar_metricas_request(response):
+    if 'metricas_inicio' in g:
+        REQUEST_SEGUNDOS.labels(
+            endpoint=g.metricas_endpoint,
+            metodo=request.method,
+            status=response.status_code
+        ).observe(time.perf_counter() - g.metricas_inicio)
+
+        # Las respuestas en stream (SSE, send_file) siguen ocupando el hilo
+        # después del teardown: el request termina cuando el servidor cierra la respuesta
+        en_curso = REQUESTS_EN_CURSO.labels(endpoint=g.metricas_endpoint)
+        response.call_on_close(en_curso.dec)
+        g.metricas_al_cerrar = True
+    return response
+
+
+@app.teardown_request
+def _terminar_metricas_request(error=None):
+    # Sin respuesta (p. ej. falló un after_request previo) no habrá call_on_close
+    if 'metricas_inicio' in g and 'metricas_al_cerrar' not in g:
+        REQUESTS_EN_CURSO.labels(endpoint=g.metricas_endpoint).dec()
+
 # Crear directorio de uploads si no existe
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
@@ -47,30 +282,327 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # CONEXIÓN A POSTGRESQL (Solo para búsqueda básica)
 # ============================================================================
 
-def get_db_connection():
-    """Establece conexión con PostgreSQL"""
+def activar_psycopg2_cooperativo():
+    """
+    En modo async (workers gevent) registra un wait callback para que
+    psycopg2 ceda el control a otras greenlets mientras espera a Postgres,
+    en lugar de bloquear el worker completo. requests ya coopera porque el
+    worker gevent parcha socket/ssl/threading antes de importar la app.
+
+    Retorna True si quedó activo (gevent instalado y socket parchado).
+    """
     try:
-        conn = psycopg2.connect(Config.get_postgres_connection_string())
+        from gevent import monkey
+        from gevent.socket import wait_read, wait_write
+    except ImportError:
+        return False
+
+    if not monkey.is_module_patched('socket'):
+        return False
+
+    def esperar(conn, timeout=None):
+        while True:
+            estado = conn.poll()
+            if estado == psycopg2.extensions.POLL_OK:
+                return
+            if estado == psycopg2.extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif estado == psycopg2.extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f"Estado de poll inesperado: {estado}")
+
+    psycopg2.extensions.set_wait_callback(esperar)
+    return True
+
+
+PSYCOPG2_COOPERATIVO = activar_psycopg2_cooperativo()
+
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    """No se pudo obtener una conexión del pool (BD caída o pool saturado)"""
+
+
+class PostgresPool:
+    """
+    Pool de conexiones PostgreSQL por proceso.
+
+    Reutiliza conexiones entre requests en lugar de hacer el handshake
+    TCP + autenticación en cada consulta. Si todas las conexiones están
+    ocupadas espera hasta DB_POOL_TIMEOUT segundos antes de fallar, y
+    antes de prestar una conexión que estuvo ociosa la valida con un ping.
+    """
+
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck_interval):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._ociosas = []  # [(conexión, momento en que se devolvió)]
+        self._stats = {
+            'checkouts': 0,
+            'en_uso': 0,
+            'pico_en_uso': 0,
+            'esperas': 0,
+            'timeouts': 0,
+            'conexiones_abiertas': 0,
+            'descartadas': 0,
+        }
+
+        for _ in range(minconn):
+            self._ociosas.append((self._conectar(), time.monotonic()))
+
+    def getconn(self):
+        """Presta una conexión sana del pool"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['esperas'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise DatabaseUnavailable(
+                    f"Pool de conexiones saturado ({self.maxconn} en uso por más de {self.timeout}s)"
+                )
+
+        try:
+            conn = self._obtener_conexion_sana()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['en_uso'] += 1
+            self._stats['pico_en_uso'] = max(self._stats['pico_en_uso'], self._stats['en_uso'])
         return conn
-    except psycopg2.Error as e:
-        app.logger.error(f"Error conectando a PostgreSQL: {e}")
-        return None
+
+    def putconn(self, conn):
+        """Devuelve la conexión al pool, descartándola si quedó inservible"""
+        descartar = bool(conn.closed)
+        if not descartar:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                descartar = True
+
+        with self._lock:
+            self._stats['en_uso'] -= 1
+            if descartar:
+                self._stats['descartadas'] += 1
+            else:
+                self._ociosas.append((conn, time.monotonic()))
+
+        if descartar:
+            self._cerrar(conn)
+        self._slots.release()
+
+    def _conectar(self):
+        try:
+            conn = psycopg2.connect(self.dsn)
+        except psycopg2.Error as e:
+            raise DatabaseUnavailable(f"Error conectando a PostgreSQL: {e}") from e
+        with self._lock:
+            self._stats['conexiones_abiertas'] += 1
+        return conn
+
+    def _cerrar(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _obtener_conexion_sana(self):
+        # Tras un reinicio de Postgres todas las conexiones ociosas están rotas:
+        # se descartan una a una y, si no queda ninguna, se abre una nueva
+        while True:
+            with self._lock:
+                conn, devuelta = self._ociosas.pop() if self._ociosas else (None, None)
+
+            if conn is None:
+                return self._conectar()
+
+            if self._esta_sana(conn, devuelta):
+                return conn
+
+            with self._lock:
+                self._stats['descartadas'] += 1
+            self._cerrar(conn)
+
+    def _esta_sana(self, conn, devuelta):
+        if conn.closed:
+            return False
+
+        if time.monotonic() - devuelta < self.healthcheck_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def stats(self):
+        """Estadísticas de uso y saturación del pool"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['ociosas'] = len(self._ociosas)
+        stats.update({
+            'min': self.minconn,
+            'max': self.maxconn,
+            'saturacion': round(stats['en_uso'] / self.maxconn, 3),
+        })
+        return stats
+
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """
+    Retorna el pool del proceso actual, creándolo la primera vez.
+    Se crea de forma perezosa para que cada worker de gunicorn (fork)
+    tenga sus propias conexiones.
+    """
+    global _db_pool, _db_pool_pid
+
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        return _db_pool
+
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != os.getpid():
+            try:
+                _db_pool = PostgresPool(
+                    Config.get_postgres_connection_string(),
+                    minconn=Config.DB_POOL_MIN,
+                    maxconn=Config.DB_POOL_MAX,
+                    timeout=Config.DB_POOL_TIMEOUT,
+                    healthcheck_interval=Config.DB_POOL_HEALTHCHECK_INTERVAL,
+                )
+            except DatabaseUnavailable as e:
+                app.logger.error(str(e))
+                raise
+            _db_pool_pid = os.getpid()
+    return _db_pool
+
+
+@contextmanager
+def db_connection(autocommit=False):
+    """
+    Presta una conexión del pool durante el bloque `with`.
+    Al salir se devuelve al pool; lo que no se haya confirmado con
+    commit() se descarta con rollback.
+
+    Con autocommit=True cada sentencia se confirma sola, sin BEGIN/COMMIT
+    aparte: útil para sentencias únicas donde cada round trip cuenta.
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        if autocommit:
+            conn.autocommit = True
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+@contextmanager
+def db_cursor(cursor_factory=None, autocommit=False):
+    """Atajo de db_connection() que entrega directamente un cursor"""
+    with db_connection(autocommit=autocommit) as conn:
+        cursor = conn.cursor(cursor_factory=cursor_factory)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+
+def _pedido_desde_fila(row):
+    """Convierte una fila (order_id, paid_amount, buyer_nickname, currency_id, shipping_id, receiver_id, kind)"""
+    return {
+        'order_id': row[0],
+        'paid_amount': float(row[1]) if row[1] else 0,
+        'buyer_nickname': row[2],
+        'currency_id': row[3],
+        'shipping_id': row[4],  # ✅ Ahora es shipping_id desde orden_ml
+        'receiver_id': row[5],  # ✅ Ahora viene del JOIN con shipment
+        'match_kind': row[6]    # order, pack o payment: qué ID coincidió
+    }
 
 
 def buscar_pedido(search_id):
     """
     Busca un pedido por order_id, pack_id o payment_id
     Solo retorna datos básicos para mostrar en el formulario
+
+    Resuelve cualquiera de los tres IDs con una sola búsqueda en orden_lookup
+    (índice mantenido por trigger sobre orden_ml, ver database_schema.sql)
     """
-    conn = get_db_connection()
-    if not conn:
+    try:
+        with medir_etapa('buscar_pedido'), db_cursor() as cursor:
+            query = """
+                SELECT
+                    o.order_id,
+                    o.paid_amount,
+                    o.buyer_nickname,
+                    o.currency_id,
+                    o.shipping_id,
+                    s.receiver_id,
+                    l.kind
+                FROM orden_lookup l
+                INNER JOIN public.orden_ml o ON o.order_id = l.order_id
+                LEFT JOIN public.shipment s ON o.shipping_id = s.id
+                WHERE l.key = %s
+                ORDER BY l.prioridad, l.order_id
+                LIMIT 1
+            """
+            try:
+                cursor.execute(query, (search_id,))
+            except psycopg2.errors.UndefinedTable:
+                # orden_lookup aún no se ha creado en esta base de datos
+                cursor.connection.rollback()
+                app.logger.warning("orden_lookup no existe, usando búsqueda directa en orden_ml")
+                return _buscar_pedido_sin_indice(cursor, search_id)
+
+            row = cursor.fetchone()
+
+        return _pedido_desde_fila(row) if row else None
+
+    except psycopg2.Error as e:
+        app.logger.error(f"Error buscando pedido: {e}")
         return None
 
-    cursor = None
-    try:
-        cursor = conn.cursor()
 
-        # Primero intentar por order_id o pack_id (con JOIN a shipment para obtener receiver_id)
+def _buscar_pedido_sin_indice(cursor, search_id):
+    """Búsqueda directa en orden_ml (dos consultas) para bases sin orden_lookup"""
+    # Primero intentar por order_id o pack_id (con JOIN a shipment para obtener receiver_id)
+    query = """
+        SELECT
+            o.order_id,
+            o.paid_amount,
+            o.buyer_nickname,
+            o.currency_id,
+            o.shipping_id,
+            s.receiver_id,
+            CASE WHEN o.order_id::text = %s THEN 'order' ELSE 'pack' END
+        FROM public.orden_ml o
+        LEFT JOIN public.shipment s ON o.shipping_id = s.id
+        WHERE o.order_id = %s OR o.pack_id = %s
+    """
+    cursor.execute(query, (search_id, search_id, search_id))
+    row = cursor.fetchone()
+
+    # Si no encuentra, intentar por payment_id
+    if not row:
         query = """
             SELECT
                 o.order_id,
@@ -78,66 +610,429 @@ def buscar_pedido(search_id):
                 o.buyer_nickname,
                 o.currency_id,
                 o.shipping_id,
-                s.receiver_id
+                s.receiver_id,
+                'payment'
             FROM public.orden_ml o
             LEFT JOIN public.shipment s ON o.shipping_id = s.id
-            WHERE o.order_id = %s OR o.pack_id = %s
+            WHERE o.payments_0_id = %s
         """
-        cursor.execute(query, (search_id, search_id))  # ✅ Pasar search_id DOS veces
+        cursor.execute(query, (search_id,))
         row = cursor.fetchone()
 
-        # Si no encuentra, intentar por payment_id
-        if not row:
-            query = """
-                SELECT
-                    o.order_id,
-                    o.paid_amount,
-                    o.buyer_nickname,
-                    o.currency_id,
-                    o.shipping_id,
-                    s.receiver_id
-                FROM public.orden_ml o
-                LEFT JOIN public.shipment s ON o.shipping_id = s.id
-                WHERE o.payments_0_id = %s
-            """
-            cursor.execute(query, (search_id,))
-            row = cursor.fetchone()
+    return _pedido_desde_fila(row) if row else None
 
-        if row:
-            return {
-                'order_id': row[0],
-                'paid_amount': float(row[1]) if row[1] else 0,
-                'buyer_nickname': row[2],
-                'currency_id': row[3],
-                'shipping_id': row[4],  # ✅ Ahora es shipping_id desde orden_ml
-                'receiver_id': row[5]   # ✅ Ahora viene del JOIN con shipment
+
+def buscar_pedidos(search_ids):
+    """
+    Versión en lote de buscar_pedido(): resuelve una lista de order_id,
+    pack_id o payment_id con una sola consulta (key = ANY) en orden_lookup.
+
+    Regresa {search_id: pedido} solo con los IDs encontrados; cada ID se
+    resuelve igual que en buscar_pedido() (menor prioridad, menor order_id).
+    Lanza psycopg2.Error si la BD falla.
+    """
+    with medir_etapa('buscar_pedidos'), db_cursor() as cursor:
+        query = """
+            SELECT DISTINCT ON (l.key)
+                l.key,
+                o.order_id,
+                o.paid_amount,
+                o.buyer_nickname,
+                o.currency_id,
+                o.shipping_id,
+                s.receiver_id,
+                l.kind
+            FROM orden_lookup l
+            INNER JOIN public.orden_ml o ON o.order_id = l.order_id
+            LEFT JOIN public.shipment s ON o.shipping_id = s.id
+            WHERE l.key = ANY(%s)
+            ORDER BY l.key, l.prioridad, l.order_id
+        """
+        try:
+            cursor.execute(query, (list(search_ids),))
+        except psycopg2.errors.UndefinedTable:
+            cursor.connection.rollback()
+            app.logger.warning("orden_lookup no existe, usando búsqueda directa en orden_ml")
+            return _buscar_pedidos_sin_indice(cursor, search_ids)
+
+        return {row[0]: _pedido_desde_fila(row[1:]) for row in cursor.fetchall()}
+
+
+def _buscar_pedidos_sin_indice(cursor, search_ids):
+    """Lote sobre orden_ml sin orden_lookup: una consulta con los tres IDs de cada orden"""
+    cursor.execute(
+        """
+        SELECT DISTINCT ON (k.key)
+            k.key,
+            o.order_id,
+            o.paid_amount,
+            o.buyer_nickname,
+            o.currency_id,
+            o.shipping_id,
+            s.receiver_id,
+            k.kind
+        FROM public.orden_ml o
+        CROSS JOIN LATERAL (VALUES
+            (o.order_id::text, 'order', 1),
+            (o.pack_id::text, 'pack', 2),
+            (o.payments_0_id::text, 'payment', 3)
+        ) AS k(key, kind, prioridad)
+        LEFT JOIN public.shipment s ON o.shipping_id = s.id
+        WHERE o.order_id::text = ANY(%(ids)s)
+           OR o.pack_id::text = ANY(%(ids)s)
+           OR o.payments_0_id::text = ANY(%(ids)s)
+        ORDER BY k.key, k.prioridad, o.order_id
+        """,
+        {'ids': list(search_ids)}
+    )
+    ids = set(search_ids)
+    return {row[0]: _pedido_desde_fila(row[1:]) for row in cursor.fetchall() if row[0] in ids}
+
+
+# ============================================================================
+# SESIONES EN EL SERVIDOR (sesiones_portal)
+# ============================================================================
+
+class SesionPortal(CallbackDict, SessionMixin):
+    """Sesión de Flask guardada en sesiones_portal; la cookie solo lleva token.versión"""
+
+    def __init__(self, datos=None, token=None, version=None, usuario_id=None):
+        def al_modificar(sesion):
+            sesion.modified = True
+
+        super().__init__(datos, al_modificar)
+        self.token = token  # SHA-256 del token de la cookie (lo que se guarda en session_token)
+        self.version = version
+        self.usuario_id = usuario_id  # dueño registrado en la BD
+        self.perdida = False  # la cookie apunta a una sesión vencida, revocada o purgada
+        self.no_disponible = False  # no se pudo leer de la BD: no se guarda ni se toca la cookie
+        self.modified = False
+
+
+class SesionesPostgres(SessionInterface):
+    """
+    Sesiones en PostgreSQL en lugar de la cookie firmada de Flask.
+
+    - Lectura: cache por proceso de hasta SESION_CACHE_TTL segundos. Cada
+      escritura cambia la versión que viaja en la cookie y una entrada del
+      cache solo se usa si su versión coincide, así otro worker nunca
+      entrega datos que ya se reemplazaron para ese cliente.
+    - Escritura: solo si los datos cambiaron (una sentencia en autocommit);
+      sin cambios, la expiración se renueva como máximo una vez cada
+      SESION_TOQUE_INTERVALO por proceso.
+    - Revocación: activa = FALSE (o borrar la fila); cada proceso la nota al
+      vencer su cache.
+    - Al cambiar el usuario de la sesión (login) se emite un token nuevo y
+      se borra el anterior, para evitar fijación de sesión.
+    """
+
+    serializer = TaggedJSONSerializer()
+    session_class = SesionPortal
+
+    def __init__(self):
+        self._pid = None
+        self._lock = None
+        self._cache = None
+        self._stats = None
+        self._preparar_proceso()
+
+    def _preparar_proceso(self):
+        # Tras un fork de gunicorn cada worker empieza con su propio cache
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._cache = OrderedDict()  # session_token -> {version, datos, usuario_id, cargada, tocada}
+            self._stats = {
+                'cache_hits': 0,
+                'lecturas_db': 0,
+                'escrituras': 0,
+                'toques': 0,
+                'borradas': 0,
+                'perdidas': 0,
+                'errores': 0,
             }
-        return None
+            self._pid = os.getpid()
+
+    def _contar(self, clave):
+        with self._lock:
+            self._stats[clave] += 1
+
+    def _cachear(self, token, version, datos, usuario_id, tocada=0.0):
+        ahora = time.monotonic()
+        with self._lock:
+            self._cache[token] = {'version': version, 'datos': datos, 'usuario_id': usuario_id,
+                                  'cargada': ahora, 'tocada': tocada}
+            self._cache.move_to_end(token)
+            while len(self._cache) > Config.SESION_CACHE_MAX:
+                self._cache.popitem(last=False)
+
+    def _olvidar(self, token):
+        with self._lock:
+            self._cache.pop(token, None)
+
+    def open_session(self, app, request):
+        self._preparar_proceso()
+        valor = request.cookies.get(self.get_cookie_name(app))
+        if not valor or '.' not in valor:
+            return SesionPortal()
+
+        token_cookie, version = valor.split('.', 1)
+        token = hashlib.sha256(token_cookie.encode()).hexdigest()
+
+        with self._lock:
+            entrada = self._cache.get(token)
+            if (entrada is not None and entrada['version'] == version
+                    and time.monotonic() - entrada['cargada'] < Config.SESION_CACHE_TTL):
+                self._stats['cache_hits'] += 1
+                datos, usuario_id = entrada['datos'], entrada['usuario_id']
+            else:
+                entrada = None
+
+        if entrada is None:
+            try:
+                with db_cursor() as cursor:
+                    cursor.execute(
+                        """
+                        SELECT datos::text, usuario_id
+                        FROM sesiones_portal
+                        WHERE session_token = %s AND activa AND fecha_expiracion > NOW()
+                        """,
+                        (token,)
+                    )
+                    row = cursor.fetchone()
+            except psycopg2.Error as e:
+                # Sin BD la sesión no se puede leer; la cookie se conserva para cuando vuelva
+                self._contar('errores')
+                logger.error(f"❌ No se pudo leer la sesión: {e}", extra={'evento': 'sesion.error'})
+                sesion = SesionPortal()
+                sesion.no_disponible = True
+                return sesion
+
+            self._contar('lecturas_db')
+            if row is None:
+                self._contar('perdidas')
+                self._olvidar(token)
+                sesion = SesionPortal()
+                sesion.perdida = True
+                return sesion
+
+            datos, usuario_id = row
+            # Con la versión de la cookie: es la que el cliente mandará mientras no haya escrituras
+            self._cachear(token, version, datos, usuario_id)
+
+        return SesionPortal(self.serializer.loads(datos), token, version, usuario_id)
+
+    def save_session(self, app, session, response):
+        nombre = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        response.vary.add('Cookie')
+
+        if session.no_disponible:
+            # Guardar aquí emitiría un token nuevo y reemplazaría la cookie válida del cliente
+            return
+
+        if not session:
+            if session.token is not None and session.modified:
+                # logout o última flash consumida: la sesión vacía no se guarda
+                self._borrar(session.token)
+            if session.token is not None or session.perdida:
+                response.delete_cookie(nombre, domain=domain, path=path)
+            return
+
+        if session.modified or session.token is None:
+            self._guardar(app, session, response, nombre, domain, path)
+        else:
+            self._tocar(session.token)
+
+    def _guardar(self, app, session, response, nombre, domain, path):
+        usuario_id = session.get('usuario_id')
+        anterior = None
+        token_cookie = None
+        token = session.token
+        if token is None or usuario_id != session.usuario_id:
+            anterior = token
+            token_cookie = secrets.token_urlsafe(32)
+            token = hashlib.sha256(token_cookie.encode()).hexdigest()
+        version = secrets.token_hex(4)
+        datos = self.serializer.dumps(dict(session))
+
+        try:
+            with db_cursor(autocommit=True) as cursor:
+                cursor.execute(
+                    """
+                    WITH anterior AS (
+                        DELETE FROM sesiones_portal WHERE session_token = %s
+                    )
+                    INSERT INTO sesiones_portal
+                    (session_token, usuario_id, datos, ip_address, user_agent, fecha_expiracion)
+                    VALUES (%s, %s, %s::jsonb, %s, %s, NOW() + make_interval(secs => %s))
+                    ON CONFLICT (session_token) DO UPDATE
+                    SET datos = EXCLUDED.datos,
+                        usuario_id = EXCLUDED.usuario_id,
+                        fecha_expiracion = EXCLUDED.fecha_expiracion
+                    WHERE sesiones_portal.activa
+                    """,
+                    (anterior, token, usuario_id, datos, request.remote_addr,
+                     request.user_agent.string[:500] if request.user_agent else None, Config.SESION_DURACION)
+                )
+                guardada = cursor.rowcount == 1
+        except psycopg2.Error as e:
+            self._contar('errores')
+            logger.error(f"❌ No se pudo guardar la sesión: {e}", extra={'evento': 'sesion.error'})
+            return
+
+        self._contar('escrituras')
+        if anterior is not None:
+            self._olvidar(anterior)
+        if not guardada:
+            # Revocada mientras se atendía el request
+            self._olvidar(token)
+            response.delete_cookie(nombre, domain=domain, path=path)
+            return
+
+        self._cachear(token, version, datos, usuario_id, tocada=time.monotonic())
+        if token_cookie is None:
+            # Mismo token: el valor de la cookie se reconstruye con la versión nueva
+            token_cookie = request.cookies[nombre].split('.', 1)[0]
+        response.set_cookie(
+            nombre,
+            f'{token_cookie}.{version}',
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def _tocar(self, token):
+        """Renueva la expiración como máximo una vez por SESION_TOQUE_INTERVALO en este proceso"""
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._cache.get(token)
+            if entrada is None or ahora - entrada['tocada'] < Config.SESION_TOQUE_INTERVALO:
+                return
+            entrada['tocada'] = ahora
+
+        try:
+            with db_cursor(autocommit=True) as cursor:
+                cursor.execute(
+                    """
+                    UPDATE sesiones_portal
+                    SET fecha_expiracion = NOW() + make_interval(secs => %s)
+                    WHERE session_token = %s AND activa
+                    """,
+                    (Config.SESION_DURACION, token)
+                )
+        except psycopg2.Error as e:
+            self._contar('errores')
+            logger.error(f"❌ No se pudo renovar la sesión: {e}", extra={'evento': 'sesion.error'})
+            return
+        self._contar('toques')
+
+    def _borrar(self, token):
+        self._olvidar(token)
+        try:
+            with db_cursor(autocommit=True) as cursor:
+                cursor.execute("DELETE FROM sesiones_portal WHERE session_token = %s", (token,))
+        except psycopg2.Error as e:
+            self._contar('errores')
+            logger.error(f"❌ No se pudo borrar la sesión: {e}", extra={'evento': 'sesion.error'})
+            return
+        self._contar('borradas')
+
+    def stats(self):
+        self._preparar_proceso()
+        with self._lock:
+            stats = dict(self._stats)
+            stats['en_cache'] = len(self._cache)
+        return stats
+
+
+def purgar_sesiones_expiradas():
+    """
+    Borra en lotes de SESION_PURGA_LOTE las sesiones vencidas o revocadas
+    (cada lote es una transacción corta). Retorna cuántas se borraron.
+    """
+    total = 0
+    while True:
+        with db_cursor(autocommit=True) as cursor:
+            cursor.execute(
+                """
+                DELETE FROM sesiones_portal
+                WHERE id IN (
+                    SELECT id FROM sesiones_portal
+                    WHERE fecha_expiracion < NOW() OR NOT activa
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                """,
+                (Config.SESION_PURGA_LOTE,)
+            )
+            borradas = cursor.rowcount
+        total += borradas
+        if borradas < Config.SESION_PURGA_LOTE:
+            return total
+
+
+if Config.SESIONES_SERVIDOR:
+    app.session_interface = SesionesPostgres()
 
-    except psycopg2.Error as e:
-        app.logger.error(f"Error buscando pedido: {e}")
-        return None
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-  
 
 # ============================================================================
 # VALIDACIONES
 # ============================================================================
 
-def validate_pdf_file(file_path):
-    """Valida que el archivo sea un PDF real"""
+def validate_pdf_file(file_head):
+    """Valida que el archivo sea un PDF real a partir de sus primeros bytes"""
     try:
-        file_type = magic.from_file(file_path, mime=True)
+        file_type = magic.from_buffer(file_head, mime=True)
         return file_type == 'application/pdf'
     except Exception as e:
         app.logger.error(f"Error validando PDF: {e}")
         return False
 
 
+CSF_CHUNK_SIZE = 64 * 1024
+CSF_BLOQUE_BD = 1024 * 1024  # bytes por lo_put al guardar la CSF en el outbox
+
+
+def leer_csf(file):
+    """
+    Lee la CSF subida en una sola pasada sin escribirla en UPLOAD_FOLDER:
+    detecta el tipo MIME con el primer bloque, calcula el SHA-256 y guarda
+    los bytes tal cual en un archivo temporal en memoria/disco local.
+
+    No se codifica en base64 aquí: la CSF se guarda binaria en el outbox y
+    entregar_job() la codifica una sola vez al enviar (transporte json).
+
+    Retorna {'stream', 'size', 'sha256'} o None si no es un PDF.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    stream = tempfile.SpooledTemporaryFile(max_size=Config.CSF_SPOOL_MAX_MEMORY)
+
+    while True:
+        bloque = file.stream.read(CSF_CHUNK_SIZE)
+        if not bloque:
+            break
+
+        if size == 0 and not validate_pdf_file(bloque):
+            stream.close()
+            return None
+
+        sha256.update(bloque)
+        size += len(bloque)
+        stream.write(bloque)
+
+    if size == 0:
+        stream.close()
+        return None
+
+    stream.seek(0)
+    return {'stream': stream, 'size': size, 'sha256': sha256.hexdigest()}
+
+
 def validate_email(email):
     """Valida formato de email"""
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -148,102 +1043,791 @@ def validate_email(email):
 # INTEGRACIÓN N8N
 # ============================================================================
 
+class MultipartBody:
+    """
+    Cuerpo multipart/form-data que se lee por bloques.
+
+    requests lo envía con Content-Length conocido leyendo cada parte en
+    orden, así el PDF pasa del archivo temporal al socket sin armar el
+    cuerpo completo en memoria.
+    """
+
+    def __init__(self, partes):
+        """partes: lista de (nombre, filename, content_type, contenido, headers_extra);
+        contenido puede ser bytes o un archivo abierto en modo binario"""
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self._segmentos = []
+
+        for nombre, filename, content_type, contenido, headers_extra in partes:
+            disposicion = f'form-data; name="{nombre}"'
+            if filename:
+                disposicion += f'; filename="{filename}"'
+            cabecera = f'--{self.boundary}\r\nContent-Disposition: {disposicion}\r\nContent-Type: {content_type}\r\n'
+            for header, valor in (headers_extra or {}).items():
+                cabecera += f'{header}: {valor}\r\n'
+            self._segmentos += [(cabecera + '\r\n').encode('utf-8'), contenido, b'\r\n']
+        self._segmentos.append(f'--{self.boundary}--\r\n'.encode('utf-8'))
+
+        self._longitud = sum(self._longitud_segmento(seg) for seg in self._segmentos)
+        self.seek(0)
+
+    @staticmethod
+    def _longitud_segmento(segmento):
+        if isinstance(segmento, bytes):
+            return len(segmento)
+        posicion = segmento.tell()
+        segmento.seek(0, os.SEEK_END)
+        longitud = segmento.tell()
+        segmento.seek(posicion)
+        return longitud
+
+    def __len__(self):
+        return self._longitud
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # Solo se soporta volver al inicio (reintentos de urllib3)
+        if offset != 0 or whence != os.SEEK_SET:
+            raise io.UnsupportedOperation('MultipartBody solo permite seek(0)')
+        self._indice = 0
+        self._offset = 0
+        self._leidos = 0
+        for segmento in self._segmentos:
+            if not isinstance(segmento, bytes):
+                segmento.seek(0)
+        return 0
+
+    def tell(self):
+        return self._leidos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._longitud - self._leidos
+
+        partes = []
+        while size > 0 and self._indice < len(self._segmentos):
+            segmento = self._segmentos[self._indice]
+            if isinstance(segmento, bytes):
+                trozo = segmento[self._offset:self._offset + size]
+                self._offset += len(trozo)
+                agotado = self._offset >= len(segmento)
+            else:
+                trozo = segmento.read(size)
+                agotado = len(trozo) < size
+
+            partes.append(trozo)
+            size -= len(trozo)
+            if agotado:
+                self._indice += 1
+                self._offset = 0
+
+        datos = b''.join(partes)
+        self._leidos += len(datos)
+        return datos
+
+
+_n8n_session = None
+_n8n_session_pid = None
+_n8n_session_lock = threading.Lock()
+
+
+def get_n8n_session():
+    """
+    Sesión HTTP del proceso actual para hablar con n8n.
+
+    Mantiene conexiones keep-alive abiertas (pool de urllib3) para no
+    pagar el handshake TCP + TLS en cada envío. Solo reintenta errores
+    al establecer la conexión: en ese caso n8n nunca recibió el POST.
+    Timeouts de lectura o respuestas 5xx no se reintentan, porque la
+    factura podría haberse creado ya.
+    """
+    global _n8n_session, _n8n_session_pid
+
+    if _n8n_session is not None and _n8n_session_pid == os.getpid():
+        return _n8n_session
+
+    with _n8n_session_lock:
+        if _n8n_session is None or _n8n_session_pid != os.getpid():
+            reintentos = Retry(
+                total=None,
+                connect=Config.N8N_HTTP_CONNECT_RETRIES,
+                read=0,
+                status=0,
+                other=0,
+                redirect=0,
+                backoff_factor=Config.N8N_HTTP_RETRY_BACKOFF,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,  # un solo host: el webhook de n8n
+                pool_maxsize=Config.N8N_HTTP_POOL_SIZE,
+                max_retries=reintentos,
+            )
+
+            sesion = requests.Session()
+            sesion.mount('http://', adapter)
+            sesion.mount('https://', adapter)
+            # La sesión se comparte entre hilos: sin cookies no hay estado mutable por request
+            sesion.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+            _n8n_session = sesion
+            _n8n_session_pid = os.getpid()
+    return _n8n_session
+
+
+def n8n_http_stats():
+    """Reutilización de conexiones hacia n8n en el proceso actual"""
+    if _n8n_session is None or _n8n_session_pid != os.getpid():
+        return {'requests': 0, 'conexiones_abiertas': 0, 'reutilizadas': 0, 'reutilizacion': 0.0}
+
+    requests_enviados = 0
+    conexiones = 0
+    for adapter in set(_n8n_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for clave in pools.keys():
+            pool = pools.get(clave)
+            if pool is not None:
+                requests_enviados += pool.num_requests
+                conexiones += pool.num_connections
+
+    reutilizadas = max(requests_enviados - conexiones, 0)
+    return {
+        'requests': requests_enviados,
+        'conexiones_abiertas': conexiones,
+        'reutilizadas': reutilizadas,
+        'reutilizacion': round(reutilizadas / requests_enviados, 3) if requests_enviados else 0.0,
+        'pool_maxsize': Config.N8N_HTTP_POOL_SIZE,
+    }
+
+
+def construir_cuerpo_n8n(data):
+    """
+    Serializa el payload según N8N_TRANSPORT. Retorna (cuerpo, headers).
+
+    - json: todo en un JSON con la CSF en base64 dentro de csf_pdf.content
+    - multipart: parte "metadata" (JSON, opcionalmente gzip) + parte
+      "csf_pdf" con el PDF binario tal cual, sin base64
+    """
+    if Config.N8N_TRANSPORT != 'multipart':
+        return json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'}
+
+    csf = data['csf_pdf']
+    metadata = dict(data)
+    metadata['csf_pdf'] = {k: v for k, v in csf.items() if k != 'stream'}
+    metadata_bytes = json.dumps(metadata).encode('utf-8')
+
+    if Config.N8N_GZIP_METADATA:
+        parte_metadata = ('metadata', 'metadata.json.gz', 'application/json',
+                          gzip.compress(metadata_bytes), {'Content-Encoding': 'gzip'})
+    else:
+        parte_metadata = ('metadata', None, 'application/json', metadata_bytes, None)
+
+    body = MultipartBody([
+        parte_metadata,
+        ('csf_pdf', csf['filename'], csf['mime_type'], csf['stream'], None),
+    ])
+    return body, {'Content-Type': body.content_type}
+
+
+def _n8n_pudo_recibir(error):
+    """
+    False solo si el POST nunca llegó a n8n (no se pudo abrir la conexión).
+    Un timeout de lectura o una conexión cortada a media respuesta dejan el
+    resultado indeterminado: n8n pudo haber creado la factura.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    causa = error.args[0] if error.args else None
+    return not isinstance(getattr(causa, 'reason', causa), NewConnectionError)
+
+
 def enviar_a_n8n(data):
     """
     Envía datos al webhook de n8n
     n8n se encarga de toda la lógica: validar elegibilidad, crear factura, etc.
+
+    En un fallo, 'reintentable' indica si vale la pena reenviar e
+    'indeterminado' si n8n pudo haber procesado la solicitud (timeout de
+    lectura, 5xx, conexión cortada después de enviar).
     """
-    logger.info("=" * 80)
-    logger.info("INICIANDO ENVÍO DE DATOS A N8N")
-    logger.info("=" * 80)
+    order_id = data.get('order_id')
+    contexto = {'evento': 'n8n.envio', 'order_id': order_id, 'transporte': Config.N8N_TRANSPORT}
+    inicio = time.monotonic()
 
     try:
-        # Log del endpoint
-        logger.info(f"📡 Endpoint n8n: {Config.N8N_WEBHOOK_URL}")
-
-        # Log del payload (sin datos sensibles completos)
-        logger.info("📦 Payload a enviar:")
-        logger.info(f"  - Order ID: {data.get('order_id')}")
-        logger.info(f"  - Paid Amount: {data.get('paid_amount')} {data.get('currency_id')}")
-        logger.info(f"  - Email: {data.get('email')}")
-        logger.info(f"  - Phone: {data.get('phone')}")
-        logger.info(f"  - CFDI Usage: {data.get('cfdi_usage')}")
-        logger.info(f"  - Payment Method: {data.get('payment_method')}")
-        logger.info(f"  - CSF Filename: {data.get('csf_pdf', {}).get('filename')}")
-        logger.info(f"  - CSF Size: {len(data.get('csf_pdf', {}).get('content', ''))} bytes (base64)")
-        logger.info(f"  - Timestamp: {data.get('timestamp')}")
-        logger.info(f"  - Source: {data.get('source')}")
-
-        # Serializar payload para log completo (útil para debugging)
-        payload_size = len(json.dumps(data))
-        logger.info(f"📊 Tamaño total del payload: {payload_size} bytes")
-
-        # Intentar enviar a n8n
-        logger.info("🚀 Enviando request POST a n8n...")
-
-        response = requests.post(
-            Config.N8N_WEBHOOK_URL,
-            json=data,
-            headers={'Content-Type': 'application/json'},
-            timeout=60  # n8n puede tardar procesando Odoo
-        )
-
-        # Log de la respuesta
-        logger.info(f"✅ Respuesta recibida de n8n")
-        logger.info(f"  - Status Code: {response.status_code}")
-        logger.info(f"  - Response Headers: {dict(response.headers)}")
+        # Serializar una sola vez; el tamaño del log sale del mismo cuerpo que se envía
+        with medir_etapa('n8n_cuerpo'):
+            body, headers = construir_cuerpo_n8n(data)
+        contexto['bytes'] = len(body)
+
+        # Detalle del payload (sin la CSF) solo en requests muestreados
+        logger.debug("📦 Payload a enviar a n8n", extra={
+            **contexto,
+            'paid_amount': data.get('paid_amount'),
+            'currency_id': data.get('currency_id'),
+            'cfdi_usage': data.get('cfdi_usage'),
+            'payment_method': data.get('payment_method'),
+            'csf_size': data.get('csf_pdf', {}).get('size'),
+            'source': data.get('source'),
+        })
+
+        inicio_post = time.perf_counter()
+        try:
+            response = get_n8n_session().post(
+                Config.N8N_WEBHOOK_URL,
+                data=body,
+                headers=headers,
+                timeout=(Config.N8N_CONNECT_TIMEOUT, Config.N8N_TIMEOUT)  # n8n puede tardar procesando Odoo
+            )
+        finally:
+            observar_etapa('n8n_post', inicio_post)
+        contexto['status_code'] = response.status_code
 
         if response.status_code == 200:
             response_data = response.json()
-            logger.info("✅ ÉXITO - n8n procesó la solicitud correctamente")
-            logger.info(f"  - Response Body: {json.dumps(response_data, indent=2)}")
-            logger.info("=" * 80)
+            contexto['duracion_ms'] = round((time.monotonic() - inicio) * 1000)
+            N8N_ENVIOS.labels(resultado='exito').inc()
+            logger.info(f"✅ n8n procesó la orden {order_id}", extra=contexto)
+            logger.debug("Respuesta de n8n", extra={**contexto, 'respuesta': response_data})
             return True, response_data
         else:
-            logger.error(f"❌ ERROR - n8n respondió con error")
-            logger.error(f"  - Status Code: {response.status_code}")
-            logger.error(f"  - Response Text: {response.text}")
-            logger.error("=" * 80)
-            return False, {'error': f'Error del servidor: {response.status_code}'}
-
-    except requests.exceptions.Timeout:
-        logger.error("❌ TIMEOUT - n8n no respondió a tiempo")
-        logger.error(f"  - Timeout configurado: 60 segundos")
-        logger.error("  - Posibles causas: n8n caído, procesamiento lento en Odoo, red lenta")
-        logger.error("=" * 80)
-        return False, {'error': 'El servidor tardó demasiado en responder'}
+            contexto['duracion_ms'] = round((time.monotonic() - inicio) * 1000)
+            N8N_ENVIOS.labels(resultado='http_error').inc()
+            logger.error(f"❌ n8n respondió {response.status_code} para la orden {order_id}",
+                         extra={**contexto, 'respuesta': response.text[:2000]})
+            # 5xx / 408 / 429: n8n o su ingress no disponible, se puede reintentar.
+            # Un 5xx pudo llegar después de crear la factura: indeterminado
+            reintentable = response.status_code >= 500 or response.status_code in (408, 429)
+            return False, {'error': f'Error del servidor: {response.status_code}',
+                           'status_code': response.status_code, 'reintentable': reintentable,
+                           'indeterminado': response.status_code >= 500}
+
+    # Antes que RequestException: requests.JSONDecodeError hereda de ambas
+    except json.JSONDecodeError as e:
+        N8N_ENVIOS.labels(resultado='json_invalido').inc()
+        logger.error(f"❌ n8n respondió JSON inválido para la orden {order_id}: {e}",
+                     extra={**contexto, 'respuesta': response.text[:2000]})
+        return False, {'error': 'Respuesta inválida del servidor', 'status_code': response.status_code}
+
+    except requests.exceptions.Timeout as e:
+        N8N_ENVIOS.labels(resultado='timeout').inc()
+        logger.error(f"❌ Timeout de n8n ({Config.N8N_TIMEOUT}s) para la orden {order_id}",
+                     extra={**contexto, 'error': 'timeout'})
+        return False, {'error': 'El servidor tardó demasiado en responder', 'reintentable': True,
+                       'indeterminado': _n8n_pudo_recibir(e)}
 
     except requests.exceptions.ConnectionError as e:
-        logger.error("❌ ERROR DE CONEXIÓN - No se pudo conectar con n8n")
-        logger.error(f"  - URL: {Config.N8N_WEBHOOK_URL}")
-        logger.error(f"  - Error: {str(e)}")
-        logger.error("  - Posibles causas: n8n no está ejecutándose, URL incorrecta, firewall")
-        logger.error("=" * 80)
-        return False, {'error': 'No se pudo conectar con el servicio de facturación'}
+        N8N_ENVIOS.labels(resultado='conexion').inc()
+        logger.error(f"❌ No se pudo conectar con n8n para la orden {order_id}: {e}",
+                     extra={**contexto, 'error': 'conexion'})
+        return False, {'error': 'No se pudo conectar con el servicio de facturación', 'reintentable': True,
+                       'indeterminado': _n8n_pudo_recibir(e)}
 
     except requests.exceptions.RequestException as e:
-        logger.error("❌ ERROR EN REQUEST - Excepción general de requests")
-        logger.error(f"  - Tipo de error: {type(e).__name__}")
-        logger.error(f"  - Detalle: {str(e)}")
-        logger.error("=" * 80)
-        return False, {'error': 'No se pudo conectar con el servicio de facturación'}
-
-    except json.JSONDecodeError as e:
-        logger.error("❌ ERROR JSON - n8n respondió con JSON inválido")
-        logger.error(f"  - Error: {str(e)}")
-        logger.error(f"  - Response text: {response.text if 'response' in locals() else 'N/A'}")
-        logger.error("=" * 80)
-        return False, {'error': 'Respuesta inválida del servidor'}
+        N8N_ENVIOS.labels(resultado='error').inc()
+        logger.error(f"❌ Error de request hacia n8n para la orden {order_id}: {type(e).__name__}: {e}",
+                     extra={**contexto, 'error': type(e).__name__})
+        return False, {'error': 'No se pudo conectar con el servicio de facturación', 'reintentable': True,
+                       'indeterminado': True}
 
     except Exception as e:
-        logger.error("❌ ERROR INESPERADO en enviar_a_n8n")
-        logger.error(f"  - Tipo: {type(e).__name__}")
-        logger.error(f"  - Mensaje: {str(e)}")
-        logger.exception("  - Stack trace completo:")
-        logger.error("=" * 80)
+        N8N_ENVIOS.labels(resultado='error').inc()
+        logger.exception(f"❌ Error inesperado en enviar_a_n8n para la orden {order_id}",
+                         extra={**contexto, 'error': type(e).__name__})
         return False, {'error': f'Error inesperado: {str(e)}'}
 
 
+# ============================================================================
+# ENVÍO A N8N EN SEGUNDO PLANO (OUTBOX)
+# ============================================================================
+
+_n8n_executor = None
+_n8n_executor_pid = None
+_n8n_cupos = None
+_n8n_executor_lock = threading.Lock()
+
+
+def get_n8n_executor():
+    """
+    Executor acotado del proceso actual para los envíos a n8n.
+    Retorna (executor, semáforo de cupos). Los cupos limitan envíos
+    en curso + en espera a N8N_EXECUTOR_WORKERS + N8N_EXECUTOR_QUEUE.
+    """
+    global _n8n_executor, _n8n_executor_pid, _n8n_cupos
+
+    with _n8n_executor_lock:
+        if _n8n_executor is None or _n8n_executor_pid != os.getpid():
+            _n8n_executor = ThreadPoolExecutor(
+                max_workers=Config.N8N_EXECUTOR_WORKERS,
+                thread_name_prefix='envio-n8n'
+            )
+            _n8n_cupos = threading.BoundedSemaphore(Config.N8N_EXECUTOR_WORKERS + Config.N8N_EXECUTOR_QUEUE)
+            _n8n_executor_pid = os.getpid()
+    return _n8n_executor, _n8n_cupos
+
+
+def clave_idempotencia(order_id, csf_sha256):
+    """Misma orden con la misma CSF = misma solicitud (doble clic, reenvío del formulario)"""
+    return hashlib.sha256(f"{order_id}:{csf_sha256}".encode()).hexdigest()
+
+
+def _jobs_existentes(cursor, claves):
+    """
+    Toma el advisory lock de cada clave (en orden, para no bloquearse entre
+    lotes) y regresa {clave: (job_id, status)} de las que ya tienen un job
+    en curso o completado dentro de IDEMPOTENCIA_VENTANA. Los locks duran
+    hasta el fin de la transacción.
+    """
+    claves = sorted(set(claves))
+    cursor.execute(
+        "SELECT pg_advisory_xact_lock(hashtextextended(k, 0)) FROM unnest(%s::text[]) AS k",
+        (claves,)
+    )
+    cursor.execute(
+        """
+        SELECT DISTINCT ON (clave_idempotencia) clave_idempotencia, id, status
+        FROM facturacion_jobs
+        WHERE clave_idempotencia = ANY(%s)
+          AND (status IN ('pendiente', 'enviando', 'reintentando')
+               OR (status = 'completado' AND finished_at > NOW() - make_interval(secs => %s)))
+        ORDER BY clave_idempotencia, created_at DESC
+        """,
+        (claves, Config.IDEMPOTENCIA_VENTANA)
+    )
+    return {clave: (str(job_id), status) for clave, job_id, status in cursor.fetchall()}
+
+
+def _guardar_csf(cursor, csf, stream):
+    """
+    Guarda la CSF en csf_documentos (una vez por contenido). Los bytes van
+    a un large object escrito por bloques de CSF_BLOQUE_BD desde el archivo
+    temporal de leer_csf(), así el request nunca tiene la CSF completa en
+    memoria. Se usa lo_put por SQL y no connection.lobject(), que no
+    funciona con psycopg2 cooperativo (modo async).
+    """
+    cursor.execute("UPDATE csf_documentos SET ultimo_uso_at = NOW() WHERE sha256 = %s", (csf['sha256'],))
+    if cursor.rowcount:
+        return
+
+    cursor.execute("SELECT lo_from_bytea(0, '')")
+    oid = cursor.fetchone()[0]
+    posicion = 0
+    for bloque in iter(lambda: stream.read(CSF_BLOQUE_BD), b''):
+        cursor.execute("SELECT lo_put(%s, %s, %s)", (oid, posicion, psycopg2.Binary(bloque)))
+        posicion += len(bloque)
+
+    cursor.execute(
+        """
+        INSERT INTO csf_documentos (sha256, contenido_oid, mime_type, size)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (sha256) DO UPDATE SET ultimo_uso_at = NOW()
+        RETURNING contenido_oid
+        """,
+        (csf['sha256'], oid, csf['mime_type'], csf['size'])
+    )
+    if cursor.fetchone()[0] != oid:
+        # Otro request guardó la misma CSF mientras se escribía esta
+        cursor.execute("SELECT lo_unlink(%s)", (oid,))
+
+
+def encolar_envio_n8n(payload, stream):
+    """
+    Guarda la solicitud en el outbox (facturacion_jobs + csf_documentos)
+    en una sola transacción y la envía a n8n en segundo plano. `stream`
+    es el archivo temporal de leer_csf(); se copia a la BD por bloques.
+    Retorna (job_id, status del job existente o None si es nuevo).
+
+    Si ya hay un job con la misma clave de idempotencia en curso, o
+    completado hace menos de IDEMPOTENCIA_VENTANA, se regresa ese job y no
+    se guarda ni se envía nada. El advisory lock de la clave serializa los
+    duplicados simultáneos entre workers y réplicas.
+
+    Si el executor del proceso está lleno la solicitud no se rechaza:
+    queda pendiente y la entrega outbox_worker.py pasado OUTBOX_GRACIA.
+    """
+    csf = payload['csf_pdf']
+    job_id = str(uuid.uuid4())
+    clave = clave_idempotencia(payload['order_id'], csf['sha256'])
+
+    with db_cursor() as cursor:
+        existente = _jobs_existentes(cursor, [clave]).get(clave)
+        if existente:
+            cursor.connection.rollback()
+            return existente
+
+        _guardar_csf(cursor, csf, stream)
+        cursor.execute(
+            """
+            INSERT INTO facturacion_jobs (id, order_id, email, status, payload, csf_sha256, clave_idempotencia,
+                                          proximo_intento_at)
+            VALUES (%s, %s, %s, 'pendiente', %s, %s, %s, NOW() + make_interval(secs => %s))
+            """,
+            (job_id, payload['order_id'], payload.get('email'), Json(payload), csf['sha256'], clave,
+             Config.OUTBOX_GRACIA)
+        )
+        cursor.connection.commit()
+
+    executor, cupos = get_n8n_executor()
+    if not cupos.acquire(blocking=False):
+        logger.warning(f"⏳ Executor de envíos lleno; el job {job_id} lo entregará outbox_worker",
+                       extra={'evento': 'outbox.diferido', 'job_id': job_id, 'order_id': payload['order_id']})
+        return job_id, None
+
+    # CSF grandes se releen de la BD al enviar para no retenerlas en memoria mientras esperan
+    en_memoria = None
+    if csf['size'] <= Config.CSF_SPOOL_MAX_MEMORY:
+        stream.seek(0)
+        en_memoria = stream.read()
+    try:
+        executor.submit(_procesar_job_n8n, job_id, en_memoria, cupos)
+    except Exception:
+        cupos.release()
+        logger.exception(f"⏳ No se pudo programar el envío inmediato del job {job_id}; queda en outbox")
+
+    return job_id, None
+
+
+def encolar_lote_n8n(lote_id, email, csf, stream, filas):
+    """
+    Versión en lote de encolar_envio_n8n() para la facturación masiva.
+
+    `filas` es la lista de renglones del CSV; los válidos traen 'payload'.
+    `csf` es la metadata de la constancia (sha256, size, mime_type), como
+    payload['csf_pdf'] en encolar_envio_n8n(), y `stream` su archivo temporal.
+    En una sola transacción guarda la CSF una vez, crea un job por renglón
+    válido (todos con el mismo csf_sha256) y registra el lote en
+    facturacion_lotes. Los renglones con un job en curso o completado
+    (misma orden y CSF) se ligan a ese job en vez de crear otro.
+
+    Regresa las filas (sin payload) con su job_id. Los jobs nuevos no se
+    envían desde el web: los entrega outbox_worker.py, y su
+    proximo_intento_at se escalona para que a lo más MASIVA_CONCURRENCIA
+    queden listos cada MASIVA_INTERVALO segundos. Así un lote no ocupa el
+    executor de envíos individuales ni satura n8n.
+    """
+    claves = {i: clave_idempotencia(f['payload']['order_id'], csf['sha256'])
+              for i, f in enumerate(filas) if 'payload' in f}
+    nuevos = []
+
+    with db_cursor() as cursor:
+        existentes = _jobs_existentes(cursor, list(claves.values())) if claves else {}
+        _guardar_csf(cursor, csf, stream)
+
+        for i, clave in claves.items():
+            fila = filas[i]
+            payload = fila.pop('payload')
+            if clave in existentes:
+                fila['job_id'], fila['existente'] = existentes[clave]
+                continue
+            fila['job_id'] = str(uuid.uuid4())
+            espera = (len(nuevos) // Config.MASIVA_CONCURRENCIA) * Config.MASIVA_INTERVALO
+            nuevos.append((fila['job_id'], payload['order_id'], email, Json(payload), csf['sha256'], clave,
+                           espera))
+
+        if nuevos:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO facturacion_jobs (id, order_id, email, status, payload, csf_sha256, clave_idempotencia,
+                                              proximo_intento_at)
+                VALUES %s
+                """,
+                nuevos,
+                template="(%s, %s, %s, 'pendiente', %s, %s, %s, NOW() + make_interval(secs => %s))",
+                page_size=Config.MASIVA_MAX_FILAS
+            )
+        cursor.execute(
+            """
+            INSERT INTO facturacion_lotes (id, email, csf_sha256, total, filas)
+            VALUES (%s, %s, %s, %s, %s)
+            """,
+            (lote_id, email, csf['sha256'], len(filas), Json(filas))
+        )
+        cursor.connection.commit()
+
+    if nuevos:
+        logger.info(f"📦 Lote {lote_id}: {len(nuevos)} envíos programados para outbox_worker",
+                    extra={'evento': 'lote.encolado', 'lote_id': lote_id, 'jobs': len(nuevos),
+                           'duracion_estimada_s': round(nuevos[-1][-1])})
+
+    return filas
+
+
+def generar_token_envio():
+    """Identifica a quien tiene reclamado un job (host:pid:aleatorio)"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def reclamar_job(job_id, token):
+    """
+    Reclama un job recién creado para el envío inmediato desde el web.
+    Retorna la fila o None si ya lo reclamó un worker.
+    """
+    with db_cursor(RealDictCursor) as cursor:
+        cursor.execute(
+            """
+            UPDATE facturacion_jobs
+            SET status = 'enviando',
+                intentos = intentos + 1,
+                bloqueado_por = %s,
+                bloqueado_hasta = NOW() + make_interval(secs => %s)
+            WHERE id = %s AND status = 'pendiente'
+            RETURNING id, order_id, email, payload, csf_sha256, intentos
+            """,
+            (token, Config.OUTBOX_LEASE, job_id)
+        )
+        job = cursor.fetchone()
+        cursor.connection.commit()
+    return job
+
+
+def reclamar_jobs_outbox(limite, token):
+    """
+    Reclama hasta `limite` jobs listos para enviar: pendientes o en
+    reintento cuyo proximo_intento_at ya pasó, y envíos abandonados
+    (lease vencido). FOR UPDATE SKIP LOCKED permite que varios workers
+    drenen el outbox en paralelo sin tomar el mismo job.
+    """
+    with db_cursor(RealDictCursor) as cursor:
+        cursor.execute(
+            """
+            UPDATE facturacion_jobs j
+            SET status = 'enviando',
+                intentos = j.intentos + 1,
+                bloqueado_por = %s,
+                bloqueado_hasta = NOW() + make_interval(secs => %s)
+            WHERE j.id IN (
+                SELECT id FROM facturacion_jobs
+                WHERE (status IN ('pendiente', 'reintentando') AND proximo_intento_at <= NOW())
+                   OR (status = 'enviando' AND bloqueado_hasta < NOW())
+                ORDER BY proximo_intento_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING j.id, j.order_id, j.email, j.payload, j.csf_sha256, j.intentos
+            """,
+            (token, Config.OUTBOX_LEASE, limite)
+        )
+        jobs = cursor.fetchall()
+        cursor.connection.commit()
+    return jobs
+
+
+def renovar_lease(job_id, token):
+    """
+    Extiende el lease de un job justo antes de enviarlo. Regresa False si
+    el job ya no está reclamado con `token` (el lease venció y lo tomó otro
+    worker): en ese caso no se debe enviar.
+    """
+    with db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE facturacion_jobs
+            SET bloqueado_hasta = NOW() + make_interval(secs => %s)
+            WHERE id = %s AND bloqueado_por = %s AND status = 'enviando'
+            """,
+            (Config.OUTBOX_LEASE, job_id, token)
+        )
+        renovado = cursor.rowcount == 1
+        cursor.connection.commit()
+    return renovado
+
+
+def factura_existente(order_id):
+    """True si la orden ya tiene factura (la registra n8n al crearla en Odoo)"""
+    with db_cursor() as cursor:
+        cursor.execute("SELECT 1 FROM facturas WHERE order_id = %s", (order_id,))
+        return cursor.fetchone() is not None
+
+
+def _cargar_csf(sha256):
+    """Contenido binario de la CSF guardada en el outbox (large object o, en filas anteriores, BYTEA)"""
+    with db_cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(lo_get(contenido_oid), contenido) FROM csf_documentos WHERE sha256 = %s",
+            (sha256,)
+        )
+        row = cursor.fetchone()
+    return bytes(row[0]) if row else None
+
+
+def _backoff_outbox(intentos):
+    """Segundos hasta el siguiente intento: exponencial con jitter"""
+    espera = min(Config.OUTBOX_BACKOFF_BASE * (2 ** (intentos - 1)), Config.OUTBOX_BACKOFF_MAX)
+    return random.uniform(espera / 2, espera)
+
+
+def _finalizar_entrega(job_id, token, status, mensaje, respuesta=None, status_code=None,
+                       error=None, reintentar_en=None):
+    """
+    Guarda el resultado de un envío. Solo aplica si el job sigue
+    reclamado con `token`: si el lease venció y otro worker lo tomó,
+    el resultado de este envío se descarta.
+    """
+    with db_cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE facturacion_jobs
+            SET status = %s,
+                mensaje = COALESCE(%s, mensaje),
+                respuesta = COALESCE(%s, respuesta),
+                n8n_status_code = %s,
+                ultimo_error = %s,
+                proximo_intento_at = CASE WHEN %s::float IS NULL THEN proximo_intento_at
+                                          ELSE NOW() + make_interval(secs => %s::float) END,
+                bloqueado_por = NULL,
+                bloqueado_hasta = NULL,
+                finished_at = CASE WHEN %s IS NULL THEN NOW() ELSE NULL END
+            WHERE id = %s AND bloqueado_por = %s
+            """,
+            (status, mensaje, Json(respuesta) if respuesta is not None else None, status_code, error,
+             reintentar_en, reintentar_en, reintentar_en, job_id, token)
+        )
+        actualizado = cursor.rowcount == 1
+        cursor.connection.commit()
+
+    if not actualizado:
+        logger.warning(f"⚠️ Job {job_id} ya no está reclamado por {token}; se descarta el resultado")
+    return actualizado
+
+
+def entregar_job(job, token, contenido=None):
+    """
+    Envía a n8n un job reclamado y registra la respuesta.
+
+    Errores de conexión, timeouts y 5xx se reintentan con backoff hasta
+    OUTBOX_MAX_INTENTOS. Un timeout de lectura o un 5xx son indeterminados
+    (n8n pudo crear la factura): el reintento espera al menos
+    OUTBOX_ESPERA_INDETERMINADO y, como todo reintento, antes de reenviar
+    revisa facturas; si la orden ya tiene factura el job se da por
+    completado sin volver a llamar a n8n. Una respuesta de n8n con
+    success=false o un 4xx es definitiva.
+    """
+    job_id = str(job['id'])
+    payload = dict(job['payload'])
+
+    if contenido is None:
+        contenido = _cargar_csf(job['csf_sha256'])
+    if contenido is None:
+        logger.error(f"❌ Job {job_id} - CSF {job['csf_sha256']} no encontrada en csf_documentos")
+        _finalizar_entrega(job_id, token, 'error', 'No se encontró la constancia fiscal. Intenta nuevamente.',
+                           error='CSF no encontrada')
+        return 'error'
+
+    # El lease se tomó al reclamar; si el job esperó turno en el executor
+    # pudo vencer y otro worker tomarlo. Se renueva (y se verifica) justo
+    # antes del POST para que n8n nunca reciba el mismo job dos veces.
+    if not renovar_lease(job_id, token):
+        logger.warning(f"⚠️ Job {job_id} ya no está reclamado por {token}; no se envía",
+                       extra={'evento': 'outbox.lease_perdido', 'job_id': job_id, 'order_id': job['order_id']})
+        return 'lease_perdido'
+
+    if job['intentos'] > 1 and factura_existente(job['order_id']):
+        logger.info(f"✅ Job {job_id} - la orden {job['order_id']} ya tiene factura; no se reenvía",
+                    extra={'evento': 'outbox.ya_facturada', 'job_id': job_id, 'order_id': job['order_id'],
+                           'intentos': job['intentos']})
+        _finalizar_entrega(job_id, token, 'completado',
+                           f"Tu factura ya fue generada; la recibirás en: {payload.get('email')}")
+        return 'completado'
+
+    csf = dict(payload['csf_pdf'])
+    if Config.N8N_TRANSPORT == 'multipart':
+        csf['stream'] = io.BytesIO(contenido)
+    else:
+        csf['content'] = base64.b64encode(contenido).decode('ascii')
+    payload['csf_pdf'] = csf
+
+    success, response = enviar_a_n8n(payload)
+
+    if success and response.get('success'):
+        mensaje = response.get('message',
+            f"¡Solicitud enviada! Recibirás tu factura en: {payload.get('email')}")
+        logger.info(f"✅ Job {job_id} completado",
+                    extra={'evento': 'outbox.completado', 'job_id': job_id, 'order_id': job['order_id'],
+                           'intentos': job['intentos']})
+        _finalizar_entrega(job_id, token, 'completado', mensaje, response, status_code=200)
+        return 'completado'
+
+    if success:
+        # n8n retornó error (pedido no elegible, error en Odoo, etc.)
+        error_msg = response.get('message', 'Error al procesar la factura')
+        logger.error(f"❌ Job {job_id} - n8n reportó error: {error_msg}",
+                     extra={'evento': 'outbox.rechazado', 'job_id': job_id, 'order_id': job['order_id']})
+        _finalizar_entrega(job_id, token, 'rechazado', error_msg, response, status_code=200, error=error_msg)
+        return 'rechazado'
+
+    error_msg = response.get('error', 'Error desconocido')
+    status_code = response.get('status_code')
+
+    if response.get('reintentable') and job['intentos'] < Config.OUTBOX_MAX_INTENTOS:
+        espera = _backoff_outbox(job['intentos'])
+        if response.get('indeterminado'):
+            # n8n pudo seguir procesando: darle tiempo de registrar la factura antes de revisar
+            espera = max(espera, Config.OUTBOX_ESPERA_INDETERMINADO)
+        logger.warning(f"🔁 Job {job_id} - intento {job['intentos']} falló ({error_msg}); "
+                       f"reintento en {espera:.0f}s",
+                       extra={'evento': 'outbox.reintento', 'job_id': job_id, 'order_id': job['order_id'],
+                              'intentos': job['intentos'], 'espera_s': round(espera),
+                              'indeterminado': bool(response.get('indeterminado'))})
+        _finalizar_entrega(
+            job_id, token, 'reintentando',
+            'El servicio de facturación no está disponible en este momento. Tu solicitud quedó '
+            'registrada y se reintentará automáticamente; recibirás tu factura por correo.',
+            status_code=status_code, error=error_msg, reintentar_en=espera
+        )
+        return 'reintentando'
+
+    logger.error(f"❌ Job {job_id} - Falló el envío a n8n tras {job['intentos']} intento(s): {error_msg}",
+                 extra={'evento': 'outbox.error', 'job_id': job_id, 'order_id': job['order_id'],
+                        'intentos': job['intentos']})
+    _finalizar_entrega(job_id, token, 'error', f'No se pudo procesar la solicitud: {error_msg}',
+                       response, status_code=status_code, error=error_msg)
+    return 'error'
+
+
+def _procesar_job_n8n(job_id, contenido, cupos):
+    """Envío inmediato desde el web, en un hilo del executor"""
+    token = generar_token_envio()
+    try:
+        job = reclamar_job(job_id, token)
+        if job is None:
+            logger.info(f"ℹ️ Job {job_id} ya fue reclamado por outbox_worker")
+            return
+        entregar_job(job, token, contenido)
+    except Exception:
+        # El job queda 'enviando' y outbox_worker lo retoma al vencer el lease
+        logger.exception(f"❌ Job {job_id} - Error inesperado procesando envío")
+    finally:
+        cupos.release()
+
+
+def purgar_csf_documentos():
+    """
+    Borra las CSF cuyos jobs ya terminaron hace más de
+    OUTBOX_RETENCION_CSF_DIAS días. Retorna cuántas se borraron.
+    """
+    with db_cursor() as cursor:
+        cursor.execute(
+            """
+            WITH borrados AS (
+                DELETE FROM csf_documentos d
+                WHERE d.ultimo_uso_at < NOW() - make_interval(days => %s)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM facturacion_jobs j
+                      WHERE j.csf_sha256 = d.sha256
+                        AND (j.finished_at IS NULL OR j.finished_at > NOW() - make_interval(days => %s))
+                  )
+                RETURNING d.contenido_oid
+            )
+            SELECT count(*), count(lo_unlink(contenido_oid)) FROM borrados
+            """,
+            (Config.OUTBOX_RETENCION_CSF_DIAS, Config.OUTBOX_RETENCION_CSF_DIAS)
+        )
+        borrados = cursor.fetchone()[0]
+        cursor.connection.commit()
+    return borrados
+
+
 # ============================================================================
 # RUTAS - INTERFAZ DE USUARIO
 # ============================================================================
@@ -259,29 +1843,80 @@ def buscar_pedido_route():
     """Busca un pedido y muestra el formulario de facturación"""
     search_id = request.form.get('search_id', '').strip()
 
-    logger.info(f"🔍 Búsqueda de pedido iniciada - ID: {search_id}")
-
     if not search_id:
-        logger.warning("⚠️  Búsqueda sin ID proporcionado")
         flash('Por favor ingresa un ID de pedido o pago.', 'error')
         return redirect(url_for('index'))
 
     # Buscar pedido en Postgres
-    logger.info(f"📊 Consultando base de datos para ID: {search_id}")
     order = buscar_pedido(search_id)
 
     if not order:
-        logger.warning(f"❌ No se encontró pedido con ID: {search_id}")
+        logger.info(f"🔍 Pedido no encontrado - ID: {search_id}",
+                    extra={'evento': 'pedido.no_encontrado', 'search_id': search_id})
         flash('No se encontró ningún pedido con ese ID.', 'error')
         return redirect(url_for('index'))
 
-    logger.info(f"✅ Pedido encontrado - Order ID: {order['order_id']}, Amount: {order['paid_amount']}")
+    logger.info(f"🔍 Pedido encontrado - Order ID: {order['order_id']}",
+                extra={'evento': 'pedido.encontrado', 'search_id': search_id, 'order_id': order['order_id'],
+                       'coincidencia': order['match_kind']})
 
     # Guardar en sesión y mostrar formulario
     session['order_data'] = order
     return redirect(url_for('facturar', order_id=order['order_id']))
 
 
+def _token_api_valido():
+    """True solo si PEDIDOS_API_TOKEN está configurado y el request trae Authorization: Bearer <token>"""
+    if not Config.PEDIDOS_API_TOKEN:
+        return False
+    autorizacion = request.headers.get('Authorization', '')
+    return secrets.compare_digest(autorizacion.encode(), f'Bearer {Config.PEDIDOS_API_TOKEN}'.encode())
+
+
+@app.route('/api/pedidos/lookup', methods=['POST'])
+def api_pedidos_lookup():
+    """
+    Búsqueda de pedidos en lote (call center, herramientas B2B)
+
+    Payload: {"ids": ["2000001234", "pack-o-payment-id", ...]}
+    (hasta PEDIDOS_LOOKUP_MAX_LOTE IDs). Respuesta: los mismos campos que
+    /buscar-pedido por cada ID de entrada, o null si no se encontró.
+    Exige Authorization: Bearer <PEDIDOS_API_TOKEN>; sin token configurado responde 401.
+    """
+    if not _token_api_valido():
+        return jsonify({'error': 'No autorizado'}), 401
+
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'error': 'Se requiere una lista "ids"'}), 400
+    if len(ids) > Config.PEDIDOS_LOOKUP_MAX_LOTE:
+        return jsonify({'error': f'Máximo {Config.PEDIDOS_LOOKUP_MAX_LOTE} IDs por petición'}), 400
+    if not all(isinstance(i, (str, int)) and not isinstance(i, bool) for i in ids):
+        return jsonify({'error': 'Cada ID debe ser texto o número'}), 400
+
+    # Sin duplicados y en el orden recibido
+    search_ids = list(dict.fromkeys(s for s in (str(i).strip() for i in ids) if s))
+
+    try:
+        encontrados = buscar_pedidos(search_ids) if search_ids else {}
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Error de conexión'}), 503
+    except psycopg2.Error as e:
+        app.logger.error(f"Error buscando pedidos en lote: {e}")
+        return jsonify({'error': 'Error consultando pedidos'}), 500
+
+    logger.info(f"🔍 Búsqueda en lote - {len(encontrados)}/{len(search_ids)} encontrados",
+                extra={'evento': 'pedido.lote', 'solicitados': len(search_ids), 'encontrados': len(encontrados)})
+
+    return jsonify({
+        'success': True,
+        'pedidos': {search_id: encontrados.get(search_id) for search_id in search_ids},
+        'encontrados': len(encontrados),
+        'no_encontrados': [search_id for search_id in search_ids if search_id not in encontrados]
+    })
+
+
 @app.route('/facturar/<order_id>')
 def facturar(order_id):
     """Vista del formulario de facturación"""
@@ -299,68 +1934,97 @@ def facturar(order_id):
     )
 
 
+def construir_payload_factura(order, datos, csf, filename):
+    """
+    Payload para n8n de una solicitud de factura. `datos` trae email,
+    phone, cfdi_usage, payment_method y monto_pagado del formulario.
+    """
+    return {
+        # Datos del pedido
+        'order_id': order['order_id'],
+        'paid_amount': order['paid_amount'],
+        'currency_id': order.get('currency_id', 'MXN'),
+
+        # Datos del comprador (para crear usuario en portal)
+        'receiver_id': order.get('receiver_id'),
+        'shipping_id': order.get('shipping_id'),  # ✅ Corregido: shipping_id no shipment_id
+        'nombre': order.get('buyer_nickname', f"Cliente ML - {order['order_id']}"),
+
+        # Datos de facturación
+        'email': datos['email'],
+        'phone': datos['phone'],
+        'cfdi_usage': datos['cfdi_usage'],
+        'payment_method': datos['payment_method'],
+        'monto_pagado': datos['monto_pagado'],
+
+        # PDF de CSF: el contenido se guarda en csf_documentos y se agrega
+        # al enviar (base64 en 'content' o binario en modo multipart)
+        'csf_pdf': {
+            'filename': filename,
+            'mime_type': 'application/pdf',
+            'size': csf['size'],
+            'sha256': csf['sha256']
+        },
+
+        # Metadata
+        'timestamp': datetime.now().isoformat(),
+        'source': 'portal_flask'
+    }
+
+
 @app.route('/procesar-factura', methods=['POST'])
 def procesar_factura():
     """
     Procesa el formulario y envía todo a n8n
     n8n se encarga de: validar elegibilidad, crear factura en Odoo, enviar email
     """
-    logger.info("=" * 80)
-    logger.info("📝 PROCESANDO SOLICITUD DE FACTURA ODOO")
-    logger.info("=" * 80)
+    # Latencia por etapa en portal_etapa_segundos (ver metrics.py)
+    inicio = time.perf_counter()
 
     # Validar sesión
     if 'order_data' not in session:
-        logger.error("❌ Sesión expirada o no existe")
+        logger.warning("❌ Solicitud de factura sin sesión", extra={'evento': 'factura.rechazada', 'motivo': 'sesion'})
         flash('Sesión expirada. Busca el pedido nuevamente.', 'error')
         return redirect(url_for('index'))
 
     order = session['order_data']
-    logger.info(f"📦 Order ID: {order['order_id']}")
+    inicio = observar_etapa('sesion', inicio)
+
+    def rechazar(motivo, mensaje, **extra):
+        logger.warning(f"❌ Solicitud de factura rechazada ({motivo}) - Orden {order['order_id']}",
+                       extra={'evento': 'factura.rechazada', 'order_id': order['order_id'], 'motivo': motivo, **extra})
+        flash(mensaje, 'error')
+        return redirect(url_for('facturar', order_id=order['order_id']))
 
     # ========================================================================
     # VALIDAR ARCHIVO PDF
     # ========================================================================
-    logger.info("📄 Validando archivo PDF...")
 
     if 'csf_file' not in request.files:
-        logger.error("❌ No se encontró archivo en el request")
-        flash('Debes adjuntar la Constancia de Situación Fiscal (PDF).', 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
+        return rechazar('sin_archivo', 'Debes adjuntar la Constancia de Situación Fiscal (PDF).')
 
     file = request.files['csf_file']
     if file.filename == '':
-        logger.error("❌ Archivo sin nombre")
-        flash('No se seleccionó ningún archivo.', 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
-
-    logger.info(f"  - Nombre archivo: {file.filename}")
+        return rechazar('sin_archivo', 'No se seleccionó ningún archivo.')
 
     if not file.filename.lower().endswith('.pdf'):
-        logger.error(f"❌ Archivo no es PDF: {file.filename}")
-        flash('El archivo debe ser un PDF.', 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
+        return rechazar('extension', 'El archivo debe ser un PDF.', archivo=file.filename)
 
-    # Guardar temporalmente para validar
     filename = secure_filename(f"{order['order_id']}_{file.filename}")
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    logger.info(f"  - Guardando en: {file_path}")
-    file.save(file_path)
-
-    # Validar que sea PDF real
-    logger.info("  - Validando tipo MIME...")
-    if not validate_pdf_file(file_path):
-        os.remove(file_path)
-        logger.error("❌ Archivo no es un PDF válido (validación MIME falló)")
-        flash('El archivo no es un PDF válido.', 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
 
-    logger.info("✅ PDF validado correctamente")
+    # Validar que sea PDF real y calcular hash en una sola pasada; el base64
+    # (modo json) se genera al enviar, fuera del request
+    csf = leer_csf(file)
+    inicio = observar_etapa('csf', inicio)
+    if not csf:
+        return rechazar('mime', 'El archivo no es un PDF válido.', archivo=file.filename)
+
+    logger.debug("📄 CSF validada", extra={'evento': 'factura.csf', 'order_id': order['order_id'],
+                                            'csf_size': csf['size'], 'sha256': csf['sha256'][:12]})
 
     # ========================================================================
     # VALIDAR DATOS DEL FORMULARIO
     # ========================================================================
-    logger.info("📋 Validando datos del formulario...")
 
     cfdi_usage = request.form.get('cfdi_usage', '').strip()
     payment_method = request.form.get('payment_method', '').strip()
@@ -368,143 +2032,781 @@ def procesar_factura():
     phone = request.form.get('phone', '').strip()
     monto_pagado = request.form.get('monto_pagado', '').strip()
 
-    logger.info(f"  - CFDI Usage: {cfdi_usage}")
-    logger.info(f"  - Payment Method: {payment_method}")
-    logger.info(f"  - Email: {email}")
-    logger.info(f"  - Phone: {phone}")
-    logger.info(f"  - Monto Pagado: {monto_pagado}")
-
     # Validaciones básicas
     if not all([cfdi_usage, payment_method, email, monto_pagado]):
-        os.remove(file_path)
-        logger.error("❌ Campos obligatorios faltantes")
-        flash('Todos los campos obligatorios deben ser completados.', 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
+        return rechazar('campos', 'Todos los campos obligatorios deben ser completados.')
 
     if not validate_email(email):
-        os.remove(file_path)
-        logger.error(f"❌ Email inválido: {email}")
-        flash('El formato del correo electrónico no es válido.', 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
+        return rechazar('email', 'El formato del correo electrónico no es válido.')
 
     try:
         monto_pagado_float = float(monto_pagado)
-        logger.info(f"  - Monto convertido: {monto_pagado_float}")
     except ValueError:
-        os.remove(file_path)
-        logger.error(f"❌ Monto inválido (no numérico): {monto_pagado}")
-        flash('El monto pagado debe ser un número válido.', 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
+        return rechazar('monto', 'El monto pagado debe ser un número válido.', monto=monto_pagado)
 
     # Validar monto (tolerancia de 0.01)
     diferencia = abs(monto_pagado_float - order['paid_amount'])
-    logger.info(f"  - Validando monto: {monto_pagado_float} vs {order['paid_amount']} (diff: {diferencia})")
-
     if diferencia > 0.01:
-        os.remove(file_path)
-        logger.error(f"❌ Monto no coincide - Esperado: {order['paid_amount']}, Recibido: {monto_pagado_float}")
-        flash(f"El monto ingresado no coincide con el monto del pedido (${order['paid_amount']}).", 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
+        return rechazar('monto', f"El monto ingresado no coincide con el monto del pedido (${order['paid_amount']}).",
+                        monto=monto_pagado_float, esperado=order['paid_amount'])
 
-    logger.info("✅ Todos los datos del formulario son válidos")
+    inicio = observar_etapa('validacion', inicio)
 
     # ========================================================================
     # PREPARAR DATOS PARA N8N
     # ========================================================================
-    logger.info("📦 Preparando payload para n8n...")
-
-    # Convertir PDF a base64
-    logger.info("  - Convirtiendo PDF a base64...")
-    with open(file_path, 'rb') as f:
-        pdf_content = base64.b64encode(f.read()).decode('utf-8')
-    logger.info(f"  - PDF codificado: {len(pdf_content)} caracteres")
-
-    # Payload para n8n
-    payload = {
-        # Datos del pedido
-        'order_id': order['order_id'],
-        'paid_amount': order['paid_amount'],
-        'currency_id': order.get('currency_id', 'MXN'),
-
-        # Datos del comprador (para crear usuario en portal)
-        'receiver_id': order.get('receiver_id'),
-        'shipping_id': order.get('shipping_id'),  # ✅ Corregido: shipping_id no shipment_id
-        'nombre': order.get('buyer_nickname', f"Cliente ML - {order['order_id']}"),
 
-        # Datos de facturación
+    payload = construir_payload_factura(order, {
         'email': email,
         'phone': phone,
         'cfdi_usage': cfdi_usage,
         'payment_method': payment_method,
         'monto_pagado': monto_pagado_float,
-
-        # PDF de CSF (en base64)
-        'csf_pdf': {
-            'filename': filename,
-            'content': pdf_content,
-            'mime_type': 'application/pdf'
-        },
-
-        # Metadata
-        'timestamp': datetime.now().isoformat(),
-        'source': 'portal_flask'
-    }
-
-    logger.info("✅ Payload preparado correctamente")
-
-    # Eliminar archivo temporal
-    logger.info(f"🗑️  Eliminando archivo temporal: {file_path}")
-    os.remove(file_path)
+    }, csf, filename)
 
     # ========================================================================
     # ENVIAR A N8N
     # ========================================================================
 
-    success, response = enviar_a_n8n(payload)
-
-    if not success:
-        error_msg = response.get('error', 'Error desconocido')
-        logger.error(f"❌ Falló el envío a n8n: {error_msg}")
-        flash(f'No se pudo procesar la solicitud: {error_msg}', 'error')
+    # La solicitud queda guardada en el outbox antes de responder; el envío
+    # (hasta N8N_TIMEOUT segundos) corre en segundo plano y, si n8n no está
+    # disponible, outbox_worker lo reintenta. La página de éxito consulta el job
+    try:
+        with csf['stream'] as stream, medir_etapa('outbox'):
+            job_id, existente = encolar_envio_n8n(payload, stream)
+    except psycopg2.Error as e:
+        logger.error(f"❌ No se pudo registrar la solicitud - Orden {order['order_id']}: {e}",
+                     extra={'evento': 'factura.error', 'order_id': order['order_id']})
+        flash('No se pudo registrar la solicitud. Intenta nuevamente.', 'error')
         return redirect(url_for('facturar', order_id=order['order_id']))
 
-    # Procesar respuesta de n8n
-    logger.info("📨 Procesando respuesta de n8n...")
+    if existente:
+        # Doble clic o reenvío: se muestra la solicitud original en vez de mandar otra a n8n
+        logger.info(f"🔁 Solicitud duplicada - Orden {order['order_id']} (job {job_id}, {existente})",
+                    extra={'evento': 'factura.duplicada', 'order_id': order['order_id'], 'job_id': job_id,
+                           'status': existente})
+        flash('Ya habíamos recibido esta solicitud; te mostramos su estado.', 'info')
+        return redirect(url_for('exito', order_id=order['order_id'], job=job_id))
 
-    if response.get('success'):
-        # Limpiar sesión
-        session.pop('order_data', None)
+    logger.info(f"📝 Solicitud de factura registrada - Orden {order['order_id']}",
+                extra={'evento': 'factura.encolada', 'order_id': order['order_id'], 'job_id': job_id,
+                       'csf_size': csf['size'], 'cfdi_usage': cfdi_usage, 'payment_method': payment_method})
 
-        mensaje = response.get('message',
-            f'¡Solicitud enviada! Recibirás tu factura en: {email}')
-        logger.info(f"✅ ÉXITO TOTAL - {mensaje}")
-        flash(mensaje, 'success')
-        return redirect(url_for('exito', order_id=order['order_id']))
-    else:
-        # n8n retornó error (pedido no elegible, error en Odoo, etc.)
-        error_msg = response.get('message', 'Error al procesar la factura')
-        logger.error(f"❌ n8n reportó error: {error_msg}")
-        flash(error_msg, 'error')
-        return redirect(url_for('facturar', order_id=order['order_id']))
+    return redirect(url_for('exito', order_id=order['order_id'], job=job_id))
 
 
 @app.route('/exito/<order_id>')
 def exito(order_id):
-    """Página de confirmación exitosa"""
-    return render_template('exito.html', order_id=order_id)
+    """Página de confirmación: muestra el avance del envío a n8n"""
+    return render_template('exito.html', order_id=order_id, job_id=request.args.get('job'))
+
+
+@app.route('/api/facturas/jobs/<job_id>')
+def api_factura_job(job_id):
+    """Estado de una solicitud de factura enviada en segundo plano (polling)"""
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return jsonify({'error': 'Job no encontrado'}), 404
+
+    try:
+        with db_cursor(RealDictCursor) as cursor:
+            cursor.execute(
+                "SELECT id, order_id, status, mensaje, created_at, finished_at FROM facturacion_jobs WHERE id = %s",
+                (job_id,)
+            )
+            job = cursor.fetchone()
+    except psycopg2.Error as e:
+        app.logger.error(f"Error consultando job {job_id}: {e}")
+        return jsonify({'error': 'Error de conexión'}), 503
+
+    if not job:
+        return jsonify({'error': 'Job no encontrado'}), 404
+
+    return jsonify({
+        'success': True,
+        'job_id': str(job['id']),
+        'order_id': job['order_id'],
+        'status': job['status'],
+        'mensaje': job['mensaje'],
+        'finalizado': job['finished_at'] is not None,
+        'created_at': job['created_at'].isoformat() if job['created_at'] else None,
+        'finished_at': job['finished_at'].isoformat() if job['finished_at'] else None
+    })
+
+
+# ============================================================================
+# FACTURACIÓN MASIVA (CSV)
+# ============================================================================
+
+# Motivo de rechazo de un renglón del CSV -> mensaje para el cliente
+MOTIVOS_FILA_MASIVA = {
+    'formato': 'Falta el ID del pedido o el monto no es un número',
+    'no_encontrado': 'No se encontró ningún pedido con ese ID',
+    'monto': 'El monto no coincide con el monto del pedido',
+    'duplicado': 'El pedido ya aparece en otro renglón del archivo',
+}
+
+
+def _parsear_monto(texto):
+    """'$1,234.50' -> 1234.5; None si no es un número"""
+    try:
+        monto = float(texto.replace('$', '').replace(',', '').strip())
+    except ValueError:
+        return None
+    return monto if math.isfinite(monto) else None
+
+
+def leer_csv_pedidos(archivo):
+    """
+    Lee el CSV de facturación masiva como stream, renglón por renglón.
+    Columnas: ID de pedido (order_id, pack_id o payment_id) y monto pagado;
+    el encabezado es opcional. Genera (número de renglón, search_id, monto)
+    con monto None si no es válido.
+
+    Lanza ValueError si el archivo no es UTF-8, no es un CSV válido o pasa
+    de MASIVA_MAX_FILAS renglones.
+    """
+    lector = csv.reader(codecs.iterdecode(archivo.stream, 'utf-8-sig'))
+    leidas = 0
+    try:
+        for numero, columnas in enumerate(lector, start=1):
+            columnas = [c.strip() for c in columnas]
+            if not any(columnas):
+                continue
+            search_id = columnas[0]
+            texto_monto = columnas[1] if len(columnas) > 1 else ''
+            monto = _parsear_monto(texto_monto)
+            if numero == 1 and monto is None and not any(c.isdigit() for c in texto_monto):
+                continue  # encabezado
+            leidas += 1
+            if leidas > Config.MASIVA_MAX_FILAS:
+                raise ValueError(f'El archivo tiene más de {Config.MASIVA_MAX_FILAS} pedidos.')
+            yield numero, search_id, monto
+    except UnicodeDecodeError:
+        raise ValueError('El CSV debe estar guardado en UTF-8.')
+    except csv.Error as e:
+        raise ValueError(f'El CSV no es válido (renglón {lector.line_num}): {e}')
+
+
+def validar_filas_masiva(renglones, datos, csf, nombre_csf):
+    """
+    Valida los renglones del CSV en bloques de MASIVA_LOTE_VALIDACION: cada
+    bloque se resuelve con una sola consulta (buscar_pedidos) y se compara
+    el monto con la misma tolerancia que el formulario individual.
+
+    Regresa una fila por renglón: los válidos traen 'payload' para n8n,
+    los demás 'motivo' (ver MOTIVOS_FILA_MASIVA).
+    """
+    filas = []
+    ordenes = set()
+    renglones = iter(renglones)
+
+    while True:
+        bloque = list(islice(renglones, Config.MASIVA_LOTE_VALIDACION))
+        if not bloque:
+            return filas
+
+        pedidos = buscar_pedidos({search_id for _, search_id, _ in bloque if search_id})
+        for numero, search_id, monto in bloque:
+            fila = {'fila': numero, 'id': search_id, 'monto': monto}
+            order = pedidos.get(search_id)
+            if order:
+                fila['order_id'] = order['order_id']
+
+            if not search_id or monto is None:
+                fila['motivo'] = 'formato'
+            elif order is None:
+                fila['motivo'] = 'no_encontrado'
+            elif abs(monto - order['paid_amount']) > 0.01:
+                fila['motivo'] = 'monto'
+            elif order['order_id'] in ordenes:
+                fila['motivo'] = 'duplicado'
+            else:
+                ordenes.add(order['order_id'])
+                fila['payload'] = construir_payload_factura(
+                    order, {**datos, 'monto_pagado': monto}, csf,
+                    secure_filename(f"{order['order_id']}_{nombre_csf}")
+                )
+            filas.append(fila)
+
+
+@app.route('/facturacion-masiva')
+def facturacion_masiva():
+    """Formulario de facturación masiva: una CSF y un CSV de pedidos"""
+    return render_template(
+        'facturacion_masiva.html',
+        max_filas=Config.MASIVA_MAX_FILAS,
+        cfdi_options=Config.CFDI_USAGE_OPTIONS,
+        payment_methods=Config.PAYMENT_METHOD_OPTIONS
+    )
+
+
+@app.route('/facturacion-masiva', methods=['POST'])
+def facturacion_masiva_post():
+    """
+    Factura varios pedidos con una sola CSF: valida el CSV contra orden_ml
+    en bloques, crea un job por pedido válido (todos apuntan a la misma
+    CSF en csf_documentos) y muestra el avance por renglón.
+    """
+    def rechazar(motivo, mensaje, **extra):
+        logger.warning(f"❌ Facturación masiva rechazada ({motivo})",
+                       extra={'evento': 'lote.rechazado', 'motivo': motivo, **extra})
+        flash(mensaje, 'error')
+        return redirect(url_for('facturacion_masiva'))
+
+    archivo_csf = request.files.get('csf_file')
+    archivo_csv = request.files.get('csv_file')
+    if not archivo_csf or archivo_csf.filename == '' or not archivo_csv or archivo_csv.filename == '':
+        return rechazar('sin_archivo', 'Debes adjuntar la Constancia de Situación Fiscal (PDF) y el CSV de pedidos.')
+
+    if not archivo_csf.filename.lower().endswith('.pdf'):
+        return rechazar('extension', 'La constancia debe ser un PDF.', archivo=archivo_csf.filename)
+    if not archivo_csv.filename.lower().endswith('.csv'):
+        return rechazar('extension', 'La lista de pedidos debe ser un archivo CSV.', archivo=archivo_csv.filename)
+
+    datos = {
+        'cfdi_usage': request.form.get('cfdi_usage', '').strip(),
+        'payment_method': request.form.get('payment_method', '').strip(),
+        'email': request.form.get('email', '').strip(),
+        'phone': request.form.get('phone', '').strip(),
+    }
+    if not all([datos['cfdi_usage'], datos['payment_method'], datos['email']]):
+        return rechazar('campos', 'Todos los campos obligatorios deben ser completados.')
+    if not validate_email(datos['email']):
+        return rechazar('email', 'El formato del correo electrónico no es válido.')
+
+    csf = leer_csf(archivo_csf)
+    if not csf:
+        return rechazar('mime', 'El archivo no es un PDF válido.', archivo=archivo_csf.filename)
+
+    lote_id = str(uuid.uuid4())
+    try:
+        with csf['stream'] as stream:
+            filas = validar_filas_masiva(leer_csv_pedidos(archivo_csv), datos, csf, archivo_csf.filename)
+            if not filas:
+                return rechazar('csv_vacio', 'El CSV no contiene pedidos.')
+            documento = {'mime_type': 'application/pdf', 'size': csf['size'], 'sha256': csf['sha256']}
+            with medir_etapa('outbox'):
+                filas = encolar_lote_n8n(lote_id, datos['email'], documento, stream, filas)
+    except ValueError as e:
+        return rechazar('csv', str(e))
+    except psycopg2.Error as e:
+        logger.error(f"❌ No se pudo registrar el lote {lote_id}: {e}", extra={'evento': 'lote.error', 'lote_id': lote_id})
+        flash('No se pudo registrar la solicitud. Intenta nuevamente.', 'error')
+        return redirect(url_for('facturacion_masiva'))
+
+    con_job = [f for f in filas if 'job_id' in f]
+    logger.info(f"📦 Lote {lote_id} registrado - {len(con_job)}/{len(filas)} pedidos",
+                extra={'evento': 'lote.encolado', 'lote_id': lote_id, 'filas': len(filas),
+                       'jobs': sum(1 for f in con_job if 'existente' not in f),
+                       'existentes': sum(1 for f in con_job if 'existente' in f),
+                       'rechazadas': len(filas) - len(con_job), 'csf_size': csf['size']})
+
+    return redirect(url_for('facturacion_lote', lote_id=lote_id))
+
+
+def estado_lote(lote_id):
+    """
+    Avance de un lote en una consulta: cada renglón del CSV con el estado
+    de su job. Regresa None si el lote no existe.
+    """
+    with db_cursor(RealDictCursor) as cursor:
+        cursor.execute(
+            """
+            SELECT l.total, l.created_at, f.fila, f.id, f.order_id, f.motivo, f.job_id,
+                   j.status, j.mensaje, j.finished_at
+            FROM facturacion_lotes l
+            CROSS JOIN LATERAL jsonb_to_recordset(l.filas)
+                AS f(fila INTEGER, id TEXT, order_id TEXT, motivo TEXT, job_id UUID)
+            LEFT JOIN facturacion_jobs j ON j.id = f.job_id
+            WHERE l.id = %s
+            ORDER BY f.fila
+            """,
+            (lote_id,)
+        )
+        renglones = cursor.fetchall()
+
+    if not renglones:
+        return None
+
+    filas = []
+    resumen = {'rechazadas': 0, 'en_proceso': 0, 'completadas': 0, 'con_error': 0}
+    for r in renglones:
+        if r['motivo']:
+            status, mensaje = 'invalida', MOTIVOS_FILA_MASIVA.get(r['motivo'], r['motivo'])
+            resumen['rechazadas'] += 1
+        else:
+            status, mensaje = r['status'], r['mensaje']
+            if r['finished_at'] is None:
+                resumen['en_proceso'] += 1
+            elif status == 'completado':
+                resumen['completadas'] += 1
+            else:
+                resumen['con_error'] += 1
+        filas.append({
+            'fila': r['fila'],
+            'id': r['id'],
+            'order_id': r['order_id'],
+            'job_id': str(r['job_id']) if r['job_id'] else None,
+            'status': status,
+            'mensaje': mensaje,
+        })
+
+    return {
+        'lote_id': lote_id,
+        'total': renglones[0]['total'],
+        'created_at': renglones[0]['created_at'].isoformat() if renglones[0]['created_at'] else None,
+        'resumen': resumen,
+        'finalizado': resumen['en_proceso'] == 0,
+        'filas': filas,
+    }
+
+
+@app.route('/facturacion-masiva/<lote_id>')
+def facturacion_lote(lote_id):
+    """Avance de un lote de facturación masiva (se actualiza solo)"""
+    try:
+        uuid.UUID(lote_id)
+        lote = estado_lote(lote_id)
+    except ValueError:
+        lote = None
+    except psycopg2.Error as e:
+        app.logger.error(f"Error consultando lote {lote_id}: {e}")
+        return render_template('error.html', message='Error de conexión. Intenta nuevamente.'), 503
+
+    if not lote:
+        return render_template('error.html', message='Lote no encontrado'), 404
+
+    return render_template('facturacion_lote.html', lote=lote, motivos=MOTIVOS_FILA_MASIVA)
+
+
+@app.route('/api/facturas/lotes/<lote_id>')
+def api_factura_lote(lote_id):
+    """Estado por renglón de un lote de facturación masiva (polling)"""
+    try:
+        uuid.UUID(lote_id)
+    except ValueError:
+        return jsonify({'error': 'Lote no encontrado'}), 404
+
+    try:
+        lote = estado_lote(lote_id)
+    except psycopg2.Error as e:
+        app.logger.error(f"Error consultando lote {lote_id}: {e}")
+        return jsonify({'error': 'Error de conexión'}), 503
+
+    if not lote:
+        return jsonify({'error': 'Lote no encontrado'}), 404
+
+    return jsonify({'success': True, **lote})
+
+
+# ============================================================================
+# DOCUMENTOS RECIBIDOS DE N8N (PDF/XML TIMBRADOS)
+# ============================================================================
+
+DOCUMENTOS_CHUNK_SIZE = 64 * 1024
+DOCUMENTOS_VALOR_MAX = 64 * 1024  # campos que no son documento (order_id, filename...)
+
+# Campo base64 del JSON -> (columna de facturas, extensión)
+CAMPOS_DOCUMENTO = {
+    'pdf_content': ('pdf_url', 'pdf'),
+    'xml_content': ('xml_url', 'xml'),
+}
+
+_RE_FIN_CADENA = re.compile(rb'["\\]')
+_ESPACIOS_JSON = b' \t\r\n'
+
+
+class DocumentoTemporal:
+    """
+    Documento que llega en base64 dentro del JSON: se decodifica por bloques
+    directo a un archivo temporal en DOCUMENTOS_FOLDER mientras se calcula
+    su SHA-256. guardar() lo mueve a su ruta definitiva.
+    """
+
+    def __init__(self, campo):
+        self.campo = campo
+        self.columna, self.extension = CAMPOS_DOCUMENTO[campo]
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self._pendiente = b''
+        self._inicio = b''
+        directorio = os.path.join(Config.DOCUMENTOS_FOLDER, 'tmp')
+        os.makedirs(directorio, exist_ok=True)
+        self._archivo = tempfile.NamedTemporaryFile(dir=directorio, suffix='.part', delete=False)
+        self.ruta_temporal = self._archivo.name
+
+    def escribir_base64(self, segmento):
+        """Decodifica los grupos completos de 4 caracteres; el resto espera al siguiente segmento"""
+        datos = self._pendiente + segmento.translate(None, _ESPACIOS_JSON)
+        corte = len(datos) - len(datos) % 4
+        self._pendiente = datos[corte:]
+        if corte:
+            try:
+                bloque = base64.b64decode(datos[:corte], validate=True)
+            except binascii.Error:
+                raise ValueError(f'{self.campo}: base64 inválido')
+            self._escribir(bloque)
+
+    def _escribir(self, bloque):
+        if len(self._inicio) < 2048:
+            self._inicio += bloque[:2048 - len(self._inicio)]
+        self.sha256.update(bloque)
+        self.size += len(bloque)
+        self._archivo.write(bloque)
+
+    def cerrar(self):
+        """Termina la decodificación y valida el contenido (ValueError si no es válido)"""
+        if self._pendiente:
+            raise ValueError(f'{self.campo}: base64 incompleto')
+        self._archivo.flush()
+        os.fsync(self._archivo.fileno())
+        self._archivo.close()
+
+        if self.size == 0:
+            raise ValueError(f'{self.campo} vacío')
+        if self.extension == 'pdf' and not validate_pdf_file(self._inicio):
+            raise ValueError(f'{self.campo} no es un PDF válido')
+        if self.extension == 'xml' and not self._inicio.lstrip(b'\xef\xbb\xbf' + _ESPACIOS_JSON).startswith(b'<'):
+            raise ValueError(f'{self.campo} no es un XML válido')
+
+    def guardar(self):
+        """
+        Mueve el archivo a DOCUMENTOS_FOLDER/ab/cd/<sha256>.<ext> con un
+        rename atómico. Si ese contenido ya existía se descarta el temporal.
+        Regresa (ruta, duplicado).
+        """
+        digest = self.sha256.hexdigest()
+        directorio = os.path.join(Config.DOCUMENTOS_FOLDER, digest[:2], digest[2:4])
+        os.makedirs(directorio, exist_ok=True)
+        ruta = os.path.join(directorio, f'{digest}.{self.extension}')
+
+        if os.path.exists(ruta):
+            self.descartar()
+            return ruta, True
+        os.replace(self.ruta_temporal, ruta)
+        return ruta, False
+
+    def descartar(self):
+        if not self._archivo.closed:
+            self._archivo.close()
+        try:
+            os.unlink(self.ruta_temporal)
+        except FileNotFoundError:
+            pass
+
+
+class LectorDocumentosN8N:
+    """
+    Lee en streaming el cuerpo JSON de /webhook/enviar-pdf: un objeto o una
+    lista de objetos planos. Los campos de CAMPOS_DOCUMENTO se decodifican
+    a disco con DocumentoTemporal; el resto de los valores (pequeños) se
+    leen con json.
+
+    La memoria usada no depende del tamaño de los documentos.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = b''
+        self._pos = 0
+        self._fin = False
+
+    # --- buffer -------------------------------------------------------------
+
+    def _llenar(self):
+        if self._fin:
+            return False
+        bloque = self._stream.read(DOCUMENTOS_CHUNK_SIZE)
+        if not bloque:
+            self._fin = True
+            return False
+        self._buffer = self._buffer[self._pos:] + bloque
+        self._pos = 0
+        return True
+
+    def _ver(self):
+        """Siguiente carácter significativo (sin espacios) o b'' al final"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _ESPACIOS_JSON:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos:self._pos + 1]
+            if not self._llenar():
+                return b''
+
+    def _esperar(self, caracteres):
+        c = self._ver()
+        if not c or c not in caracteres:
+            raise ValueError(f'JSON inválido: se esperaba {caracteres.decode()}')
+        self._pos += 1
+        return c
+
+    # --- valores ------------------------------------------------------------
+
+    def _valor(self):
+        """Valor JSON pequeño (cadena, número, etc.) a partir de la posición actual"""
+        self._ver()
+        decoder = json.JSONDecoder()
+        while True:
+            pendiente = self._buffer[self._pos:]
+            try:
+                texto = pendiente.decode('utf-8')
+            except UnicodeDecodeError as e:
+                # Un carácter multibyte partido al final del bloque
+                texto = pendiente[:e.start].decode('utf-8')
+            try:
+                valor, fin = decoder.raw_decode(texto)
+                # Un número al final del buffer puede continuar en el siguiente bloque
+                if fin < len(texto) or self._fin:
+                    self._pos += len(texto[:fin].encode('utf-8'))
+                    return valor
+            except json.JSONDecodeError:
+                if self._fin:
+                    raise ValueError('JSON inválido')
+            if len(pendiente) > DOCUMENTOS_VALOR_MAX:
+                raise ValueError('Valor demasiado grande')
+            self._llenar()
+
+    def _documento(self, campo):
+        """Cadena base64 del campo `campo` decodificada a un DocumentoTemporal"""
+        self._esperar(b'"')
+        documento = DocumentoTemporal(campo)
+        try:
+            while True:
+                encontrado = _RE_FIN_CADENA.search(self._buffer, self._pos)
+                if not encontrado:
+                    documento.escribir_base64(self._buffer[self._pos:])
+                    self._pos = len(self._buffer)
+                    if not self._llenar():
+                        raise ValueError(f'{campo}: cadena sin terminar')
+                    continue
+
+                documento.escribir_base64(self._buffer[self._pos:encontrado.start()])
+                self._pos = encontrado.end()
+                if encontrado.group() == b'"':
+                    break
+
+                # Escape JSON: n8n puede escapar '/' o partir el base64 en líneas
+                if self._pos >= len(self._buffer) and not self._llenar():
+                    raise ValueError(f'{campo}: cadena sin terminar')
+                escape = self._buffer[self._pos:self._pos + 1]
+                self._pos += 1
+                if escape == b'/':
+                    documento.escribir_base64(b'/')
+                elif escape not in (b'n', b'r', b't'):
+                    raise ValueError(f'{campo}: carácter inválido en base64')
+
+            documento.cerrar()
+            return documento
+        except Exception:
+            documento.descartar()
+            raise
+
+    def _objeto(self):
+        self._esperar(b'{')
+        datos, documentos = {}, []
+        try:
+            if self._ver() == b'}':
+                self._pos += 1
+                return datos, documentos
+            while True:
+                if self._ver() != b'"':
+                    raise ValueError('JSON inválido: se esperaba una clave')
+                clave = self._valor()
+                self._esperar(b':')
+                if clave in CAMPOS_DOCUMENTO and self._ver() == b'"':
+                    documentos.append(self._documento(clave))
+                else:
+                    datos[clave] = self._valor()
+                if self._esperar(b',}') == b'}':
+                    return datos, documentos
+        except Exception:
+            for documento in documentos:
+                documento.descartar()
+            raise
+
+    def objetos(self):
+        """Genera (datos, documentos) por cada objeto del cuerpo"""
+        if self._ver() == b'[':
+            self._pos += 1
+            if self._ver() == b']':
+                self._pos += 1
+            else:
+                while True:
+                    yield self._objeto()
+                    if self._esperar(b',]') == b']':
+                        break
+        else:
+            yield self._objeto()
+
+        if self._ver():
+            raise ValueError('JSON inválido: datos después del cuerpo')
+
+
+def vincular_documentos_factura(vinculos):
+    """
+    Guarda las rutas en facturas.pdf_url/xml_url con un UPDATE por lote.
+    vinculos: lista de (order_id, pdf_url, xml_url); None deja la columna igual.
+    Regresa los order_id actualizados.
+    """
+    if not vinculos:
+        return set()
+
+    with db_cursor() as cursor:
+        filas = execute_values(
+            cursor,
+            """
+            UPDATE facturas f
+            SET pdf_url = COALESCE(v.pdf_url, f.pdf_url),
+                xml_url = COALESCE(v.xml_url, f.xml_url),
+                updated_at = NOW(),
+                updated_by = 'n8n'
+            FROM (VALUES %s) AS v(order_id, pdf_url, xml_url)
+            WHERE f.order_id = v.order_id
+            RETURNING f.order_id
+            """,
+            vinculos,
+            template='(%s, %s::text, %s::text)',
+            fetch=True
+        )
+        cursor.connection.commit()
+    return {fila[0] for fila in filas}
 
 
 # ============================================================================
 # ENDPOINTS - CALLBACKS DESDE N8N
 # ============================================================================
 
+# Estado reportado por n8n -> facturas.status (None: solo queda en el historial)
+ESTADOS_FACTURA_N8N = {
+    'success': 'created',
+    'timbrada': 'created',
+    'enviada': 'sent',
+    'pagada': 'paid',
+    'cancelada': 'cancelled',
+    'error': 'error',
+}
+
+
+def _parsear_timestamp_n8n(valor):
+    """ISO 8601 de n8n a datetime local sin zona; None si falta o no es válido"""
+    if not valor:
+        return None
+    try:
+        fecha = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone().replace(tzinfo=None)
+    return fecha
+
+
+def leer_estados_webhook(data, campo_estado, campo_detalles, origen):
+    """
+    Normaliza el cuerpo de un webhook de estado: un objeto o una lista de
+    objetos con order_id. Regresa la lista de tuplas para facturacion_estados.
+    Lanza ValueError si el lote no es válido.
+    """
+    elementos = data if isinstance(data, list) else [data]
+    if not elementos:
+        raise ValueError('Lote vacío')
+    if len(elementos) > Config.WEBHOOK_ESTADOS_MAX_LOTE:
+        raise ValueError(f'Máximo {Config.WEBHOOK_ESTADOS_MAX_LOTE} estados por petición')
+
+    estados = []
+    for item in elementos:
+        if not isinstance(item, dict) or not item.get('order_id'):
+            raise ValueError('Datos inválidos')
+        estado = str(item.get(campo_estado) or 'unknown')[:50]
+        detalles = item.get(campo_detalles)
+        estados.append((
+            str(item['order_id'])[:50],
+            estado,
+            str(detalles) if detalles not in (None, '') else None,
+            origen,
+            ESTADOS_FACTURA_N8N.get(estado.lower()),
+            _parsear_timestamp_n8n(item.get('timestamp')),
+        ))
+    return estados
+
+
+def registrar_estados_factura(estados):
+    """
+    Guarda un lote de estados en facturacion_estados y aplica el último
+    estado mapeado de cada orden a facturas.status, todo en una transacción.
+    Los triggers de la tabla publican los eventos del portal (SSE) al confirmar.
+
+    Regresa el número de facturas cuyo status cambió.
+    """
+    # Si una orden viene varias veces en el lote, manda el último estado
+    ultimo_status = {}
+    for order_id, _, _, _, status_factura, _ in estados:
+        if status_factura:
+            ultimo_status[order_id] = status_factura
+
+    with db_cursor() as cursor:
+        execute_values(
+            cursor,
+            """
+            INSERT INTO facturacion_estados
+            (order_id, estado, detalles, origen, status_factura, reportado_at)
+            VALUES %s
+            """,
+            estados,
+            page_size=Config.WEBHOOK_ESTADOS_MAX_LOTE
+        )
+
+        actualizadas = 0
+        if ultimo_status:
+            # Un success/timbrada tardío no regresa a 'created' una factura
+            # que ya se envió, pagó o canceló
+            execute_values(
+                cursor,
+                """
+                UPDATE facturas f
+                SET status = v.status, updated_at = NOW(), updated_by = 'n8n'
+                FROM (VALUES %s) AS v(order_id, status)
+                WHERE f.order_id = v.order_id
+                  AND f.status IS DISTINCT FROM v.status
+                  AND NOT (v.status = 'created' AND f.status IN ('sent', 'paid', 'cancelled'))
+                """,
+                list(ultimo_status.items()),
+                page_size=Config.WEBHOOK_ESTADOS_MAX_LOTE
+            )
+            actualizadas = cursor.rowcount
+
+        cursor.connection.commit()
+    return actualizadas
+
+
+def obtener_historial_estados(cursor, order_id, limite=100):
+    """Línea de tiempo de una orden, de la más antigua a la más reciente"""
+    cursor.execute(
+        """
+        SELECT estado, detalles, origen, status_factura, reportado_at, created_at
+        FROM (
+            SELECT *
+            FROM facturacion_estados
+            WHERE order_id = %s
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        ) recientes
+        ORDER BY created_at, id
+        """,
+        (order_id, limite)
+    )
+    return cursor.fetchall()
+
+
 @app.route('/webhook/factura-procesada', methods=['POST'])
 def webhook_factura_procesada():
     """
     n8n llama este endpoint cuando termina de procesar
     Útil para notificaciones en tiempo real, actualizar UI, etc.
 
-    Payload de n8n:
+    Payload de n8n (un objeto o una lista de objetos):
     {
         "order_id": "123456",
         "status": "success|error",
@@ -514,28 +2816,31 @@ def webhook_factura_procesada():
     }
     """
     try:
-        data = request.get_json()
-
-        if not data or 'order_id' not in data:
+        data = request.get_json(silent=True)
+        if not data:
             return jsonify({'error': 'Datos inválidos'}), 400
 
-        order_id = data['order_id']
-        status = data.get('status')
+        try:
+            estados = leer_estados_webhook(data, 'status', 'message', 'factura-procesada')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        # Loguear para tracking
-        app.logger.info(f"Webhook n8n - Order {order_id}: {status}")
+        actualizadas = registrar_estados_factura(estados)
 
-        # Aquí podrías:
-        # - Guardar en una tabla de logs
-        # - Enviar notificación WebSocket al cliente
-        # - Actualizar caché
-        # - etc.
+        # Loguear para tracking
+        for order_id, status, _, _, _, _ in estados:
+            app.logger.info(f"Webhook n8n - Order {order_id}: {status}")
 
         return jsonify({
             'success': True,
-            'message': 'Webhook recibido'
+            'message': 'Webhook recibido',
+            'registrados': len(estados),
+            'facturas_actualizadas': actualizadas
         }), 200
 
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Error de conexión'}), 503
+
     except Exception as e:
         app.logger.error(f"Error en webhook: {e}")
         return jsonify({'error': str(e)}), 500
@@ -544,41 +2849,87 @@ def webhook_factura_procesada():
 @app.route('/webhook/enviar-pdf', methods=['POST'])
 def webhook_enviar_pdf():
     """
-    n8n puede enviar PDFs generados (facturas timbradas, etc.)
+    n8n envía los documentos timbrados (PDF y/o XML) de una o varias órdenes.
 
-    Payload de n8n:
+    Payload de n8n (un objeto o una lista de objetos):
     {
         "order_id": "123456",
         "pdf_content": "base64...",
+        "xml_content": "base64...",  // opcional
         "filename": "factura.pdf",
         "type": "factura|complemento"
     }
+
+    El cuerpo se lee en streaming: el base64 se decodifica a disco por
+    bloques sin cargar el documento en memoria. Cada archivo se guarda por
+    contenido en DOCUMENTOS_FOLDER/ab/cd/<sha256>.<ext> (el mismo contenido
+    se guarda una sola vez) y los de tipo factura quedan en
+    facturas.pdf_url / xml_url.
     """
-    try:
-        data = request.get_json()
+    documentos_respuesta = []
+    vinculos = []
 
-        if not data or 'pdf_content' not in data:
+    try:
+        for datos, documentos in LectorDocumentosN8N(request.stream).objetos():
+            order_id = datos.get('order_id')
+            if not order_id or not documentos:
+                for documento in documentos:
+                    documento.descartar()
+                return jsonify({'error': 'Datos inválidos'}), 400
+
+            order_id = str(order_id)
+            tipo = datos.get('type') or 'factura'
+            rutas = {}
+            try:
+                for documento in documentos:
+                    ruta, duplicado = documento.guardar()
+                    rutas[documento.columna] = ruta
+                    documentos_respuesta.append({
+                        'order_id': order_id,
+                        'type': tipo,
+                        'campo': documento.campo,
+                        'sha256': documento.sha256.hexdigest(),
+                        'size': documento.size,
+                        'path': ruta,
+                        'duplicado': duplicado
+                    })
+            except Exception:
+                # Los que ya se movieron no tienen temporal; los demás se borran
+                for documento in documentos:
+                    documento.descartar()
+                raise
+
+            # Los complementos se guardan pero no reemplazan la factura
+            if tipo == 'factura':
+                vinculos.append((order_id, rutas.get('pdf_url'), rutas.get('xml_url')))
+
+            app.logger.info(f"Documento(s) recibido(s) de n8n para orden {order_id}: {', '.join(rutas.values())}")
+
+        if not documentos_respuesta:
             return jsonify({'error': 'Datos inválidos'}), 400
 
-        order_id = data.get('order_id')
-        pdf_base64 = data['pdf_content']
-        filename = data.get('filename', 'documento.pdf')
-
-        # Decodificar y guardar PDF
-        pdf_bytes = base64.b64decode(pdf_base64)
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], f"received_{filename}")
-
-        with open(save_path, 'wb') as f:
-            f.write(pdf_bytes)
+        vinculadas = vincular_documentos_factura(vinculos)
+        for documento in documentos_respuesta:
+            documento['vinculado'] = documento['type'] == 'factura' and documento['order_id'] in vinculadas
 
-        app.logger.info(f"PDF recibido de n8n: {filename} para orden {order_id}")
-
-        return jsonify({
+        respuesta = {
             'success': True,
-            'message': 'PDF recibido y guardado',
-            'path': save_path
-        }), 200
-
+            'message': 'Documento(s) recibido(s) y guardado(s)',
+            'documentos': documentos_respuesta,
+            'facturas_actualizadas': len(vinculadas)
+        }
+        if len(documentos_respuesta) == 1:
+            respuesta['path'] = documentos_respuesta[0]['path']
+        return jsonify(respuesta), 200
+
+    except ValueError as e:
+        app.logger.warning(f"Documento inválido desde n8n: {e}")
+        return jsonify({'error': str(e)}), 400
+    except HTTPException:
+        # 413 si el cuerpo supera MAX_CONTENT_LENGTH
+        raise
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Error de conexión'}), 503
     except Exception as e:
         app.logger.error(f"Error recibiendo PDF: {e}")
         return jsonify({'error': str(e)}), 500
@@ -589,34 +2940,42 @@ def webhook_actualizar_estado():
     """
     Endpoint genérico para que n8n notifique cambios de estado
 
-    Payload de n8n:
+    Payload de n8n (un objeto o una lista de objetos):
     {
         "order_id": "123456",
-        "estado": "procesando|timbrada|enviada|error",
+        "estado": "procesando|timbrada|enviada|pagada|cancelada|error",
         "detalles": "...",
         "timestamp": "2024-01-01T12:00:00"
     }
+
+    Cada estado queda en facturacion_estados; los que tienen equivalente en
+    ESTADOS_FACTURA_N8N actualizan facturas.status en la misma transacción.
     """
     try:
-        data = request.get_json()
-
-        if not data or 'order_id' not in data:
+        data = request.get_json(silent=True)
+        if not data:
             return jsonify({'error': 'Datos inválidos'}), 400
 
-        order_id = data['order_id']
-        estado = data.get('estado', 'unknown')
-        detalles = data.get('detalles', '')
+        try:
+            estados = leer_estados_webhook(data, 'estado', 'detalles', 'actualizar-estado')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        app.logger.info(f"Estado actualizado - Orden {order_id}: {estado} - {detalles}")
+        actualizadas = registrar_estados_factura(estados)
 
-        # Aquí podrías guardar en una tabla de estados:
-        # INSERT INTO facturacion_estados (order_id, estado, detalles) VALUES (...)
+        for order_id, estado, detalles, _, _, _ in estados:
+            app.logger.info(f"Estado actualizado - Orden {order_id}: {estado} - {detalles or ''}")
 
         return jsonify({
             'success': True,
-            'message': 'Estado actualizado'
+            'message': 'Estado actualizado',
+            'registrados': len(estados),
+            'facturas_actualizadas': actualizadas
         }), 200
 
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Error de conexión'}), 503
+
     except Exception as e:
         app.logger.error(f"Error actualizando estado: {e}")
         return jsonify({'error': str(e)}), 500
@@ -648,6 +3007,9 @@ def login_required(f):
     """Decorador para rutas que requieren autenticación"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        if getattr(session, 'no_disponible', False):
+            # La sesión existe pero no se pudo leer: no mandar a login a alguien que sí inició sesión
+            return render_template('error.html', message='Error de conexión. Intenta nuevamente.'), 503
         if 'usuario_id' not in session:
             flash('Debes iniciar sesión para acceder a esta página.', 'warning')
             return redirect(url_for('portal_login'))
@@ -655,20 +3017,152 @@ def login_required(f):
     return decorated_function
 
 
-def registrar_acceso(usuario_id, email, receiver_id, tipo_evento, exitoso=True, mensaje=''):
-    """Registra en historial_accesos"""
-    conn = get_db_connection()
-    if not conn:
-        return
+class AuditWriter:
+    """
+    Escritor en segundo plano para historial_accesos.
+
+    Los requests solo encolan el evento; un hilo del proceso lo inserta en
+    lotes (INSERT multi-fila) al juntar AUDIT_BATCH_SIZE eventos o cada
+    AUDIT_FLUSH_INTERVAL segundos. Así el login no espera la escritura de
+    auditoría. Si la cola se llena los eventos se descartan y se cuentan.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_cola):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+        self._encolados = 0
+        self._escritos = 0
+        self._descartados = 0  # cola llena
+        self._perdidos = 0  # lotes que no se pudieron escribir
+        self._lotes = 0
+        self._ultimo_flush_ms = None
+
+        self._hilo = threading.Thread(target=self._ejecutar, name='audit-writer', daemon=True)
+        self._hilo.start()
+
+    def registrar(self, evento):
+        """Encola una tupla con las columnas de historial_accesos. No bloquea."""
+        try:
+            self._cola.put_nowait(evento)
+        except queue.Full:
+            with self._lock:
+                self._descartados += 1
+                descartados = self._descartados
+            # Un aviso por cada 100 descartes para no inundar el log
+            if descartados % 100 == 1:
+                logger.warning(f"⚠️ Cola de auditoría llena; {descartados} evento(s) descartados")
+            return False
+
+        with self._lock:
+            self._encolados += 1
+        return True
+
+    def _siguiente_lote(self):
+        """Espera hasta juntar un lote completo o a que venza el intervalo"""
+        lote = []
+        limite = time.monotonic() + self.flush_interval
+        while len(lote) < self.batch_size:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self._cola.get(timeout=min(restante, 0.2)))
+            except queue.Empty:
+                if self._detener.is_set():
+                    break
+        return lote
+
+    def _ejecutar(self):
+        while not (self._detener.is_set() and self._cola.empty()):
+            lote = self._siguiente_lote()
+            if lote:
+                self._escribir(lote)
+
+    def _escribir(self, lote):
+        inicio = time.monotonic()
+        for intento in (1, 2):
+            try:
+                with db_cursor() as cursor:
+                    execute_values(
+                        cursor,
+                        """
+                        INSERT INTO historial_accesos
+                        (usuario_id, email, receiver_id, tipo_evento, ip_address, user_agent, exitoso, mensaje, created_at)
+                        VALUES %s
+                        """,
+                        lote,
+                        page_size=self.batch_size
+                    )
+                    cursor.connection.commit()
+                break
+            except Exception as e:
+                if intento == 2:
+                    logger.error(f"❌ No se pudieron registrar {len(lote)} acceso(s): {e}")
+                    with self._lock:
+                        self._perdidos += len(lote)
+                    return
+                time.sleep(self.flush_interval)
+
+        with self._lock:
+            self._escritos += len(lote)
+            self._lotes += 1
+            self._ultimo_flush_ms = round((time.monotonic() - inicio) * 1000, 1)
+
+    def cerrar(self, timeout=10):
+        """Escribe lo pendiente y detiene el hilo (al terminar el worker)"""
+        if self._pid != os.getpid():
+            return
+        self._detener.set()
+        self._hilo.join(timeout)
+        if self._hilo.is_alive():
+            logger.warning(f"⚠️ Auditoría: quedaron {self._cola.qsize()} evento(s) sin escribir al cerrar")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'encolados': self._encolados,
+                'escritos': self._escritos,
+                'descartados': self._descartados,
+                'perdidos': self._perdidos,
+                'pendientes': self._cola.qsize(),
+                'lotes': self._lotes,
+                'ultimo_flush_ms': self._ultimo_flush_ms,
+                'batch_size': self.batch_size,
+                'flush_interval': self.flush_interval,
+            }
+
+
+_audit_writer = None
+_audit_writer_lock = threading.Lock()
+
+
+def get_audit_writer():
+    """Escritor de auditoría del proceso actual (uno por worker de gunicorn)"""
+    global _audit_writer
 
+    if _audit_writer is not None and _audit_writer._pid == os.getpid():
+        return _audit_writer
+
+    with _audit_writer_lock:
+        if _audit_writer is None or _audit_writer._pid != os.getpid():
+            _audit_writer = AuditWriter(
+                batch_size=Config.AUDIT_BATCH_SIZE,
+                flush_interval=Config.AUDIT_FLUSH_INTERVAL,
+                max_cola=Config.AUDIT_QUEUE_MAX,
+            )
+            atexit.register(_audit_writer.cerrar)
+    return _audit_writer
+
+
+def registrar_acceso(usuario_id, email, receiver_id, tipo_evento, exitoso=True, mensaje=''):
+    """Registra en historial_accesos (en segundo plano, ver AuditWriter)"""
     try:
-        cursor = conn.cursor()
-        query = """
-            INSERT INTO historial_accesos
-            (usuario_id, email, receiver_id, tipo_evento, ip_address, user_agent, exitoso, mensaje)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        cursor.execute(query, (
+        get_audit_writer().registrar((
             usuario_id,
             email,
             receiver_id,
@@ -676,38 +3170,376 @@ def registrar_acceso(usuario_id, email, receiver_id, tipo_evento, exitoso=True,
             request.remote_addr,
             request.user_agent.string[:500] if request.user_agent else None,
             exitoso,
-            mensaje
+            mensaje,
+            datetime.now()  # hora del evento, no de la escritura del lote
         ))
-        conn.commit()
     except Exception as e:
         app.logger.error(f"Error registrando acceso: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
-def actualizar_ultimo_acceso(usuario_id):
-    """Actualiza el timestamp de último acceso"""
-    conn = get_db_connection()
-    if not conn:
-        return
+class LimitadorLogin:
+    """
+    Límite de intentos fallidos de login por IP y por email.
+
+    Ventana deslizante aproximada de LOGIN_VENTANA segundos: fallos de la
+    ventana actual más los de la anterior, ponderados por la parte de ella
+    que sigue dentro de la ventana.
+
+    - permitir() decide en memoria: una clave que llegó a su límite o está
+      bloqueada se rechaza sin tocar la BD.
+    - Los fallos se acumulan en memoria y un hilo del proceso los envía cada
+      LOGIN_SYNC_INTERVAL a la tabla UNLOGGED login_limites en un solo
+      INSERT ... ON CONFLICT, que devuelve los totales de todas las réplicas.
+    - La réplica que ve primero una clave por encima del límite la bloquea
+      en login_limites y, si es un email, escribe el bloqueo en
+      usuarios_portal (una sola vez por bloqueo).
+
+    Entre sincronizaciones cada réplica puede dejar pasar algunos intentos
+    de más; el bloqueo de la cuenta en usuarios_portal es exacto.
+    """
+
+    def __init__(self, ventana, max_por_ip, max_por_email, bloqueo, sync_interval, max_claves):
+        self.ventana = ventana
+        self.maximos = {'ip': max_por_ip, 'email': max_por_email}
+        self.bloqueo = bloqueo
+        self.sync_interval = sync_interval
+        self.max_claves = max_claves
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._pid = os.getpid()
+
+        self._claves = OrderedDict()  # clave -> {ventana, actual, anterior, bloqueado_hasta (epoch)}
+        self._pendientes = {}  # clave -> fallos aún no enviados a login_limites
+        self._reinicios = set()  # claves de email con login exitoso
+
+        self._stats = {
+            'permitidos': 0,
+            'rechazados': 0,
+            'fallos': 0,
+            'sincronizaciones': 0,
+            'bloqueos': 0,
+            'errores': 0,
+        }
+
+        self._hilo = threading.Thread(target=self._ejecutar, name='limitador-login', daemon=True)
+        self._hilo.start()
+
+    def _claves_de(self, ip, email):
+        return ((f'ip:{ip}', 'ip'), (f'email:{email}', 'email'))
+
+    def _estimar(self, estado, ahora):
+        ventana = int(ahora // self.ventana)
+        if estado['ventana'] == ventana:
+            actual, anterior = estado['actual'], estado['anterior']
+        elif estado['ventana'] == ventana - 1:
+            actual, anterior = 0, estado['actual']
+        else:
+            return 0.0
+        return anterior * (1 - (ahora % self.ventana) / self.ventana) + actual
+
+    def permitir(self, ip, email):
+        """(True, 0) o (False, segundos que faltan para volver a intentar). No toca la BD."""
+        ahora = time.time()
+        with self._lock:
+            for clave, tipo in self._claves_de(ip, email):
+                estado = self._claves.get(clave)
+                if estado is None:
+                    continue
+                if estado['bloqueado_hasta'] <= ahora and self._estimar(estado, ahora) >= self.maximos[tipo]:
+                    # Llegó al límite en esta réplica: se bloquea aquí sin esperar a la sincronización
+                    estado['bloqueado_hasta'] = ahora + self.bloqueo
+                    logger.warning(f"🚫 Login limitado ({clave})",
+                                   extra={'evento': 'login.limitado', 'clave': clave, 'bloqueo_s': self.bloqueo})
+                if estado['bloqueado_hasta'] > ahora:
+                    self._stats['rechazados'] += 1
+                    return False, estado['bloqueado_hasta'] - ahora
+            self._stats['permitidos'] += 1
+        return True, 0
+
+    def registrar_fallo(self, ip, email):
+        ahora = time.time()
+        ventana = int(ahora // self.ventana)
+        with self._lock:
+            self._stats['fallos'] += 1
+            for clave, _ in self._claves_de(ip, email):
+                estado = self._estado(clave, ventana)
+                estado['actual'] += 1
+                self._pendientes[clave] = self._pendientes.get(clave, 0) + 1
+
+    def registrar_exito(self, email):
+        """Login correcto: el email vuelve a empezar (autenticar_usuario ya limpió usuarios_portal)"""
+        clave = f'email:{email}'
+        with self._lock:
+            self._claves.pop(clave, None)
+            self._pendientes.pop(clave, None)
+            self._reinicios.add(clave)
+
+    def marcar_bloqueado(self, email, segundos):
+        """La BD reportó la cuenta bloqueada: los siguientes intentos se rechazan en memoria"""
+        with self._lock:
+            estado = self._estado(f'email:{email}', int(time.time() // self.ventana))
+            estado['bloqueado_hasta'] = max(estado['bloqueado_hasta'], time.time() + segundos)
+
+    def _estado(self, clave, ventana):
+        """Estado local de la clave con la ventana al día (llamar con el lock tomado)"""
+        estado = self._claves.get(clave)
+        if estado is None:
+            estado = {'ventana': ventana, 'actual': 0, 'anterior': 0, 'bloqueado_hasta': 0.0}
+            self._claves[clave] = estado
+            while len(self._claves) > self.max_claves:
+                self._claves.popitem(last=False)
+        elif estado['ventana'] != ventana:
+            estado['anterior'] = estado['actual'] if estado['ventana'] == ventana - 1 else 0
+            estado['actual'] = 0
+            estado['ventana'] = ventana
+        self._claves.move_to_end(clave)
+        return estado
+
+    def _ejecutar(self):
+        while not self._detener.wait(self.sync_interval):
+            self._sincronizar()
+
+    def _sincronizar(self):
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+            reinicios, self._reinicios = self._reinicios, set()
+        if not pendientes and not reinicios:
+            return
+
+        try:
+            with db_cursor(autocommit=True) as cursor:
+                if reinicios:
+                    cursor.execute("DELETE FROM login_limites WHERE clave = ANY(%s)", (list(reinicios),))
+
+                totales = []
+                if pendientes:
+                    totales = execute_values(
+                        cursor,
+                        """
+                        INSERT INTO login_limites AS l (clave, ventana, actual)
+                        SELECT v.clave, floor(extract(epoch FROM NOW()) / v.segundos)::bigint, v.fallos
+                        FROM (VALUES %s) AS v(clave, fallos, segundos)
+                        ON CONFLICT (clave) DO UPDATE
+                        SET anterior = CASE WHEN l.ventana = EXCLUDED.ventana THEN l.anterior
+                                            WHEN l.ventana = EXCLUDED.ventana - 1 THEN l.actual
+                                            ELSE 0 END,
+                            actual = CASE WHEN l.ventana = EXCLUDED.ventana THEN l.actual ELSE 0 END + EXCLUDED.actual,
+                            ventana = EXCLUDED.ventana,
+                            updated_at = NOW()
+                        RETURNING clave, ventana, actual, anterior,
+                                  GREATEST(EXTRACT(EPOCH FROM bloqueado_hasta - NOW()), 0)
+                        """,
+                        [(clave, fallos, self.ventana) for clave, fallos in pendientes.items()],
+                        fetch=True
+                    )
+
+                ahora = time.time()
+                por_bloquear = self._actualizar(totales, ahora)
+                if por_bloquear:
+                    self._bloquear(cursor, por_bloquear, ahora)
+        except psycopg2.Error as e:
+            logger.error(f"❌ No se pudo sincronizar login_limites: {e}", extra={'evento': 'login.limites_error'})
+            with self._lock:
+                self._stats['errores'] += 1
+                # Se reintentan en la siguiente vuelta
+                for clave, fallos in pendientes.items():
+                    self._pendientes[clave] = self._pendientes.get(clave, 0) + fallos
+                self._reinicios |= reinicios
+            return
+
+        with self._lock:
+            self._stats['sincronizaciones'] += 1
+
+    def _actualizar(self, totales, ahora):
+        """Reemplaza el estado local por el total de las réplicas; regresa las claves por bloquear"""
+        por_bloquear = []
+        with self._lock:
+            for clave, ventana, actual, anterior, restante in totales:
+                estado = self._estado(clave, ventana)
+                # Lo que se registró en esta réplica mientras corría la sincronización sigue pendiente
+                estado['actual'] = actual + self._pendientes.get(clave, 0)
+                estado['anterior'] = anterior
+                if restante:
+                    estado['bloqueado_hasta'] = ahora + float(restante)
+                elif self._estimar(estado, ahora) >= self.maximos[clave.split(':', 1)[0]]:
+                    por_bloquear.append(clave)
+        return por_bloquear
+
+    def _bloquear(self, cursor, claves, ahora):
+        """
+        Bloquea las claves en login_limites (solo la réplica que lo logra primero
+        sigue) y lleva el bloqueo de los emails a usuarios_portal.
+        """
+        cursor.execute(
+            """
+            WITH bloqueo AS (
+                UPDATE login_limites
+                SET bloqueado_hasta = NOW() + make_interval(secs => %s)
+                WHERE clave = ANY(%s)
+                  AND (bloqueado_hasta IS NULL OR bloqueado_hasta <= NOW())
+                RETURNING clave, actual + anterior AS intentos, bloqueado_hasta
+            ),
+            cuentas AS (
+                UPDATE usuarios_portal u
+                SET intentos_fallidos = b.intentos,
+                    bloqueado_hasta = b.bloqueado_hasta
+                FROM bloqueo b
+                WHERE b.clave LIKE 'email:%%'
+                  AND u.email = substr(b.clave, 7)
+                RETURNING u.id
+            )
+            SELECT b.clave, b.intentos, (SELECT COUNT(*) FROM cuentas) FROM bloqueo b
+            """,
+            (self.bloqueo, claves)
+        )
+        bloqueadas = cursor.fetchall()
+
+        with self._lock:
+            # Las que ya bloqueó otra réplica se bloquean igual en memoria
+            for clave in claves:
+                if clave in self._claves:
+                    self._claves[clave]['bloqueado_hasta'] = ahora + self.bloqueo
+            self._stats['bloqueos'] += len(bloqueadas)
+
+        for clave, intentos, cuentas in bloqueadas:
+            logger.warning(f"🔒 Bloqueo por intentos de login ({clave})", extra={
+                'evento': 'login.bloqueo', 'clave': clave, 'intentos': intentos, 'bloqueo_s': self.bloqueo,
+                'cuenta_bloqueada': bool(cuentas) and clave.startswith('email:'),
+            })
+
+    def cerrar(self, timeout=5):
+        """Envía los fallos pendientes y detiene el hilo (al terminar el worker)"""
+        if self._pid != os.getpid():
+            return
+        self._detener.set()
+        self._hilo.join(timeout)
+        self._sincronizar()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['claves'] = len(self._claves)
+            stats['pendientes'] = len(self._pendientes)
+        return stats
+
+
+_limitador_login = None
+_limitador_login_lock = threading.Lock()
+
+
+def get_limitador_login():
+    """Limitador de intentos de login del proceso actual (uno por worker de gunicorn)"""
+    global _limitador_login
+
+    if _limitador_login is not None and _limitador_login._pid == os.getpid():
+        return _limitador_login
+
+    with _limitador_login_lock:
+        if _limitador_login is None or _limitador_login._pid != os.getpid():
+            _limitador_login = LimitadorLogin(
+                ventana=Config.LOGIN_VENTANA,
+                max_por_ip=Config.LOGIN_MAX_POR_IP,
+                max_por_email=Config.LOGIN_MAX_POR_EMAIL,
+                bloqueo=Config.LOGIN_BLOQUEO,
+                sync_interval=Config.LOGIN_SYNC_INTERVAL,
+                max_claves=Config.LOGIN_MAX_CLAVES,
+            )
+            atexit.register(_limitador_login.cerrar)
+    return _limitador_login
+
+
+def purgar_limites_login():
+    """Borra de login_limites las claves sin actividad en dos ventanas y sin bloqueo vigente"""
+    with db_cursor(autocommit=True) as cursor:
+        cursor.execute(
+            """
+            DELETE FROM login_limites
+            WHERE updated_at < NOW() - make_interval(secs => %s)
+              AND (bloqueado_hasta IS NULL OR bloqueado_hasta < NOW())
+            """,
+            (2 * Config.LOGIN_VENTANA,)
+        )
+        return cursor.rowcount
+
 
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE usuarios_portal SET ultimo_acceso = NOW() WHERE id = %s",
-            (usuario_id,)
+def autenticar_usuario(cursor, email, receiver_id, ip_address, user_agent):
+    """
+    Resuelve un intento de login en una sola sentencia.
+
+    El UPDATE ... RETURNING solo toca al usuario si existe, está activo y no
+    está bloqueado (la condición se vuelve a evaluar sobre la fila bloqueada,
+    así un bloqueo concurrente se respeta); en ese caso resetea los intentos
+    fallidos y registra ultimo_acceso. En la misma sentencia se inserta el
+    evento en historial_accesos. Con el cursor en autocommit es un único
+    round trip.
+
+    Retorna un dict con 'resultado' (exitoso, no_encontrado, bloqueado,
+    inactivo) y los datos del usuario. 'bloqueado' siempre trae
+    bloqueado_hasta en el futuro; si la fila cambió entre la lectura y el
+    UPDATE (bloqueo o baja concurrente) el resultado es 'reintentar'.
+    """
+    cursor.execute(
+        """
+        WITH candidato AS (
+            SELECT id, activo, bloqueado_hasta
+            FROM usuarios_portal
+            WHERE email = %(email)s AND receiver_id = %(receiver_id)s
+        ),
+        acceso AS (
+            UPDATE usuarios_portal u
+            SET intentos_fallidos = 0,
+                bloqueado_hasta = NULL,
+                ultimo_acceso = NOW()
+            WHERE u.email = %(email)s AND u.receiver_id = %(receiver_id)s
+              AND u.activo
+              AND (u.bloqueado_hasta IS NULL OR u.bloqueado_hasta <= NOW())
+            RETURNING u.id, u.receiver_id, u.email, u.nombre
+        ),
+        resultado AS (
+            SELECT
+                COALESCE(a.id, c.id) AS id,
+                a.receiver_id,
+                a.email,
+                a.nombre,
+                c.bloqueado_hasta,
+                CASE
+                    WHEN a.id IS NOT NULL THEN 'exitoso'
+                    WHEN c.id IS NULL THEN 'no_encontrado'
+                    WHEN c.activo IS NOT TRUE THEN 'inactivo'
+                    WHEN c.bloqueado_hasta > NOW() THEN 'bloqueado'
+                    ELSE 'reintentar'
+                END AS resultado
+            FROM (SELECT 1) AS intento
+            LEFT JOIN candidato c ON TRUE
+            LEFT JOIN acceso a ON TRUE
+        ),
+        auditoria AS (
+            INSERT INTO historial_accesos
+            (usuario_id, email, receiver_id, tipo_evento, ip_address, user_agent, exitoso, mensaje)
+            SELECT
+                r.id, %(email)s, %(receiver_id)s,
+                CASE WHEN r.resultado = 'exitoso' THEN 'login_exitoso' ELSE 'login_fallido' END,
+                %(ip_address)s, %(user_agent)s,
+                r.resultado = 'exitoso',
+                CASE r.resultado
+                    WHEN 'exitoso' THEN 'Login exitoso'
+                    WHEN 'no_encontrado' THEN 'Credenciales incorrectas'
+                    WHEN 'inactivo' THEN 'Cuenta inactiva'
+                    WHEN 'bloqueado' THEN 'Cuenta bloqueada'
+                    ELSE 'Cuenta modificada durante el login'
+                END
+            FROM resultado r
         )
-        conn.commit()
-    except Exception as e:
-        app.logger.error(f"Error actualizando último acceso: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+        SELECT id, receiver_id, email, nombre, bloqueado_hasta, resultado FROM resultado
+        """,
+        {
+            'email': email,
+            'receiver_id': receiver_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+        }
+    )
+    return cursor.fetchone()
 
 
 # ============================================================================
@@ -733,69 +3565,66 @@ def portal_login_post():
         flash('Por favor ingresa tu email y número de cliente.', 'error')
         return redirect(url_for('portal_login'))
 
-    conn = get_db_connection()
-    if not conn:
-        flash('Error de conexión. Intenta nuevamente.', 'error')
+    # IP o email por encima del límite: se rechaza sin tocar la BD ni auditar
+    limitador = get_limitador_login()
+    permitido, espera = limitador.permitir(request.remote_addr, email)
+    if not permitido:
+        flash(f'Demasiados intentos. Intenta en {max(1, round(espera / 60))} minutos.', 'error')
         return redirect(url_for('portal_login'))
 
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        # Buscar usuario
-        query = """
-            SELECT id, receiver_id, email, nombre, activo, bloqueado_hasta, intentos_fallidos
-            FROM usuarios_portal
-            WHERE email = %s AND receiver_id = %s
-        """
-        cursor.execute(query, (email, receiver_id))
-        usuario = cursor.fetchone()
-
-        if not usuario:
-            registrar_acceso(None, email, receiver_id, 'login_fallido', False, 'Credenciales incorrectas')
-            flash('Email o número de cliente incorrecto.', 'error')
-            return redirect(url_for('portal_login'))
+        # Una sola sentencia en autocommit: un round trip por login
+        with db_cursor(RealDictCursor, autocommit=True) as cursor:
+            usuario = autenticar_usuario(
+                cursor, email, receiver_id,
+                request.remote_addr,
+                request.user_agent.string[:500] if request.user_agent else None
+            )
 
-        # Verificar si está bloqueado
-        if usuario['bloqueado_hasta'] and usuario['bloqueado_hasta'] > datetime.now():
-            tiempo_restante = (usuario['bloqueado_hasta'] - datetime.now()).seconds // 60
-            flash(f'Cuenta bloqueada temporalmente. Intenta en {tiempo_restante} minutos.', 'error')
-            return redirect(url_for('portal_login'))
+    except DatabaseUnavailable:
+        flash('Error de conexión. Intenta nuevamente.', 'error')
+        return redirect(url_for('portal_login'))
+    except Exception as e:
+        app.logger.error(f"Error en login: {e}")
+        flash('Error al iniciar sesión. Intenta nuevamente.', 'error')
+        return redirect(url_for('portal_login'))
 
-        # Verificar si está activo
-        if not usuario['activo']:
-            registrar_acceso(usuario['id'], email, receiver_id, 'login_fallido', False, 'Cuenta inactiva')
-            flash('Tu cuenta ha sido desactivada. Contacta a soporte.', 'error')
-            return redirect(url_for('portal_login'))
+    if usuario['resultado'] == 'no_encontrado':
+        limitador.registrar_fallo(request.remote_addr, email)
+        flash('Email o número de cliente incorrecto.', 'error')
+        return redirect(url_for('portal_login'))
 
-        # Login exitoso
-        session['usuario_id'] = usuario['id']
-        session['email'] = usuario['email']
-        session['nombre'] = usuario['nombre']
-        session['receiver_id'] = usuario['receiver_id']
-        session['login_time'] = datetime.now().isoformat()
+    # Verificar si está bloqueado
+    if usuario['resultado'] == 'bloqueado':
+        segundos = 0
+        if usuario['bloqueado_hasta'] is not None:
+            segundos = (usuario['bloqueado_hasta'] - datetime.now()).total_seconds()
+        if segundos > 0:
+            limitador.marcar_bloqueado(email, segundos)
+        tiempo_restante = max(1, round(segundos / 60))
+        flash(f'Cuenta bloqueada temporalmente. Intenta en {tiempo_restante} minutos.', 'error')
+        return redirect(url_for('portal_login'))
 
-        # Resetear intentos fallidos
-        cursor.execute(
-            "UPDATE usuarios_portal SET intentos_fallidos = 0, bloqueado_hasta = NULL WHERE id = %s",
-            (usuario['id'],)
-        )
-        conn.commit()
+    # Verificar si está activo
+    if usuario['resultado'] == 'inactivo':
+        flash('Tu cuenta ha sido desactivada. Contacta a soporte.', 'error')
+        return redirect(url_for('portal_login'))
 
-        registrar_acceso(usuario['id'], email, receiver_id, 'login_exitoso', True, 'Login exitoso')
-        actualizar_ultimo_acceso(usuario['id'])
+    # La cuenta se bloqueó o desactivó mientras se procesaba este login
+    if usuario['resultado'] != 'exitoso':
+        flash('No se pudo iniciar sesión. Intenta nuevamente.', 'error')
+        return redirect(url_for('portal_login'))
 
-        flash(f'Bienvenido, {usuario["nombre"]}!', 'success')
-        return redirect(url_for('portal_dashboard'))
+    # Login exitoso
+    limitador.registrar_exito(email)
+    session['usuario_id'] = usuario['id']
+    session['email'] = usuario['email']
+    session['nombre'] = usuario['nombre']
+    session['receiver_id'] = usuario['receiver_id']
+    session['login_time'] = datetime.now().isoformat()
 
-    except Exception as e:
-        app.logger.error(f"Error en login: {e}")
-        flash('Error al iniciar sesión. Intenta nuevamente.', 'error')
-        return redirect(url_for('portal_login'))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+    flash(f'Bienvenido, {usuario["nombre"]}!', 'success')
+    return redirect(url_for('portal_dashboard'))
 
 
 @app.route('/portal/logout')
@@ -820,78 +3649,141 @@ def portal_logout():
 # RUTAS - DASHBOARD
 # ============================================================================
 
+def codificar_cursor_facturas(factura):
+    """Cursor opaco con la posición (orden_at, id) de la última factura de una página"""
+    valor = f"{factura['orden_at'].isoformat()}|{factura['id']}"
+    return base64.urlsafe_b64encode(valor.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor_facturas(cursor_param):
+    """Retorna (created_at, id) o None si el cursor no es válido"""
+    try:
+        relleno = '=' * (-len(cursor_param) % 4)
+        valor = base64.urlsafe_b64decode(cursor_param + relleno).decode('utf-8')
+        created_at, factura_id = valor.split('|')
+        return datetime.fromisoformat(created_at), int(factura_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def obtener_pagina_facturas(cursor, usuario_id, despues=None, limite=None):
+    """
+    Una página de facturas del usuario, de la más reciente a la más antigua.
+
+    Paginación por keyset sobre (COALESCE(created_at, 'epoch'), id) con el
+    índice idx_facturas_usuario_orden: cada página cuesta lo mismo sin
+    importar cuántas facturas tenga el usuario ni qué tan atrás esté.
+    created_at admite NULL; esas facturas van al final en vez de romper el
+    cursor.
+    Retorna (facturas, siguiente_cursor); siguiente_cursor es None en la
+    última página.
+    """
+    limite = limite or Config.PORTAL_FACTURAS_POR_PAGINA
+    condicion_cursor = ""
+    params = [usuario_id]
+    if despues is not None:
+        condicion_cursor = "AND (COALESCE(f.created_at, TIMESTAMP 'epoch'), f.id) < (%s, %s)"
+        params += list(despues)
+    params.append(limite + 1)  # una de más para saber si hay otra página
+
+    query = f"""
+        SELECT
+            f.id,
+            f.order_id,
+            f.invoice_id,
+            f.invoice_name,
+            f.amount,
+            f.currency_id,
+            f.status,
+            f.payment_status,
+            f.paid_amount,
+            f.payment_date,
+            f.pdf_url,
+            f.xml_url,
+            f.observaciones_contabilidad,
+            f.notas_cliente,
+            f.created_at,
+            f.updated_at,
+            COALESCE(f.created_at, TIMESTAMP 'epoch') AS orden_at
+        FROM facturas f
+        WHERE f.usuario_id = %s {condicion_cursor}
+        ORDER BY COALESCE(f.created_at, TIMESTAMP 'epoch') DESC, f.id DESC
+        LIMIT %s
+    """
+    cursor.execute(query, params)
+    facturas = cursor.fetchall()
+
+    siguiente_cursor = None
+    if len(facturas) > limite:
+        facturas = facturas[:limite]
+        siguiente_cursor = codificar_cursor_facturas(facturas[-1])
+    return facturas, siguiente_cursor
+
+
+def obtener_resumen_facturas(cursor, usuario_id):
+    """
+    Totales de facturas del usuario desde facturas_resumen_usuario,
+    que mantiene trigger_facturas_resumen (ver database_schema.sql)
+    """
+    cursor.execute(
+        """
+        SELECT total_facturas, monto_total, facturas_pendientes, facturas_pagadas
+        FROM facturas_resumen_usuario
+        WHERE usuario_id = %s
+        """,
+        (usuario_id,)
+    )
+    return cursor.fetchone() or {
+        'total_facturas': 0,
+        'monto_total': 0,
+        'facturas_pendientes': 0,
+        'facturas_pagadas': 0,
+    }
+
+
 @app.route('/portal/dashboard')
 @login_required
 def portal_dashboard():
-    """Dashboard principal del usuario"""
+    """Dashboard principal del usuario (primera página de facturas, ver api_portal_facturas)"""
     usuario_id = session['usuario_id']
 
-    conn = get_db_connection()
-    if not conn:
-        flash('Error de conexión.', 'error')
-        return redirect(url_for('portal_login'))
+    despues = None
+    if request.args.get('cursor'):
+        despues = decodificar_cursor_facturas(request.args['cursor'])
+        if despues is None:
+            return redirect(url_for('portal_dashboard'))
 
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        with db_cursor(RealDictCursor) as cursor:
+            facturas, siguiente_cursor = obtener_pagina_facturas(cursor, usuario_id, despues)
 
-        # Obtener facturas del usuario
-        query = """
-            SELECT
-                f.id,
-                f.order_id,
-                f.invoice_name,
-                f.amount,
-                f.currency_id,
-                f.status,
-                f.payment_status,
-                f.paid_amount,
-                f.payment_date,
-                f.pdf_url,
-                f.xml_url,
-                f.observaciones_contabilidad,
-                f.notas_cliente,
-                f.created_at,
-                f.updated_at
-            FROM facturas f
-            WHERE f.usuario_id = %s
-            ORDER BY f.created_at DESC
-        """
-        cursor.execute(query, (usuario_id,))
-        facturas = cursor.fetchall()
-
-        # Obtener notificaciones no leídas
-        query_notif = """
-            SELECT COUNT(*) as count
-            FROM notificaciones
-            WHERE usuario_id = %s AND leida = FALSE
-        """
-        cursor.execute(query_notif, (usuario_id,))
-        notificaciones_count = cursor.fetchone()['count']
-
-        # Estadísticas
-        stats = {
-            'total_facturas': len(facturas),
-            'monto_total': sum(f['amount'] for f in facturas),
-            'facturas_pendientes': sum(1 for f in facturas if f['payment_status'] == 'pending'),
-            'facturas_pagadas': sum(1 for f in facturas if f['payment_status'] == 'paid'),
-        }
+            # Estadísticas: contadores mantenidos por trigger (una búsqueda por PK)
+            stats = obtener_resumen_facturas(cursor, usuario_id)
+
+            # Obtener notificaciones no leídas
+            query_notif = """
+                SELECT COUNT(*) as count
+                FROM notificaciones
+                WHERE usuario_id = %s AND leida = FALSE
+            """
+            cursor.execute(query_notif, (usuario_id,))
+            notificaciones_count = cursor.fetchone()['count']
 
         return render_template(
             'portal/dashboard.html',
             facturas=facturas,
+            siguiente_cursor=siguiente_cursor,
             stats=stats,
             notificaciones_count=notificaciones_count
         )
 
+    except DatabaseUnavailable:
+        flash('Error de conexión.', 'error')
+        return redirect(url_for('portal_login'))
     except Exception as e:
         app.logger.error(f"Error en dashboard: {e}")
         flash('Error al cargar el dashboard.', 'error')
         return redirect(url_for('portal_login'))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 @app.route('/portal/factura/<int:factura_id>')
@@ -900,152 +3792,545 @@ def portal_factura_detalle(factura_id):
     """Ver detalle de una factura específica"""
     usuario_id = session['usuario_id']
 
-    conn = get_db_connection()
-    if not conn:
-        flash('Error de conexión.', 'error')
-        return redirect(url_for('portal_dashboard'))
-
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        with db_cursor(RealDictCursor) as cursor:
+            # Obtener factura (solo si pertenece al usuario)
+            query = """
+                SELECT
+                    f.*,
+                    u.nombre as usuario_nombre,
+                    u.email as usuario_email
+                FROM facturas f
+                INNER JOIN usuarios_portal u ON f.usuario_id = u.id
+                WHERE f.id = %s AND f.usuario_id = %s
+            """
+            cursor.execute(query, (factura_id, usuario_id))
+            factura = cursor.fetchone()
 
-        # Obtener factura (solo si pertenece al usuario)
-        query = """
-            SELECT
-                f.*,
-                u.nombre as usuario_nombre,
-                u.email as usuario_email
-            FROM facturas f
-            INNER JOIN usuarios_portal u ON f.usuario_id = u.id
-            WHERE f.id = %s AND f.usuario_id = %s
-        """
-        cursor.execute(query, (factura_id, usuario_id))
-        factura = cursor.fetchone()
+            historial = obtener_historial_estados(cursor, factura['order_id']) if factura else []
 
         if not factura:
             flash('Factura no encontrada.', 'error')
             return redirect(url_for('portal_dashboard'))
 
-        return render_template('portal/factura_detalle.html', factura=factura)
+        return render_template('portal/factura_detalle.html', factura=factura, historial=historial)
 
+    except DatabaseUnavailable:
+        flash('Error de conexión.', 'error')
+        return redirect(url_for('portal_dashboard'))
     except Exception as e:
         app.logger.error(f"Error obteniendo factura: {e}")
         flash('Error al cargar la factura.', 'error')
         return redirect(url_for('portal_dashboard'))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
-@app.route('/portal/factura/<int:factura_id>/pdf')
-@login_required
-def portal_descargar_pdf(factura_id):
-    """Descargar PDF de factura"""
-    usuario_id = session['usuario_id']
+_RE_SHA256_ARCHIVO = re.compile(r'^[0-9a-f]{64}$')
 
-    conn = get_db_connection()
-    if not conn:
-        flash('Error de conexión.', 'error')
-        return redirect(url_for('portal_dashboard'))
 
-    try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+@lru_cache(maxsize=1024)
+def _sha256_archivo(ruta, mtime_ns, size):
+    """SHA-256 de un archivo; mtime y tamaño en la llave invalidan la caché si cambia"""
+    sha256 = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(DOCUMENTOS_CHUNK_SIZE), b''):
+            sha256.update(bloque)
+    return sha256.hexdigest()
+
+
+def etag_documento(ruta, stat):
+    """
+    ETag fuerte por contenido. Los documentos de DOCUMENTOS_FOLDER ya se
+    llaman <sha256>.<ext>; los anteriores se hashean una vez por versión.
+    """
+    nombre = os.path.splitext(os.path.basename(ruta))[0]
+    if _RE_SHA256_ARCHIVO.match(nombre):
+        return nombre
+    return _sha256_archivo(ruta, stat.st_mtime_ns, stat.st_size)
+
+
+def enviar_documento_factura(factura_id, columna, mimetype, extension):
+    """
+    Entrega el PDF o XML de una factura del usuario en sesión.
+
+    Con 304 si el navegador ya tiene esa versión (ETag por contenido). Con
+    DESCARGAS_OFFLOAD el proxy (nginx X-Accel-Redirect o X-Sendfile) envía
+    los bytes, incluidos los rangos, y el worker queda libre; sin proxy se
+    usa send_file condicional (Range, If-None-Match, If-Modified-Since).
+    """
+    usuario_id = session['usuario_id']
+    etiqueta = extension.upper()
 
+    with db_cursor(RealDictCursor) as cursor:
         # Verificar que la factura pertenece al usuario
-        query = """
-            SELECT pdf_url, order_id
-            FROM facturas
-            WHERE id = %s AND usuario_id = %s
-        """
-        cursor.execute(query, (factura_id, usuario_id))
+        cursor.execute(
+            f"SELECT {columna} AS ruta, order_id FROM facturas WHERE id = %s AND usuario_id = %s",
+            (factura_id, usuario_id)
+        )
         factura = cursor.fetchone()
 
-        if not factura:
-            flash('Factura no encontrada.', 'error')
-            return redirect(url_for('portal_dashboard'))
+    if not factura:
+        flash('Factura no encontrada.', 'error')
+        return redirect(url_for('portal_dashboard'))
 
-        if not factura['pdf_url']:
-            flash('PDF no disponible aún.', 'warning')
-            return redirect(url_for('portal_factura_detalle', factura_id=factura_id))
+    if not factura['ruta']:
+        flash(f'{etiqueta} no disponible aún.', 'warning')
+        return redirect(url_for('portal_factura_detalle', factura_id=factura_id))
 
-        # Verificar si existe el archivo
-        file_path = factura['pdf_url']
-        if os.path.exists(file_path):
-            return send_file(
+    # Verificar si existe el archivo
+    file_path = factura['ruta']
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        flash('Archivo no encontrado.', 'error')
+        return redirect(url_for('portal_factura_detalle', factura_id=factura_id))
+
+    etag = etag_documento(file_path, stat)
+    download_name = f"factura_{factura['order_id']}.{extension}"
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+    else:
+        response = _respuesta_offload(file_path, mimetype, download_name)
+        if response is not None:
+            response.set_etag(etag)
+            response.last_modified = stat.st_mtime
+        else:
+            response = send_file(
                 file_path,
-                mimetype='application/pdf',
+                mimetype=mimetype,
                 as_attachment=True,
-                download_name=f"factura_{factura['order_id']}.pdf"
+                download_name=download_name,
+                conditional=True,
+                etag=etag
             )
-        else:
-            flash('Archivo no encontrado.', 'error')
-            return redirect(url_for('portal_factura_detalle', factura_id=factura_id))
 
+    # Revalidar siempre: una factura puede recibir un PDF nuevo con otra ruta
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _respuesta_offload(file_path, mimetype, download_name):
+    """
+    Respuesta vacía con X-Accel-Redirect / X-Sendfile para que el proxy
+    envíe el archivo. None sin DESCARGAS_OFFLOAD o si la ruta no está bajo
+    DOCUMENTOS_FOLDER (nginx solo expone esa carpeta con su location interna).
+    """
+    if Config.DESCARGAS_OFFLOAD == 'nginx':
+        base = os.path.realpath(Config.DOCUMENTOS_FOLDER)
+        ruta = os.path.realpath(file_path)
+        if os.path.commonpath([base, ruta]) != base:
+            return None
+        relativa = os.path.relpath(ruta, base).replace(os.sep, '/')
+        cabecera = ('X-Accel-Redirect', Config.DESCARGAS_ACCEL_PREFIX.rstrip('/') + '/' + relativa)
+    elif Config.DESCARGAS_OFFLOAD == 'sendfile':
+        cabecera = ('X-Sendfile', os.path.realpath(file_path))
+    else:
+        return None
+
+    response = Response(mimetype=mimetype)
+    response.headers[cabecera[0]] = cabecera[1]
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    return response
+
+
+@app.route('/portal/factura/<int:factura_id>/pdf')
+@login_required
+def portal_descargar_pdf(factura_id):
+    """Descargar PDF de factura"""
+    try:
+        return enviar_documento_factura(factura_id, 'pdf_url', 'application/pdf', 'pdf')
+
+    except DatabaseUnavailable:
+        flash('Error de conexión.', 'error')
+        return redirect(url_for('portal_dashboard'))
     except Exception as e:
         app.logger.error(f"Error descargando PDF: {e}")
         flash('Error al descargar PDF.', 'error')
         return redirect(url_for('portal_dashboard'))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 @app.route('/portal/factura/<int:factura_id>/xml')
 @login_required
 def portal_descargar_xml(factura_id):
     """Descargar XML de factura"""
-    usuario_id = session['usuario_id']
+    try:
+        return enviar_documento_factura(factura_id, 'xml_url', 'application/xml', 'xml')
 
-    conn = get_db_connection()
-    if not conn:
+    except DatabaseUnavailable:
         flash('Error de conexión.', 'error')
         return redirect(url_for('portal_dashboard'))
+    except Exception as e:
+        app.logger.error(f"Error descargando XML: {e}")
+        flash('Error al descargar XML.', 'error')
+        return redirect(url_for('portal_dashboard'))
+
+
+# ============================================================================
+# EVENTOS DEL PORTAL EN TIEMPO REAL (LISTEN/NOTIFY + SSE)
+# ============================================================================
+
+CANAL_EVENTOS_PORTAL = 'portal_eventos'
+
+
+class EventosPortal:
+    """
+    Reparte los NOTIFY de PostgreSQL a los streams SSE del proceso.
+
+    Una sola conexión LISTEN por proceso (fuera del pool) recibe los eventos
+    del canal portal_eventos y los entrega a las colas de los usuarios
+    suscritos en este proceso. Cada evento trae su usuario_id; los demás
+    procesos lo ignoran si ese usuario no tiene un stream abierto con ellos.
+    """
+
+    def __init__(self, dsn, max_conexiones):
+        self.dsn = dsn
+        self.max_conexiones = max_conexiones
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._suscriptores = {}  # usuario_id -> set de queue.Queue
+        self._stats = {
+            'conectado': False,
+            'reconexiones': 0,
+            'eventos_recibidos': 0,
+            'eventos_entregados': 0,
+            'eventos_descartados': 0,
+            'streams_rechazados': 0,
+        }
+        self._hilo = threading.Thread(target=self._escuchar, name='eventos-portal', daemon=True)
+        self._hilo.start()
+
+    def suscribir(self, usuario_id):
+        """Cola de eventos para un stream nuevo, o None si el proceso llegó a SSE_MAX_CONEXIONES"""
+        cola = queue.Queue(maxsize=100)
+        with self._lock:
+            if sum(len(colas) for colas in self._suscriptores.values()) >= self.max_conexiones:
+                self._stats['streams_rechazados'] += 1
+                return None
+            self._suscriptores.setdefault(usuario_id, set()).add(cola)
+        return cola
+
+    def desuscribir(self, usuario_id, cola):
+        with self._lock:
+            colas = self._suscriptores.get(usuario_id)
+            if colas:
+                colas.discard(cola)
+                if not colas:
+                    del self._suscriptores[usuario_id]
+
+    def _despachar(self, evento):
+        """Entrega el evento a los streams del usuario (o a todos si no trae usuario_id)"""
+        with self._lock:
+            if evento.get('usuario_id') is None:
+                colas = [c for colas in self._suscriptores.values() for c in colas]
+            else:
+                colas = list(self._suscriptores.get(evento['usuario_id'], ()))
+
+        for cola in colas:
+            try:
+                cola.put_nowait(evento)
+                entregado = 'eventos_entregados'
+            except queue.Full:
+                # Cliente que no está leyendo: no debe frenar a los demás
+                entregado = 'eventos_descartados'
+            with self._lock:
+                self._stats[entregado] += 1
+
+    def _escuchar(self):
+        espera = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CANAL_EVENTOS_PORTAL}")
+
+                with self._lock:
+                    reconexion = self._stats['reconexiones'] > 0
+                    self._stats['conectado'] = True
+                espera = 1
+                if reconexion:
+                    # Pudieron perderse eventos mientras no había conexión
+                    self._despachar({'tipo': 'resync', 'usuario_id': None})
+
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        with self._lock:
+                            self._stats['eventos_recibidos'] += 1
+                        try:
+                            self._despachar(json.loads(notify.payload))
+                        except (ValueError, TypeError):
+                            logger.warning(f"⚠️ Evento de portal inválido: {notify.payload[:200]}")
+
+            except Exception as e:
+                logger.error(f"❌ Listener de eventos del portal desconectado: {e}")
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
+
+            with self._lock:
+                self._stats['conectado'] = False
+                self._stats['reconexiones'] += 1
+            time.sleep(espera)
+            espera = min(espera * 2, 30)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'streams_abiertos': sum(len(colas) for colas in self._suscriptores.values()),
+                'usuarios_conectados': len(self._suscriptores),
+                'max_conexiones': self.max_conexiones,
+            }
+
+
+_eventos_portal = None
+_eventos_portal_lock = threading.Lock()
+
+
+def get_eventos_portal():
+    """Listener de eventos del proceso actual (uno por worker de gunicorn)"""
+    global _eventos_portal
+
+    if _eventos_portal is not None and _eventos_portal._pid == os.getpid():
+        return _eventos_portal
+
+    with _eventos_portal_lock:
+        if _eventos_portal is None or _eventos_portal._pid != os.getpid():
+            _eventos_portal = EventosPortal(Config.get_postgres_connection_string(), Config.SSE_MAX_CONEXIONES)
+    return _eventos_portal
+
+
+def _contar_no_leidas(usuario_id):
+    with db_cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM notificaciones WHERE usuario_id = %s AND leida = FALSE",
+            (usuario_id,)
+        )
+        return cursor.fetchone()[0]
+
+
+def _evento_sse(tipo, datos):
+    return f"event: {tipo}\ndata: {json.dumps(datos, default=str)}\n\n"
+
+
+@app.route('/api/portal/eventos')
+@login_required
+def api_portal_eventos():
+    """
+    Stream SSE del usuario: notificaciones nuevas, cambios de estado de sus
+    facturas y contador de no leídas. Reemplaza el polling de
+    /api/portal/notificaciones/count.
+
+    Se cierra tras SSE_MAX_DURACION segundos; EventSource reconecta solo.
+    """
+    usuario_id = session['usuario_id']
+    eventos = get_eventos_portal()
+
+    cola = eventos.suscribir(usuario_id)
+    if cola is None:
+        return jsonify({'error': 'Demasiadas conexiones'}), 503, {'Retry-After': '30'}
+
+    try:
+        no_leidas = _contar_no_leidas(usuario_id)
+    except psycopg2.Error as e:
+        eventos.desuscribir(usuario_id, cola)
+        app.logger.error(f"Error abriendo stream de eventos: {e}")
+        return jsonify({'error': 'Error de conexión'}), 503, {'Retry-After': '10'}
+
+    def generar():
+        try:
+            yield "retry: 5000\n"
+            yield _evento_sse('notificaciones', {'no_leidas': no_leidas})
+
+            fin = time.monotonic() + Config.SSE_MAX_DURACION
+            while True:
+                restante = fin - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    evento = cola.get(timeout=min(Config.SSE_HEARTBEAT, restante))
+                except queue.Empty:
+                    # Comentario SSE: mantiene viva la conexión en proxies e ingress
+                    yield ": ping\n\n"
+                    continue
+
+                tipo = evento.pop('tipo', 'mensaje')
+                evento.pop('usuario_id', None)
+                if tipo == 'resync':
+                    yield _evento_sse('notificaciones', {'no_leidas': _contar_no_leidas(usuario_id)})
+                else:
+                    yield _evento_sse(tipo, evento)
+        finally:
+            eventos.desuscribir(usuario_id, cola)
+
+    return Response(
+        generar(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # nginx: no acumular el stream
+        }
+    )
+
+
+@app.route('/api/portal/notificaciones/count')
+@login_required
+def api_notificaciones_count():
+    """Contador de notificaciones no leídas (respaldo para clientes sin SSE)"""
+    usuario_id = session['usuario_id']
 
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        return jsonify({
+            'success': True,
+            'count': _contar_no_leidas(usuario_id)
+        })
 
-        # Verificar que la factura pertenece al usuario
-        query = """
-            SELECT xml_url, order_id
-            FROM facturas
-            WHERE id = %s AND usuario_id = %s
-        """
-        cursor.execute(query, (factura_id, usuario_id))
-        factura = cursor.fetchone()
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Error de conexión'}), 503
+    except Exception as e:
+        app.logger.error(f"Error obteniendo count: {e}")
+        return jsonify({'error': 'Error al obtener notificaciones'}), 500
 
-        if not factura:
-            flash('Factura no encontrada.', 'error')
-            return redirect(url_for('portal_dashboard'))
 
-        if not factura['xml_url']:
-            flash('XML no disponible aún.', 'warning')
-            return redirect(url_for('portal_factura_detalle', factura_id=factura_id))
+# ============================================================================
+# API PORTAL (AJAX)
+# ============================================================================
 
-        # Verificar si existe el archivo
-        file_path = factura['xml_url']
-        if os.path.exists(file_path):
-            return send_file(
-                file_path,
-                mimetype='application/xml',
-                as_attachment=True,
-                download_name=f"factura_{factura['order_id']}.xml"
-            )
-        else:
-            flash('Archivo no encontrado.', 'error')
-            return redirect(url_for('portal_factura_detalle', factura_id=factura_id))
+@app.route('/api/portal/facturas')
+@login_required
+def api_portal_facturas():
+    """Página de facturas en JSON para el scroll infinito del dashboard (?cursor=)"""
+    usuario_id = session['usuario_id']
+
+    despues = None
+    if request.args.get('cursor'):
+        despues = decodificar_cursor_facturas(request.args['cursor'])
+        if despues is None:
+            return jsonify({'success': False, 'error': 'Cursor inválido'}), 400
+
+    try:
+        limite = min(int(request.args.get('limit', Config.PORTAL_FACTURAS_POR_PAGINA)),
+                     Config.PORTAL_FACTURAS_MAX_POR_PAGINA)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'limit inválido'}), 400
+    if limite < 1:
+        return jsonify({'success': False, 'error': 'limit inválido'}), 400
 
+    try:
+        with db_cursor(RealDictCursor) as cursor:
+            facturas, siguiente_cursor = obtener_pagina_facturas(cursor, usuario_id, despues, limite)
+    except DatabaseUnavailable:
+        return jsonify({'success': False, 'error': 'Error de conexión'}), 503
     except Exception as e:
-        app.logger.error(f"Error descargando XML: {e}")
-        flash('Error al descargar XML.', 'error')
-        return redirect(url_for('portal_dashboard'))
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+        app.logger.error(f"Error obteniendo facturas: {e}")
+        return jsonify({'success': False, 'error': 'Error al obtener facturas'}), 500
+
+    return jsonify({
+        'success': True,
+        'facturas': [
+            {
+                'id': f['id'],
+                'order_id': f['order_id'],
+                'invoice_id': f['invoice_id'],
+                'invoice_name': f['invoice_name'],
+                'amount': float(f['amount']) if f['amount'] is not None else 0,
+                'currency_id': f['currency_id'],
+                'status': f['status'],
+                'payment_status': f['payment_status'],
+                'created_at': f['created_at'].isoformat() if f['created_at'] else None,
+                'fecha': f['created_at'].strftime('%d/%m/%Y') if f['created_at'] else '',
+                'detalle_url': url_for('portal_factura_detalle', factura_id=f['id']),
+                'pdf_url': url_for('portal_descargar_pdf', factura_id=f['id']) if f['pdf_url'] else None,
+                'xml_url': url_for('portal_descargar_xml', factura_id=f['id']) if f['xml_url'] else None,
+            }
+            for f in facturas
+        ],
+        'siguiente_cursor': siguiente_cursor
+    })
+
+
+@app.route('/api/portal/facturas/stats')
+@login_required
+def api_facturas_stats():
+    """Estadísticas de facturas para gráficos (últimos 12 meses con facturas)"""
+    usuario_id = session['usuario_id']
+
+    try:
+        with db_cursor(RealDictCursor) as cursor:
+            resumen = obtener_resumen_facturas(cursor, usuario_id)
+
+            # Stats por mes desde facturas_resumen_mensual (rango sobre la PK)
+            query = """
+                SELECT
+                    mes,
+                    total,
+                    monto_total,
+                    pagadas
+                FROM facturas_resumen_mensual
+                WHERE usuario_id = %s AND total > 0
+                ORDER BY mes DESC
+                LIMIT 12
+            """
+            cursor.execute(query, (usuario_id,))
+            stats = cursor.fetchall()
+
+        return jsonify({
+            'success': True,
+            'resumen': dict(resumen),
+            'data': [dict(row) for row in stats]
+        })
+
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Error de conexión'}), 503
+    except Exception as e:
+        app.logger.error(f"Error obteniendo stats: {e}")
+        return jsonify({'error': 'Error al obtener estadísticas'}), 500
+
+
+# ============================================================================
+# ENDPOINTS - ESTADO DEL SISTEMA
+# ============================================================================
+
+@app.route('/metrics')
+def metricas_prometheus():
+    """Métricas Prometheus del pod (latencia por etapa y ruta, envíos a n8n, requests en curso)"""
+    cuerpo, content_type = generar_metricas()
+    return Response(cuerpo, content_type=content_type)
+
+
+@app.route('/api/sistema/stats')
+def api_sistema_stats():
+    """
+    Métricas internas del proceso (pool de conexiones, sesión HTTP a n8n, auditoría, etc.)
+    Exige el mismo Authorization: Bearer que /api/pedidos/lookup; sin PEDIDOS_API_TOKEN responde 401.
+    """
+    if not _token_api_valido():
+        return jsonify({'success': False, 'error': 'No autorizado'}), 401
+
+    try:
+        db_pool_stats = get_db_pool().stats()
+    except DatabaseUnavailable as e:
+        db_pool_stats = {'error': str(e)}
+
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'servidor': {'modo': Config.SERVIDOR_MODO, 'psycopg2_cooperativo': PSYCOPG2_COOPERATIVO},
+        'db_pool': db_pool_stats,
+        'n8n_http': n8n_http_stats(),
+        'audit': get_audit_writer().stats(),
+        'sesiones': app.session_interface.stats() if isinstance(app.session_interface, SesionesPostgres) else None,
+        'login_limites': get_limitador_login().stats(),
+        'logging': log_stats(),
+        'eventos': _eventos_portal.stats() if _eventos_portal is not None and _eventos_portal._pid == os.getpid() else None
+    })
 
 
 # ============================================================================
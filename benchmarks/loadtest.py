@@ -0,0 +1,471 @@
+"""
+Prueba de carga de punta a punta: /buscar-pedido -> /facturar -> /procesar-factura
+
+Levanta un n8n simulado local (latencia, errores, rechazos y cuelgues
+configurables), siembra pedidos sintéticos en orden_ml/shipment de una base
+local y recorre el flujo real del portal con N clientes concurrentes. Al
+final imprime un JSON con p50/p95/p99 por paso, throughput y el desglose de
+errores (y, con --esperar-jobs, cómo terminó cada envío a n8n).
+
+Por defecto arranca gunicorn y outbox_worker.py con N8N_WEBHOOK_URL
+apuntando al n8n simulado.
+Con --url se usa un servidor ya levantado (que debe apuntar al simulador:
+se imprime su URL en stderr).
+
+Requiere una base de desarrollo con database_schema.sql aplicado (orden_ml,
+shipment, orden_lookup, facturacion_jobs). Los pedidos se crean con el
+prefijo --prefijo y se borran al final, junto con sus jobs.
+
+Uso:
+    python benchmarks/loadtest.py --concurrencia 16 --duracion 30 \\
+        --n8n-latencia-ms 800 --n8n-error-rate 0.05 --esperar-jobs
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+import requests
+from psycopg2.extras import execute_values
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from config import Config  # noqa: E402
+
+# CSF sintética: basta con que libmagic la reconozca como PDF
+CSF_PDF = b'%PDF-1.4\n1 0 obj<</Type/Catalog>>endobj\ntrailer<</Root 1 0 R>>\n%%EOF\n' + b' ' * 20000
+
+
+# ============================================================================
+# N8N SIMULADO
+# ============================================================================
+
+class N8nSimulado(BaseHTTPRequestHandler):
+    """Webhook de n8n con latencia y fallas inyectadas (parámetros en la clase)"""
+
+    protocol_version = 'HTTP/1.1'
+    latencia = 0.5
+    jitter = 0.1
+    error_rate = 0.0
+    rechazo_rate = 0.0
+    cuelgue_rate = 0.0
+    cuelgue = 90.0
+    conteo = Counter()
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        suerte = random.random()
+        if suerte < self.cuelgue_rate:
+            resultado, espera = 'cuelgue', self.cuelgue
+        elif suerte < self.cuelgue_rate + self.error_rate:
+            resultado, espera = 'error_500', self.latencia
+        elif suerte < self.cuelgue_rate + self.error_rate + self.rechazo_rate:
+            resultado, espera = 'rechazo', self.latencia
+        else:
+            resultado, espera = 'exito', self.latencia
+        with self.lock:
+            self.conteo[resultado] += 1
+
+        time.sleep(max(0.0, random.gauss(espera, self.jitter if resultado != 'cuelgue' else 0)))
+
+        if resultado == 'error_500':
+            self._responder(500, {'message': 'Error simulado'})
+        elif resultado == 'rechazo':
+            self._responder(200, {'success': False, 'message': 'Pedido no elegible (simulado)'})
+        else:
+            self._responder(200, {'success': True, 'message': 'Factura creada (simulado)', 'invoice_id': 1})
+
+    def _responder(self, status, cuerpo):
+        datos = json.dumps(cuerpo).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+        except OSError:
+            pass  # el portal cortó por timeout
+
+    def log_message(self, *args):
+        pass
+
+
+def iniciar_n8n(args):
+    N8nSimulado.latencia = args.n8n_latencia_ms / 1000
+    N8nSimulado.jitter = args.n8n_jitter_ms / 1000
+    N8nSimulado.error_rate = args.n8n_error_rate
+    N8nSimulado.rechazo_rate = args.n8n_rechazo_rate
+    N8nSimulado.cuelgue_rate = args.n8n_cuelgue_rate
+    N8nSimulado.cuelgue = args.n8n_cuelgue_s
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', args.n8n_puerto), N8nSimulado)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f'http://127.0.0.1:{servidor.server_address[1]}/webhook/loadtest'
+
+
+# ============================================================================
+# DATOS SINTÉTICOS
+# ============================================================================
+
+def sembrar_pedidos(conn, prefijo, cantidad):
+    """Crea `cantidad` pedidos con su envío; regresa [(order_id, paid_amount)]"""
+    pedidos = [(f'{prefijo}{i:07d}', round(random.uniform(100, 5000), 2)) for i in range(cantidad)]
+    with conn.cursor() as cursor:
+        execute_values(
+            cursor,
+            "INSERT INTO public.shipment (id, receiver_id, logistic_type) VALUES %s ON CONFLICT DO NOTHING",
+            [(f'{order_id}-S', f'{prefijo}R{i % 500}', 'fulfillment') for i, (order_id, _) in enumerate(pedidos)]
+        )
+        execute_values(
+            cursor,
+            """
+            INSERT INTO public.orden_ml
+            (order_id, pack_id, payments_0_id, paid_amount, buyer_nickname, currency_id, shipping_id)
+            VALUES %s ON CONFLICT DO NOTHING
+            """,
+            [(order_id, None, f'{order_id}-P', monto, f'loadtest{i}', 'MXN', f'{order_id}-S')
+             for i, (order_id, monto) in enumerate(pedidos)]
+        )
+    conn.commit()
+    return pedidos
+
+
+def limpiar(conn, prefijo):
+    patron = prefijo.replace('%', r'\%').replace('_', r'\_') + '%'
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM facturacion_jobs WHERE order_id LIKE %s", (patron,))
+        cursor.execute("DELETE FROM public.orden_ml WHERE order_id LIKE %s", (patron,))
+        cursor.execute("DELETE FROM public.shipment WHERE id LIKE %s", (patron,))
+        # La CSF sintética solo la usan estos jobs
+        cursor.execute(
+            """
+            WITH borrados AS (
+                DELETE FROM csf_documentos c
+                WHERE c.sha256 = encode(sha256(%s), 'hex')
+                  AND NOT EXISTS (SELECT 1 FROM facturacion_jobs j WHERE j.csf_sha256 = c.sha256)
+                RETURNING c.contenido_oid
+            )
+            SELECT lo_unlink(contenido_oid) FROM borrados WHERE contenido_oid IS NOT NULL
+            """,
+            (psycopg2.Binary(CSF_PDF),)
+        )
+    conn.commit()
+
+
+# ============================================================================
+# SERVIDOR DEL PORTAL
+# ============================================================================
+
+def lanzar_portal(args, n8n_url):
+    """Arranca gunicorn (y outbox_worker) apuntando al n8n simulado; regresa ([procesos], url)"""
+    entorno = dict(
+        os.environ,
+        N8N_WEBHOOK_URL=n8n_url,
+        LOG_FILE='',
+        SERVIDOR_MODO=args.modo,
+        PROMETHEUS_MULTIPROC_DIR=os.path.join('/tmp', f'loadtest_metrics_{os.getpid()}'),
+    )
+    comando = [
+        sys.executable, '-m', 'gunicorn',
+        '-c', os.path.join(RAIZ, 'gunicorn.conf.py'),
+        '--workers', str(args.workers),
+        # El tipo de worker lo elige gunicorn.conf.py según SERVIDOR_MODO
+        *(['--threads', str(args.threads)] if args.modo == 'hilos' else ['--worker-connections', str(args.threads)]),
+        '--bind', f'127.0.0.1:{args.puerto}',
+        'app:app',
+    ]
+    salida = open(args.log_servidor, 'ab') if args.log_servidor else subprocess.DEVNULL
+    procesos = [subprocess.Popen(comando, cwd=RAIZ, env=entorno, stdout=salida, stderr=subprocess.STDOUT)]
+    if not args.sin_outbox_worker:
+        # Entrega lo que no cupo en el executor de los workers web y los reintentos
+        procesos.append(subprocess.Popen([sys.executable, 'outbox_worker.py'], cwd=RAIZ, env=entorno,
+                                         stdout=salida, stderr=subprocess.STDOUT))
+
+    url = f'http://127.0.0.1:{args.puerto}'
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        if procesos[0].poll() is not None:
+            detener(procesos)
+            raise RuntimeError(f'gunicorn terminó con código {procesos[0].returncode}')
+        try:
+            requests.get(url + '/', timeout=1)
+            return procesos, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    detener(procesos)
+    raise RuntimeError('gunicorn no respondió en 30 s')
+
+
+def detener(procesos):
+    for proceso in procesos:
+        proceso.terminate()
+    for proceso in procesos:
+        try:
+            proceso.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+
+
+# ============================================================================
+# CLIENTES
+# ============================================================================
+
+class Resultados:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = {'buscar_pedido': [], 'formulario': [], 'procesar_factura': [], 'flujo': []}
+        self.errores = Counter()
+        self.flujos_ok = 0
+        self.requests = 0
+        self.jobs = []
+
+    def paso(self, nombre, segundos):
+        with self.lock:
+            self.latencias[nombre].append(segundos)
+            self.requests += 1
+
+    def error(self, tipo):
+        with self.lock:
+            self.errores[tipo] += 1
+
+    def flujo(self, segundos, job_id):
+        with self.lock:
+            self.latencias['flujo'].append(segundos)
+            self.flujos_ok += 1
+            if job_id:
+                self.jobs.append(job_id)
+
+
+def _paso(resultados, nombre, funcion, esperado):
+    inicio = time.perf_counter()
+    try:
+        respuesta = funcion()
+    except requests.Timeout:
+        resultados.error(f'{nombre}:timeout')
+        return None
+    except requests.RequestException as e:
+        resultados.error(f'{nombre}:{type(e).__name__}')
+        return None
+    resultados.paso(nombre, time.perf_counter() - inicio)
+    if respuesta.status_code != esperado:
+        resultados.error(f'{nombre}:http_{respuesta.status_code}')
+        return None
+    return respuesta
+
+
+def cliente(url, pedidos, resultados, fin, restantes, timeout):
+    """Un usuario: repite el flujo completo con una sesión (cookies) nueva cada vez"""
+    while time.monotonic() < fin:
+        if restantes is not None:
+            with resultados.lock:
+                if restantes[0] <= 0:
+                    return
+                restantes[0] -= 1
+
+        order_id, monto = random.choice(pedidos)
+        inicio = time.perf_counter()
+        with requests.Session() as s:
+            r = _paso(resultados, 'buscar_pedido', lambda: s.post(
+                url + '/buscar-pedido', data={'search_id': order_id}, allow_redirects=False, timeout=timeout), 302)
+            if r is None:
+                continue
+            if '/facturar/' not in r.headers.get('Location', ''):
+                resultados.error('buscar_pedido:no_encontrado')
+                continue
+
+            if _paso(resultados, 'formulario', lambda: s.get(
+                    url + f'/facturar/{order_id}', timeout=timeout), 200) is None:
+                continue
+
+            r = _paso(resultados, 'procesar_factura', lambda: s.post(
+                url + '/procesar-factura',
+                data={
+                    'cfdi_usage': 'G03',
+                    'payment_method': '04',
+                    'email': f'{order_id.lower()}@loadtest.example.com',
+                    'phone': '5500000000',
+                    'monto_pagado': f'{monto:.2f}',
+                },
+                files={'csf_file': ('csf.pdf', io.BytesIO(CSF_PDF), 'application/pdf')},
+                allow_redirects=False,
+                timeout=timeout
+            ), 302)
+            if r is None:
+                continue
+            location = r.headers.get('Location', '')
+            if '/exito/' not in location:
+                resultados.error('procesar_factura:rechazada')
+                continue
+
+        job_id = location.split('job=', 1)[1] if 'job=' in location else None
+        resultados.flujo(time.perf_counter() - inicio, job_id)
+
+
+def esperar_jobs(url, job_ids, limite_s):
+    """Consulta los jobs hasta que terminan (o vence el límite); regresa el conteo por estado"""
+    pendientes = dict.fromkeys(job_ids, 'desconocido')
+    estados = Counter()
+    fin = time.monotonic() + limite_s
+    with requests.Session() as s:
+        while pendientes and time.monotonic() < fin:
+            for job_id in list(pendientes):
+                try:
+                    job = s.get(f'{url}/api/facturas/jobs/{job_id}', timeout=10).json()
+                except (requests.RequestException, ValueError):
+                    continue
+                if job.get('finalizado'):
+                    estados[job['status']] += 1
+                    del pendientes[job_id]
+                else:
+                    pendientes[job_id] = job.get('status', 'desconocido')
+            if pendientes:
+                time.sleep(1)
+    if pendientes:
+        # pendiente = esperando reintento (backoff) o a outbox_worker; enviando = en curso
+        estados['sin_terminar'] = dict(Counter(pendientes.values()))
+    return dict(estados)
+
+
+# ============================================================================
+# REPORTE
+# ============================================================================
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+
+def resumen_latencias(valores):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return {'n': 0}
+    ms = lambda v: round(v * 1000, 2)  # noqa: E731
+    return {
+        'n': len(ordenados),
+        'p50_ms': ms(percentil(ordenados, 50)),
+        'p95_ms': ms(percentil(ordenados, 95)),
+        'p99_ms': ms(percentil(ordenados, 99)),
+        'max_ms': ms(ordenados[-1]),
+        'media_ms': ms(sum(ordenados) / len(ordenados)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrencia', type=int, default=8, help='clientes simultáneos')
+    parser.add_argument('--duracion', type=float, default=30, help='segundos de carga')
+    parser.add_argument('--solicitudes', type=int, help='detenerse tras N flujos (además de --duracion)')
+    parser.add_argument('--calentamiento', type=float, default=2, help='segundos iniciales que no se miden')
+    parser.add_argument('--pedidos', type=int, default=1000, help='pedidos sintéticos a sembrar')
+    parser.add_argument('--prefijo', default='LT', help='prefijo de los order_id sintéticos')
+    parser.add_argument('--timeout', type=float, default=30, help='timeout por request del cliente')
+    parser.add_argument('--url', help='portal ya levantado (no se arranca gunicorn)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--modo', choices=('hilos', 'async'), default='hilos', help='SERVIDOR_MODO del portal')
+    parser.add_argument('--threads', type=int, default=16, help='hilos por worker (async: requests simultáneos)')
+    parser.add_argument('--puerto', type=int, default=5099)
+    parser.add_argument('--log-servidor', help='archivo para la salida de gunicorn y outbox_worker')
+    parser.add_argument('--sin-outbox-worker', action='store_true', help='no arrancar outbox_worker.py')
+    parser.add_argument('--n8n-puerto', type=int, default=0, help='0 = puerto libre')
+    parser.add_argument('--n8n-latencia-ms', type=float, default=500)
+    parser.add_argument('--n8n-jitter-ms', type=float, default=100)
+    parser.add_argument('--n8n-error-rate', type=float, default=0.0, help='fracción de respuestas 500')
+    parser.add_argument('--n8n-rechazo-rate', type=float, default=0.0, help='fracción de success=false')
+    parser.add_argument('--n8n-cuelgue-rate', type=float, default=0.0, help='fracción que no responde a tiempo')
+    parser.add_argument('--n8n-cuelgue-s', type=float, default=Config.N8N_TIMEOUT + 5)
+    parser.add_argument('--esperar-jobs', action='store_true', help='esperar el resultado de cada envío a n8n')
+    parser.add_argument('--esperar-jobs-s', type=float, default=120)
+    parser.add_argument('--conservar', action='store_true', help='no borrar pedidos ni jobs al terminar')
+    args = parser.parse_args()
+
+    servidor_n8n, n8n_url = iniciar_n8n(args)
+    print(f'n8n simulado en {n8n_url}', file=sys.stderr)
+
+    conn = psycopg2.connect(Config.get_postgres_connection_string())
+    procesos = []
+    try:
+        limpiar(conn, args.prefijo)
+        pedidos = sembrar_pedidos(conn, args.prefijo, args.pedidos)
+
+        if args.url:
+            url = args.url.rstrip('/')
+        else:
+            procesos, url = lanzar_portal(args, n8n_url)
+
+        # Calentamiento: conexiones del pool, sesión HTTP a n8n, imports perezosos
+        if args.calentamiento > 0:
+            descartar = Resultados()
+            fin = time.monotonic() + args.calentamiento
+            hilos = [threading.Thread(target=cliente, args=(url, pedidos, descartar, fin, None, args.timeout))
+                     for _ in range(args.concurrencia)]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+        N8nSimulado.conteo.clear()
+
+        resultados = Resultados()
+        restantes = [args.solicitudes] if args.solicitudes else None
+        inicio = time.monotonic()
+        fin = inicio + args.duracion
+        hilos = [threading.Thread(target=cliente, args=(url, pedidos, resultados, fin, restantes, args.timeout))
+                 for _ in range(args.concurrencia)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        transcurrido = time.monotonic() - inicio
+
+        reporte = {
+            'config': {
+                'concurrencia': args.concurrencia,
+                'duracion_s': round(transcurrido, 2),
+                'pedidos': args.pedidos,
+                'servidor': args.url or f'gunicorn {args.modo} {args.workers}x{args.threads}',
+                'n8n': {
+                    'latencia_ms': args.n8n_latencia_ms,
+                    'jitter_ms': args.n8n_jitter_ms,
+                    'error_rate': args.n8n_error_rate,
+                    'rechazo_rate': args.n8n_rechazo_rate,
+                    'cuelgue_rate': args.n8n_cuelgue_rate,
+                },
+            },
+            'throughput': {
+                'flujos_por_s': round(resultados.flujos_ok / transcurrido, 2),
+                'requests_por_s': round(resultados.requests / transcurrido, 2),
+            },
+            'flujos_ok': resultados.flujos_ok,
+            'errores': dict(resultados.errores),
+            'latencia': {paso: resumen_latencias(v) for paso, v in resultados.latencias.items()},
+        }
+
+        if args.esperar_jobs:
+            reporte['jobs'] = esperar_jobs(url, resultados.jobs, args.esperar_jobs_s)
+        reporte['n8n_recibidos'] = dict(N8nSimulado.conteo)
+
+        print(json.dumps(reporte, indent=2, ensure_ascii=False))
+
+    finally:
+        detener(procesos)
+        if not args.conservar:
+            limpiar(conn, args.prefijo)
+        conn.close()
+        servidor_n8n.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Benchmark: round trips a PostgreSQL por login en el portal de usuarios
+
+Compara el flujo anterior de portal_login_post (SELECT + UPDATE + COMMIT en
+una conexión, más registrar_acceso y actualizar_ultimo_acceso abriendo cada
+uno su propia conexión) contra autenticar_usuario (una sola sentencia en
+autocommit sobre una conexión reutilizada).
+
+Cuenta round trips contando cada sentencia más los BEGIN/COMMIT que psycopg2
+envía por separado. Con --rtt-ms se suma una latencia de red simulada por
+round trip (en local la latencia real es casi cero).
+
+Crea un usuario de prueba (receiver_id BENCH-LOGIN) y lo borra al final.
+Usar contra una base de desarrollo.
+
+Uso:
+    python benchmarks/login_roundtrips.py [--iteraciones 200] [--rtt-ms 1.5]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import autenticar_usuario  # noqa: E402
+from config import Config  # noqa: E402
+
+EMAIL = 'bench-login@example.com'
+RECEIVER_ID = 'BENCH-LOGIN'
+IP = '127.0.0.1'
+USER_AGENT = 'benchmarks/login_roundtrips.py'
+
+
+class Contador:
+    """Round trips, commits y conexiones nuevas de un flujo"""
+
+    def __init__(self, rtt_ms):
+        self.rtt = rtt_ms / 1000.0
+        self.round_trips = 0
+        self.commits = 0
+        self.conexiones = 0
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.rtt:
+            time.sleep(self.rtt)
+
+
+def conectar(contador):
+    """Conexión cuyo cursor y commit reportan sus round trips al contador"""
+
+    class CursorContado(RealDictCursor):
+        def execute(self, query, vars=None):
+            conn = self.connection
+            if not conn.autocommit and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                contador.round_trip()  # BEGIN implícito
+            contador.round_trip()
+            return super().execute(query, vars)
+
+    class ConexionContada(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            kwargs.setdefault('cursor_factory', CursorContado)
+            return super().cursor(*args, **kwargs)
+
+        def commit(self):
+            if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                contador.round_trip()
+                contador.commits += 1
+            return super().commit()
+
+    contador.conexiones += 1
+    # El handshake (TCP + startup + auth) son al menos 2 round trips más
+    contador.round_trip()
+    contador.round_trip()
+    return psycopg2.connect(Config.get_postgres_connection_string(), connection_factory=ConexionContada)
+
+
+def login_anterior(contador):
+    """Flujo original de portal_login_post, registrar_acceso y actualizar_ultimo_acceso"""
+    conn = conectar(contador)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT id, receiver_id, email, nombre, activo, bloqueado_hasta, intentos_fallidos
+        FROM usuarios_portal
+        WHERE email = %s AND receiver_id = %s
+        """,
+        (EMAIL, RECEIVER_ID)
+    )
+    usuario = cursor.fetchone()
+    cursor.execute(
+        "UPDATE usuarios_portal SET intentos_fallidos = 0, bloqueado_hasta = NULL WHERE id = %s",
+        (usuario['id'],)
+    )
+    conn.commit()
+
+    # registrar_acceso: conexión propia
+    conn_audit = conectar(contador)
+    cursor_audit = conn_audit.cursor()
+    cursor_audit.execute(
+        """
+        INSERT INTO historial_accesos
+        (usuario_id, email, receiver_id, tipo_evento, ip_address, user_agent, exitoso, mensaje)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """,
+        (usuario['id'], EMAIL, RECEIVER_ID, 'login_exitoso', IP, USER_AGENT, True, 'Login exitoso')
+    )
+    conn_audit.commit()
+    conn_audit.close()
+
+    # actualizar_ultimo_acceso: conexión propia
+    conn_ultimo = conectar(contador)
+    cursor_ultimo = conn_ultimo.cursor()
+    cursor_ultimo.execute("UPDATE usuarios_portal SET ultimo_acceso = NOW() WHERE id = %s", (usuario['id'],))
+    conn_ultimo.commit()
+    conn_ultimo.close()
+
+    conn.close()
+    return usuario
+
+
+def login_actual(contador, conn):
+    """autenticar_usuario sobre una conexión ya abierta (la del pool) en autocommit"""
+    cursor = conn.cursor()
+    usuario = autenticar_usuario(cursor, EMAIL, RECEIVER_ID, IP, USER_AGENT)
+    cursor.close()
+    assert usuario['resultado'] == 'exitoso', usuario
+    return usuario
+
+
+def medir(nombre, iteraciones, contador, flujo):
+    inicio = time.perf_counter()
+    for _ in range(iteraciones):
+        flujo(contador)
+    total = time.perf_counter() - inicio
+    return {
+        'flujo': nombre,
+        'iteraciones': iteraciones,
+        'round_trips_por_login': round(contador.round_trips / iteraciones, 2),
+        'commits_por_login': round(contador.commits / iteraciones, 2),
+        'conexiones_por_login': round(contador.conexiones / iteraciones, 2),
+        'ms_por_login': round(total * 1000 / iteraciones, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iteraciones', type=int, default=200)
+    parser.add_argument('--rtt-ms', type=float, default=0.0, help='latencia de red simulada por round trip')
+    args = parser.parse_args()
+
+    admin = psycopg2.connect(Config.get_postgres_connection_string())
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO usuarios_portal (receiver_id, email, nombre)
+            VALUES (%s, %s, 'Benchmark login')
+            ON CONFLICT (receiver_id) DO NOTHING
+            """,
+            (RECEIVER_ID, EMAIL)
+        )
+
+    try:
+        antes = medir('anterior', args.iteraciones, Contador(args.rtt_ms), login_anterior)
+
+        # La conexión ya está abierta en el pool: su handshake no cuenta
+        contador = Contador(args.rtt_ms)
+        conn = conectar(contador)
+        conn.autocommit = True
+        contador.round_trips = contador.conexiones = 0
+        despues = medir('autenticar_usuario', args.iteraciones, contador, lambda c: login_actual(c, conn))
+        conn.close()
+    finally:
+        with admin.cursor() as cursor:
+            # historial_accesos se borra en cascada
+            cursor.execute("DELETE FROM usuarios_portal WHERE receiver_id = %s", (RECEIVER_ID,))
+        admin.close()
+
+    print(json.dumps({'rtt_ms': args.rtt_ms, 'resultados': [antes, despues]}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+"""
+Micro-benchmarks de las funciones calientes del portal
+
+Mide con timeit (autorange + repeticiones) sobre datos sintéticos
+deterministas:
+
+- validate_email y validate_pdf_file (primer bloque de la CSF)
+- leer_csf: lectura + SHA-256 de la CSF subida en /procesar-factura
+- base64 de la CSF al entregar el job (entregar_job)
+- construir_cuerpo_n8n: el cuerpo que enviar_a_n8n manda a n8n (json y multipart)
+- buscar_pedido por order_id, pack_id, payment_id y sin coincidencia
+  (requiere PostgreSQL; siembra pedidos BENCH-MICRO-* y los borra al final)
+- render de portal/dashboard.html con 10, 1k y 10k facturas
+
+Cada corrida se guarda en benchmarks/resultados/<commit>.json (con sufijo
+-sucio si hay cambios sin commit). `comparar` enfrenta dos corridas por el
+mínimo por llamada y regresa código 1 si alguna empeora más que --umbral.
+
+Uso:
+    python benchmarks/micro.py [--filtro dashboard] [--sin-db] [--comparar HEAD~1]
+    python benchmarks/micro.py comparar <base> [<nuevo>] [--umbral 0.10]
+
+<base> / <nuevo> pueden ser rutas a un JSON o referencias de git
+(HEAD~1, main, un sha) con su corrida ya guardada; <nuevo> es la corrida
+del commit actual si se omite.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import psycopg2
+from psycopg2.extras import execute_values
+from werkzeug.datastructures import FileStorage
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from app import (  # noqa: E402
+    CSF_CHUNK_SIZE, app, buscar_pedido, construir_cuerpo_n8n, leer_csf, render_template,
+    validate_email, validate_pdf_file
+)
+from config import Config  # noqa: E402
+
+RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resultados')
+PREFIJO = 'BENCH-MICRO-'
+CASOS_DB = ('order_id', 'pack_id', 'payment_id', 'inexistente')
+
+
+# ============================================================================
+# DATOS SINTÉTICOS
+# ============================================================================
+
+def pdf_sintetico(tamano, semilla=0):
+    """PDF con cabecera real y relleno pseudoaleatorio (los PDF reales ya vienen comprimidos)"""
+    generador = random.Random(semilla)
+    cabecera = b'%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n'
+    cola = b'\ntrailer<</Root 1 0 R>>\n%%EOF\n'
+    return cabecera + generador.randbytes(tamano - len(cabecera) - len(cola)) + cola
+
+
+def facturas_sinteticas(cantidad):
+    """Filas con las columnas que usa portal/dashboard.html"""
+    generador = random.Random(cantidad)
+    inicio = datetime(2025, 1, 1)
+    return [
+        {
+            'id': i,
+            'order_id': f'2000{i:09d}',
+            'invoice_id': 50000 + i,
+            'invoice_name': f'INV/2025/{i:05d}' if i % 4 else None,
+            'amount': Decimal(generador.randint(10000, 500000)) / 100,
+            'currency_id': 'MXN',
+            'status': generador.choice(('created', 'sent', 'cancelled')),
+            'payment_status': generador.choice(('pending', 'paid', 'partial')),
+            'created_at': inicio + timedelta(minutes=i),
+            'pdf_url': f'/data/{i}.pdf' if i % 3 else None,
+            'xml_url': f'/data/{i}.xml' if i % 5 else None,
+        }
+        for i in range(cantidad, 0, -1)
+    ]
+
+
+def payload_n8n(csf):
+    """Payload como lo arma procesar_factura, con la CSF como la agrega entregar_job"""
+    return {
+        'order_id': '2000001234567',
+        'paid_amount': 1234.5,
+        'currency_id': 'MXN',
+        'receiver_id': '123456789',
+        'shipping_id': '44000000001',
+        'nombre': 'COMPRADOR_BENCH',
+        'email': 'comprador@example.com',
+        'phone': '5512345678',
+        'cfdi_usage': 'G03',
+        'payment_method': '04',
+        'monto_pagado': 1234.5,
+        'csf_pdf': {'filename': 'csf.pdf', 'mime_type': 'application/pdf', **csf},
+        'timestamp': '2025-01-01T12:00:00',
+        'source': 'portal_flask',
+    }
+
+
+def sembrar_pedidos(conn, cantidad=5000):
+    with conn.cursor() as cursor:
+        execute_values(
+            cursor,
+            "INSERT INTO public.shipment (id, receiver_id, logistic_type) VALUES %s ON CONFLICT DO NOTHING",
+            [(f'{PREFIJO}S{i}', f'{PREFIJO}R{i}', 'fulfillment') for i in range(cantidad)]
+        )
+        execute_values(
+            cursor,
+            """
+            INSERT INTO public.orden_ml
+            (order_id, pack_id, payments_0_id, paid_amount, buyer_nickname, currency_id, shipping_id)
+            VALUES %s ON CONFLICT DO NOTHING
+            """,
+            [(f'{PREFIJO}{i}', f'{PREFIJO}PACK{i}', f'{PREFIJO}PAY{i}', 100 + i, f'bench{i}', 'MXN',
+              f'{PREFIJO}S{i}') for i in range(cantidad)]
+        )
+    conn.commit()
+    return cantidad
+
+
+def limpiar_pedidos(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM public.orden_ml WHERE order_id LIKE %s", (PREFIJO + '%',))
+        cursor.execute("DELETE FROM public.shipment WHERE id LIKE %s", (PREFIJO + '%',))
+    conn.commit()
+
+
+# ============================================================================
+# BENCHMARKS
+# ============================================================================
+
+def cuerpo_con_transporte(transporte, payload):
+    """construir_cuerpo_n8n con N8N_TRANSPORT fijo, sin importar la configuración local"""
+    anterior = Config.N8N_TRANSPORT
+    Config.N8N_TRANSPORT = transporte
+    try:
+        return construir_cuerpo_n8n(payload)[0]
+    finally:
+        Config.N8N_TRANSPORT = anterior
+
+
+def benchmarks_sin_db():
+    """[(nombre, funcion)] que no necesitan PostgreSQL"""
+    emails = ['cliente.frecuente+ml@example.com.mx', 'sin-arroba.example.com', 'a@b.c', 'x' * 64 + '@dominio.mx']
+    casos = []
+
+    casos.append(('validate_email', lambda: [validate_email(e) for e in emails]))
+
+    pdf = pdf_sintetico(2 * 1024 * 1024)
+    primer_bloque = pdf[:CSF_CHUNK_SIZE]
+    no_pdf = b'PK\x03\x04' + primer_bloque[4:]
+    casos.append(('validate_pdf_file[pdf]', lambda: validate_pdf_file(primer_bloque)))
+    casos.append(('validate_pdf_file[zip]', lambda: validate_pdf_file(no_pdf)))
+
+    for etiqueta, tamano in (('200k', 200 * 1024), ('2m', 2 * 1024 * 1024)):
+        contenido = pdf_sintetico(tamano, semilla=tamano)
+
+        def leer(contenido=contenido):
+            csf = leer_csf(FileStorage(stream=io.BytesIO(contenido), filename='csf.pdf'))
+            csf['stream'].close()
+            return csf
+
+        casos.append((f'leer_csf[{etiqueta}]', leer))
+
+    contenido = pdf_sintetico(2 * 1024 * 1024, semilla=1)
+    casos.append(('entregar_job.base64[2m]', lambda: base64.b64encode(contenido).decode('ascii')))
+
+    csf = {'size': len(contenido), 'sha256': '0' * 64}
+    payload_json = payload_n8n({**csf, 'content': base64.b64encode(contenido).decode('ascii')})
+    casos.append(('construir_cuerpo_n8n[json,2m]', lambda: cuerpo_con_transporte('json', payload_json)))
+
+    def cuerpo_multipart():
+        body = cuerpo_con_transporte('multipart', payload_n8n({**csf, 'stream': io.BytesIO(contenido)}))
+        # El costo real incluye leer el cuerpo completo (lo hace requests al enviar)
+        while body.read(CSF_CHUNK_SIZE):
+            pass
+
+    casos.append(('construir_cuerpo_n8n[multipart,2m]', cuerpo_multipart))
+
+    stats = {'total_facturas': 0, 'monto_total': Decimal('0'), 'facturas_pendientes': 0, 'facturas_pagadas': 0}
+    for cantidad, etiqueta in ((10, '10'), (1000, '1k'), (10000, '10k')):
+        facturas = facturas_sinteticas(cantidad)
+
+        def render(facturas=facturas):
+            with app.test_request_context('/portal/dashboard'):
+                return render_template('portal/dashboard.html', facturas=facturas, siguiente_cursor='x',
+                                       stats=stats, notificaciones_count=3)
+
+        casos.append((f'dashboard.html[{etiqueta}]', render))
+
+    return casos
+
+
+def benchmarks_db(cantidad):
+    """[(nombre, funcion)] de buscar_pedido sobre los pedidos sembrados"""
+    mitad = cantidad // 2
+    busquedas = {
+        'order_id': f'{PREFIJO}{mitad}',
+        'pack_id': f'{PREFIJO}PACK{mitad}',
+        'payment_id': f'{PREFIJO}PAY{mitad}',
+        'inexistente': f'{PREFIJO}NO-EXISTE',
+    }
+
+    def buscar(search_id, esperado):
+        def funcion():
+            pedido = buscar_pedido(search_id)
+            assert (pedido is not None) == esperado, search_id
+        return funcion
+
+    return [(f'buscar_pedido[{caso}]', buscar(busquedas[caso], caso != 'inexistente')) for caso in CASOS_DB]
+
+
+def medir(funcion, repeticiones, min_tiempo):
+    """Segundos por llamada de cada repetición (timeit elige cuántas llamadas por repetición)"""
+    timer = timeit.Timer(funcion)
+    numero = 1
+    while True:
+        tiempo = timer.timeit(numero)
+        if tiempo >= min_tiempo:
+            break
+        numero = max(numero * 2, int(numero * min_tiempo / max(tiempo, 1e-9) * 1.1))
+    tiempos = [tiempo / numero] + [timer.timeit(numero) / numero for _ in range(repeticiones - 1)]
+    tiempos.sort()
+    return {
+        'llamadas_por_repeticion': numero,
+        'repeticiones': repeticiones,
+        'min_us': round(tiempos[0] * 1e6, 3),
+        'mediana_us': round(tiempos[len(tiempos) // 2] * 1e6, 3),
+        'max_us': round(tiempos[-1] * 1e6, 3),
+    }
+
+
+# ============================================================================
+# RESULTADOS
+# ============================================================================
+
+def _git(*argumentos):
+    try:
+        return subprocess.run(['git', *argumentos], cwd=RAIZ, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def commit_actual():
+    """(sha, sucio) del árbol de trabajo; los resultados de benchmarks/ no cuentan como cambios"""
+    sha = _git('rev-parse', 'HEAD')
+    cambios = _git('status', '--porcelain', '--untracked-files=no', '--', '.', ':!benchmarks/resultados')
+    return sha, bool(cambios)
+
+
+def ruta_resultado(referencia):
+    """Ruta de un JSON existente o de la corrida guardada para una referencia de git"""
+    if os.path.isfile(referencia):
+        return referencia
+    sha = _git('rev-parse', '--verify', f'{referencia}^{{commit}}')
+    if sha is None:
+        raise SystemExit(f'No existe el archivo ni la referencia de git: {referencia}')
+    for nombre in (f'{sha}.json', f'{sha}-sucio.json'):
+        ruta = os.path.join(RESULTADOS, nombre)
+        if os.path.isfile(ruta):
+            return ruta
+    raise SystemExit(f'No hay corrida guardada para {referencia} ({sha[:12]}); '
+                     f'haz checkout de ese commit y corre benchmarks/micro.py')
+
+
+def comparar(base, nuevo, umbral):
+    """Tabla base vs nuevo por el mínimo por llamada; True si hay regresiones"""
+    regresiones = []
+    filas = []
+    for nombre, actual in nuevo['resultados'].items():
+        anterior = base['resultados'].get(nombre)
+        if anterior is None:
+            filas.append((nombre, None, actual['min_us'], None, 'nuevo'))
+            continue
+        cambio = actual['min_us'] / anterior['min_us'] - 1
+        marca = ''
+        if cambio > umbral:
+            marca = 'REGRESIÓN'
+            regresiones.append(nombre)
+        elif cambio < -umbral:
+            marca = 'mejora'
+        filas.append((nombre, anterior['min_us'], actual['min_us'], cambio, marca))
+
+    ancho = max(len(f[0]) for f in filas) if filas else 10
+    print(f"base:  {base['commit'][:12]}{' (sucio)' if base['sucio'] else ''}  {base['fecha']}")
+    print(f"nuevo: {nuevo['commit'][:12]}{' (sucio)' if nuevo['sucio'] else ''}  {nuevo['fecha']}")
+    print(f"{'benchmark':<{ancho}}  {'base µs':>12}  {'nuevo µs':>12}  {'cambio':>8}")
+    for nombre, anterior, actual, cambio, marca in filas:
+        anterior_txt = f'{anterior:12.2f}' if anterior is not None else f"{'-':>12}"
+        cambio_txt = f'{cambio:+8.1%}' if cambio is not None else f"{'-':>8}"
+        print(f'{nombre:<{ancho}}  {anterior_txt}  {actual:12.2f}  {cambio_txt}  {marca}')
+    for nombre in sorted(base['resultados'].keys() - nuevo['resultados'].keys()):
+        print(f'{nombre:<{ancho}}  (no se corrió en la versión nueva)')
+
+    return bool(regresiones)
+
+
+def cargar(ruta):
+    with open(ruta, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def correr(args):
+    casos = [c for c in benchmarks_sin_db() if args.filtro in c[0]]
+
+    conn = None
+    if not args.sin_db and any(args.filtro in f'buscar_pedido[{caso}]' for caso in CASOS_DB):
+        try:
+            conn = psycopg2.connect(Config.get_postgres_connection_string())
+        except psycopg2.Error as e:
+            print(f'PostgreSQL no disponible, se omite buscar_pedido: {e}', file=sys.stderr)
+
+    resultados = {}
+    try:
+        if conn is not None:
+            limpiar_pedidos(conn)
+            casos += [c for c in benchmarks_db(sembrar_pedidos(conn)) if args.filtro in c[0]]
+
+        for nombre, funcion in casos:
+            resultados[nombre] = medir(funcion, args.repeticiones, args.min_tiempo)
+            print(f"{nombre:<40} {resultados[nombre]['min_us']:>14.2f} µs", file=sys.stderr)
+    finally:
+        if conn is not None:
+            limpiar_pedidos(conn)
+            conn.close()
+
+    sha, sucio = commit_actual()
+    corrida = {
+        'commit': sha or 'desconocido',
+        'sucio': sucio,
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'procesador': platform.processor() or platform.machine(),
+        'resultados': resultados,
+    }
+
+    salida = args.salida
+    if salida is None and sha:
+        os.makedirs(RESULTADOS, exist_ok=True)
+        salida = os.path.join(RESULTADOS, f"{sha}{'-sucio' if sucio else ''}.json")
+    if salida:
+        with open(salida, 'w', encoding='utf-8') as f:
+            json.dump(corrida, f, indent=2, ensure_ascii=False)
+        print(f'Resultados guardados en {salida}', file=sys.stderr)
+
+    if args.comparar:
+        return 1 if comparar(cargar(ruta_resultado(args.comparar)), corrida, args.umbral) else 0
+
+    print(json.dumps(corrida, indent=2, ensure_ascii=False))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ayuda_umbral = 'empeoramiento tolerado al comparar (0.10 = 10%%)'
+    subparsers = parser.add_subparsers(dest='comando')
+
+    parser_comparar = subparsers.add_parser('comparar', help='comparar dos corridas guardadas')
+    parser_comparar.add_argument('base')
+    parser_comparar.add_argument('nuevo', nargs='?')
+    parser_comparar.add_argument('--umbral', type=float, default=0.10, help=ayuda_umbral)
+
+    parser.add_argument('--filtro', default='', help='solo benchmarks cuyo nombre contenga este texto')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--min-tiempo', type=float, default=0.2, help='segundos mínimos por repetición')
+    parser.add_argument('--sin-db', action='store_true', help='omitir buscar_pedido')
+    parser.add_argument('--salida', help='archivo de resultados (por defecto benchmarks/resultados/<commit>.json)')
+    parser.add_argument('--comparar', metavar='BASE', help='al terminar, comparar contra esta corrida')
+    parser.add_argument('--umbral', type=float, default=0.10, help=ayuda_umbral)
+    args = parser.parse_args()
+
+    if args.comando == 'comparar':
+        base = cargar(ruta_resultado(args.base))
+        nuevo = cargar(ruta_resultado(args.nuevo or 'HEAD'))
+        sys.exit(1 if comparar(base, nuevo, args.umbral) else 0)
+
+    sys.exit(correr(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,28 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
     UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', '/tmp/uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    DOCUMENTOS_FOLDER = os.getenv('DOCUMENTOS_FOLDER', os.path.join(UPLOAD_FOLDER, 'documentos'))  # PDF/XML timbrados por SHA-256
+    PROXY_X_FOR = int(os.getenv('PROXY_X_FOR', '1'))  # proxies (ingress, nginx) que agregan X-Forwarded-For; 0: IP de la conexión
+
+    # Modo de servicio (ver gunicorn.conf.py): 'hilos' (workers gthread) o 'async'
+    # (workers gevent: cada request es una greenlet y psycopg2/requests ceden el
+    # control mientras esperan a Postgres o n8n). Cambia los valores por defecto
+    # de los límites de concurrencia de abajo.
+    SERVIDOR_MODO = os.getenv('SERVIDOR_MODO', 'hilos').lower()
+    SERVIDOR_ASYNC = SERVIDOR_MODO == 'async'
+
+    # Descargas de PDF/XML: '' (send_file desde el worker), 'nginx' (X-Accel-Redirect) o 'sendfile' (X-Sendfile)
+    DESCARGAS_OFFLOAD = os.getenv('DESCARGAS_OFFLOAD', '').lower()
+    DESCARGAS_ACCEL_PREFIX = os.getenv('DESCARGAS_ACCEL_PREFIX', '/_documentos/')  # location internal de nginx -> DOCUMENTOS_FOLDER
+
+    # Logging: JSON lines escritos por un hilo aparte (QueueListener)
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()  # json | texto
+    LOG_FILE = os.getenv('LOG_FILE', '')  # ruta del archivo rotativo; vacío: solo stdout
+    LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024)))  # rotación por tamaño
+    LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+    LOG_DEBUG_SAMPLE = float(os.getenv('LOG_DEBUG_SAMPLE', '0'))  # fracción de requests con detalle DEBUG (0 a 1)
+    LOG_QUEUE_MAX = int(os.getenv('LOG_QUEUE_MAX', '10000'))  # registros en espera antes de descartar
 
     # PostgreSQL - Base de datos de Mercado Libre
     POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
@@ -23,11 +45,89 @@ class Config:
     POSTGRES_USER = os.getenv('POSTGRES_USER', 'dml')
     POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'password_placeholder')
 
+    # Pool de conexiones PostgreSQL (por proceso / worker de gunicorn)
+    DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+    DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10' if SERVIDOR_ASYNC else '5'))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))  # segundos esperando una conexión libre
+    DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTHCHECK_INTERVAL', '30'))  # ping si estuvo ociosa más de N segundos
+    DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+
     # n8n - Orquestador de Workflows
     N8N_WEBHOOK_URL = os.getenv('N8N_WEBHOOK_URL', 'https://your-n8n-instance.com/webhook/facturacion')
+    N8N_TIMEOUT = int(os.getenv('N8N_TIMEOUT', '60'))  # n8n puede tardar procesando Odoo
+    N8N_CONNECT_TIMEOUT = float(os.getenv('N8N_CONNECT_TIMEOUT', '5'))  # establecer la conexión TCP/TLS
+
+    # Sesión HTTP persistente hacia n8n (keep-alive, por proceso)
+    N8N_HTTP_POOL_SIZE = int(os.getenv('N8N_HTTP_POOL_SIZE', '256' if SERVIDOR_ASYNC else '4'))  # conexiones keep-alive
+    N8N_HTTP_CONNECT_RETRIES = int(os.getenv('N8N_HTTP_CONNECT_RETRIES', '2'))  # solo errores de conexión
+    N8N_HTTP_RETRY_BACKOFF = float(os.getenv('N8N_HTTP_RETRY_BACKOFF', '0.3'))
+
+    # Transporte hacia n8n: 'json' (CSF en base64 dentro del JSON) o
+    # 'multipart' (metadata JSON + CSF binaria como multipart/form-data)
+    N8N_TRANSPORT = os.getenv('N8N_TRANSPORT', 'json').lower()
+    N8N_GZIP_METADATA = os.getenv('N8N_GZIP_METADATA', 'false').lower() in ('1', 'true', 'yes')
+    CSF_SPOOL_MAX_MEMORY = 1024 * 1024  # CSF en memoria hasta 1MB, después a archivo temporal local
+
+    # Envío a n8n en segundo plano (por worker de gunicorn)
+    N8N_EXECUTOR_WORKERS = int(os.getenv('N8N_EXECUTOR_WORKERS', '256' if SERVIDOR_ASYNC else '4'))  # envíos simultáneos (greenlets en modo async)
+    N8N_EXECUTOR_QUEUE = int(os.getenv('N8N_EXECUTOR_QUEUE', '256' if SERVIDOR_ASYNC else '20'))  # envíos en espera antes de rechazar
+
+    # Outbox durable de envíos a n8n (worker: python outbox_worker.py)
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '10'))  # jobs reclamados por vuelta (a lo más OUTBOX_CONCURRENCIA)
+    OUTBOX_CONCURRENCIA = int(os.getenv('OUTBOX_CONCURRENCIA', '4'))  # envíos simultáneos por worker
+    OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))  # segundos sin trabajo antes de volver a consultar
+    OUTBOX_MAX_INTENTOS = int(os.getenv('OUTBOX_MAX_INTENTOS', '8'))
+    OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '30'))  # 30s, 1m, 2m, 4m... (con jitter)
+    OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '3600'))
+    OUTBOX_ESPERA_INDETERMINADO = float(os.getenv('OUTBOX_ESPERA_INDETERMINADO', '300'))  # tras timeout de lectura o 5xx, espera mínima antes de revisar facturas y reenviar
+    OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', str(N8N_TIMEOUT + 60)))  # tras N segundos un job 'enviando' se considera abandonado
+    OUTBOX_GRACIA = float(os.getenv('OUTBOX_GRACIA', '30'))  # el worker no toca jobs nuevos durante N segundos (los envía el web)
+    OUTBOX_RETENCION_CSF_DIAS = int(os.getenv('OUTBOX_RETENCION_CSF_DIAS', '7'))  # CSF de jobs terminados
+    IDEMPOTENCIA_VENTANA = int(os.getenv('IDEMPOTENCIA_VENTANA', str(24 * 3600)))  # segundos que una solicitud completada responde a sus duplicados
+
+    # Auditoría de accesos (historial_accesos) escrita en lotes por worker
+    AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '100'))
+    AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '1'))  # segundos máx. antes de escribir
+    AUDIT_QUEUE_MAX = int(os.getenv('AUDIT_QUEUE_MAX', '10000'))  # eventos en espera antes de descartar
+
+    # Webhooks de estado desde n8n (facturacion_estados)
+    WEBHOOK_ESTADOS_MAX_LOTE = int(os.getenv('WEBHOOK_ESTADOS_MAX_LOTE', '500'))  # estados por petición
+
+    # Sesiones en el servidor (tabla sesiones_portal): la cookie solo lleva un token
+    SESIONES_SERVIDOR = os.getenv('SESIONES_SERVIDOR', 'true').lower() in ('1', 'true', 'yes')  # false: cookie firmada de Flask
+    SESION_DURACION = int(os.getenv('SESION_DURACION', str(8 * 3600)))  # segundos de inactividad antes de expirar
+    SESION_TOQUE_INTERVALO = float(os.getenv('SESION_TOQUE_INTERVALO', '300'))  # renovar la expiración como máximo cada N segundos
+    SESION_CACHE_TTL = float(os.getenv('SESION_CACHE_TTL', '30'))  # también es lo máximo que tarda en aplicar una revocación
+    SESION_CACHE_MAX = int(os.getenv('SESION_CACHE_MAX', '10000'))  # sesiones en cache por proceso
+    SESION_PURGA_LOTE = 5000  # filas por DELETE al purgar
+
+    # Límite de intentos de login (contadores compartidos en login_limites)
+    LOGIN_VENTANA = int(os.getenv('LOGIN_VENTANA', '900'))  # segundos de la ventana deslizante
+    LOGIN_MAX_POR_EMAIL = int(os.getenv('LOGIN_MAX_POR_EMAIL', '5'))  # fallos por email antes de bloquear la cuenta
+    LOGIN_MAX_POR_IP = int(os.getenv('LOGIN_MAX_POR_IP', '30'))  # fallos por IP antes de bloquearla
+    LOGIN_BLOQUEO = int(os.getenv('LOGIN_BLOQUEO', '900'))  # segundos de bloqueo
+    LOGIN_SYNC_INTERVAL = float(os.getenv('LOGIN_SYNC_INTERVAL', '1'))  # segundos entre sincronizaciones con la BD
+    LOGIN_MAX_CLAVES = 100000  # claves (IPs + emails) en memoria por proceso
+
+    # Búsqueda de pedidos en lote (POST /api/pedidos/lookup)
+    PEDIDOS_LOOKUP_MAX_LOTE = int(os.getenv('PEDIDOS_LOOKUP_MAX_LOTE', '500'))  # IDs por petición
+    PEDIDOS_API_TOKEN = os.getenv('PEDIDOS_API_TOKEN', '')  # Bearer de /api/pedidos/lookup y /api/sistema/stats; vacío: rutas deshabilitadas (401)
+
+    # Facturación masiva (una CSF + CSV de pedidos)
+    MASIVA_MAX_FILAS = int(os.getenv('MASIVA_MAX_FILAS', '500'))  # pedidos por CSV
+    MASIVA_LOTE_VALIDACION = 100  # renglones validados por consulta a orden_ml
+    MASIVA_CONCURRENCIA = int(os.getenv('MASIVA_CONCURRENCIA', '2'))  # jobs del lote que quedan listos por intervalo
+    MASIVA_INTERVALO = float(os.getenv('MASIVA_INTERVALO', '5'))  # segundos entre cada grupo de MASIVA_CONCURRENCIA jobs
 
     # Portal de Usuarios - URL pública
     PORTAL_URL = os.getenv('PORTAL_URL', 'http://localhost:5000/portal/login')
+    PORTAL_FACTURAS_POR_PAGINA = int(os.getenv('PORTAL_FACTURAS_POR_PAGINA', '25'))  # dashboard / scroll infinito
+    PORTAL_FACTURAS_MAX_POR_PAGINA = 100
+
+    # Eventos en vivo (SSE) - cada stream ocupa un hilo de gunicorn (gthread) o una greenlet (async)
+    SSE_HEARTBEAT = float(os.getenv('SSE_HEARTBEAT', '20'))  # ping para proxies/ingress
+    SSE_MAX_DURACION = float(os.getenv('SSE_MAX_DURACION', '300'))  # el navegador reconecta solo
+    SSE_MAX_CONEXIONES = int(os.getenv('SSE_MAX_CONEXIONES', '1000' if SERVIDOR_ASYNC else '48'))  # streams por worker; debe ser < --threads (o worker_connections)
 
     # Catálogos SAT (opciones para los selectores)
     CFDI_USAGE_OPTIONS = [
@@ -48,4 +148,4 @@ class Config:
     @staticmethod
     def get_postgres_connection_string():
         """Retorna el string de conexión para PostgreSQL"""
-        return f"host={Config.POSTGRES_HOST} port={Config.POSTGRES_PORT} dbname={Config.POSTGRES_DB} user={Config.POSTGRES_USER} password={Config.POSTGRES_PASSWORD}"
+        return f"host={Config.POSTGRES_HOST} port={Config.POSTGRES_PORT} dbname={Config.POSTGRES_DB} user={Config.POSTGRES_USER} password={Config.POSTGRES_PASSWORD} connect_timeout={Config.DB_CONNECT_TIMEOUT}"
@@ -111,6 +111,11 @@ CREATE INDEX idx_facturas_status ON facturas(status);
 CREATE INDEX idx_facturas_payment_status ON facturas(payment_status);
 CREATE INDEX idx_facturas_email ON facturas(email);
 CREATE INDEX idx_facturas_created_at ON facturas(created_at DESC);
+-- Paginación por keyset del dashboard: WHERE usuario_id = ? AND (COALESCE(created_at, 'epoch'), id) < (?, ?)
+-- (created_at admite NULL: esas facturas quedan al final con la fecha 'epoch')
+DROP INDEX IF EXISTS idx_facturas_usuario_created_id;
+CREATE INDEX IF NOT EXISTS idx_facturas_usuario_orden
+    ON facturas(usuario_id, (COALESCE(created_at, TIMESTAMP 'epoch')) DESC, id DESC);
 
 -- =====================================================
 -- 3. TABLA: sesiones_portal
@@ -132,6 +137,12 @@ CREATE INDEX idx_sesiones_usuario_id ON sesiones_portal(usuario_id);
 CREATE INDEX idx_sesiones_token ON sesiones_portal(session_token);
 CREATE INDEX idx_sesiones_activa ON sesiones_portal(activa);
 
+-- Sesiones de Flask en el servidor (SesionesPostgres en app.py): session_token
+-- es el SHA-256 del token de la cookie y datos el contenido de la sesión
+ALTER TABLE sesiones_portal ADD COLUMN IF NOT EXISTS datos JSONB NOT NULL DEFAULT '{}';
+-- Purga en lotes de sesiones vencidas (purgar_sesiones_expiradas)
+CREATE INDEX IF NOT EXISTS idx_sesiones_expiracion ON sesiones_portal(fecha_expiracion);
+
 -- =====================================================
 -- 4. TABLA: historial_accesos
 -- Log de accesos al portal
@@ -284,7 +295,439 @@ COMMENT ON COLUMN facturas.status IS 'Estado: created, sent, paid, cancelled, er
 COMMENT ON COLUMN facturas.payment_status IS 'Estado de pago: pending, partial, paid, overdue';
 
 -- =====================================================
--- 9. PERMISOS (AJUSTAR SEGÚN TU CONFIGURACIÓN)
+-- 9. TABLA: orden_lookup
+-- Índice de búsqueda de pedidos: cualquier order_id, pack_id o
+-- payment_id se resuelve con una sola búsqueda por índice.
+-- Se mantiene sincronizada con orden_ml mediante trigger.
+-- =====================================================
+
+-- Se crea a partir de orden_ml para que order_id tenga exactamente
+-- el mismo tipo que orden_ml.order_id (el JOIN usa su índice)
+CREATE TABLE IF NOT EXISTS orden_lookup AS
+SELECT
+    order_id::text AS key,          -- ID que escribe el cliente
+    'order'::varchar(10) AS kind,   -- order, pack, payment
+    order_id,                       -- orden_ml.order_id al que apunta
+    1::smallint AS prioridad        -- 1=order, 2=pack, 3=payment
+FROM orden_ml
+WITH NO DATA;
+
+ALTER TABLE orden_lookup
+    ALTER COLUMN key SET NOT NULL,
+    ALTER COLUMN kind SET NOT NULL,
+    ALTER COLUMN order_id SET NOT NULL,
+    ALTER COLUMN prioridad SET NOT NULL;
+
+-- (key, prioridad) primero: la búsqueda toma la primera fila del índice
+CREATE UNIQUE INDEX IF NOT EXISTS idx_orden_lookup_key ON orden_lookup(key, prioridad, order_id);
+CREATE INDEX IF NOT EXISTS idx_orden_lookup_order_id ON orden_lookup(order_id);
+
+-- Función para mantener orden_lookup al insertar/modificar/borrar en orden_ml
+CREATE OR REPLACE FUNCTION sync_orden_lookup()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM orden_lookup WHERE order_id = OLD.order_id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO orden_lookup (key, kind, order_id, prioridad)
+        SELECT k.key, k.kind, NEW.order_id, k.prioridad
+        FROM (VALUES
+            (NEW.order_id::text, 'order', 1),
+            (NEW.pack_id::text, 'pack', 2),
+            (NEW.payments_0_id::text, 'payment', 3)
+        ) AS k(key, kind, prioridad)
+        WHERE k.key IS NOT NULL AND k.key <> ''
+        ON CONFLICT DO NOTHING;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_sync_orden_lookup ON orden_ml;
+CREATE TRIGGER trigger_sync_orden_lookup
+    AFTER INSERT OR DELETE OR UPDATE OF order_id, pack_id, payments_0_id ON orden_ml
+    FOR EACH ROW
+    EXECUTE FUNCTION sync_orden_lookup();
+
+-- Carga inicial (idempotente) con los pedidos existentes
+INSERT INTO orden_lookup (key, kind, order_id, prioridad)
+SELECT k.key, k.kind, o.order_id, k.prioridad
+FROM orden_ml o
+CROSS JOIN LATERAL (VALUES
+    (o.order_id::text, 'order', 1),
+    (o.pack_id::text, 'pack', 2),
+    (o.payments_0_id::text, 'payment', 3)
+) AS k(key, kind, prioridad)
+WHERE k.key IS NOT NULL AND k.key <> ''
+ON CONFLICT DO NOTHING;
+
+COMMENT ON TABLE orden_lookup IS 'Índice de búsqueda de pedidos por order_id, pack_id o payment_id (sincronizado por trigger)';
+
+-- =====================================================
+-- 10. TABLA: facturacion_jobs
+-- Solicitudes de factura enviadas a n8n en segundo plano.
+-- La página de éxito consulta su estado vía /api/facturas/jobs/<id>
+-- =====================================================
+CREATE TABLE IF NOT EXISTS facturacion_jobs (
+    id UUID PRIMARY KEY,
+    order_id VARCHAR(50) NOT NULL,
+    email VARCHAR(255),
+    status VARCHAR(20) NOT NULL DEFAULT 'pendiente',  -- pendiente, enviando, completado, rechazado, error
+    mensaje TEXT,  -- Mensaje para mostrar al cliente
+    respuesta JSONB,  -- Respuesta completa de n8n
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_facturacion_jobs_order_id ON facturacion_jobs(order_id);
+CREATE INDEX IF NOT EXISTS idx_facturacion_jobs_created_at ON facturacion_jobs(created_at DESC);
+
+DROP TRIGGER IF EXISTS update_facturacion_jobs_updated_at ON facturacion_jobs;
+CREATE TRIGGER update_facturacion_jobs_updated_at
+    BEFORE UPDATE ON facturacion_jobs
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+COMMENT ON TABLE facturacion_jobs IS 'Solicitudes de factura enviadas a n8n en segundo plano';
+COMMENT ON COLUMN facturacion_jobs.status IS 'Estado: pendiente, enviando, completado, rechazado (n8n respondió success=false), error';
+
+-- =====================================================
+-- 11. OUTBOX DE ENVÍOS A N8N
+-- facturacion_jobs guarda el payload completo para que una
+-- solicitud no se pierda si n8n está caído. El envío inmediato
+-- lo hace el web; los reintentos, outbox_worker.py.
+-- Varios workers reclaman jobs con FOR UPDATE SKIP LOCKED.
+-- =====================================================
+CREATE TABLE IF NOT EXISTS csf_documentos (
+    sha256 CHAR(64) PRIMARY KEY,
+    contenido_oid OID,  -- Large object con el PDF (se escribe por bloques; la purga hace lo_unlink)
+    contenido BYTEA,  -- Solo filas guardadas antes de contenido_oid
+    mime_type VARCHAR(100) NOT NULL DEFAULT 'application/pdf',
+    size INTEGER NOT NULL,
+    ultimo_uso_at TIMESTAMP DEFAULT NOW()  -- Se renueva al reutilizarla; la purga respeta la retención desde aquí
+);
+
+-- Bases creadas con contenido BYTEA NOT NULL: las filas existentes se siguen leyendo de ahí
+ALTER TABLE csf_documentos ADD COLUMN IF NOT EXISTS contenido_oid OID;
+ALTER TABLE csf_documentos ALTER COLUMN contenido DROP NOT NULL;
+
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS payload JSONB;  -- Payload para n8n sin el contenido del PDF
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS csf_sha256 CHAR(64);  -- csf_documentos.sha256 (se purga tras la retención)
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS intentos INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS proximo_intento_at TIMESTAMP DEFAULT NOW();
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS bloqueado_por VARCHAR(100);  -- Token del envío en curso
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS bloqueado_hasta TIMESTAMP;  -- Fin del lease; después otro worker puede reclamarlo
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS n8n_status_code INTEGER;
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS ultimo_error TEXT;
+
+-- Jobs listos para enviar y envíos abandonados (lease vencido)
+CREATE INDEX IF NOT EXISTS idx_facturacion_jobs_outbox ON facturacion_jobs(proximo_intento_at)
+    WHERE status IN ('pendiente', 'reintentando');
+CREATE INDEX IF NOT EXISTS idx_facturacion_jobs_lease ON facturacion_jobs(bloqueado_hasta)
+    WHERE status = 'enviando';
+CREATE INDEX IF NOT EXISTS idx_facturacion_jobs_csf ON facturacion_jobs(csf_sha256);
+
+-- Idempotencia: sha256(order_id:sha256 de la CSF). Un reenvío de la misma
+-- solicitud se une al job en curso o al completado en IDEMPOTENCIA_VENTANA
+ALTER TABLE facturacion_jobs ADD COLUMN IF NOT EXISTS clave_idempotencia CHAR(64);
+CREATE INDEX IF NOT EXISTS idx_facturacion_jobs_idempotencia
+    ON facturacion_jobs(clave_idempotencia, created_at DESC)
+    WHERE clave_idempotencia IS NOT NULL;
+
+COMMENT ON TABLE csf_documentos IS 'Constancias de Situación Fiscal pendientes de envío a n8n, una vez por contenido (sha256)';
+COMMENT ON COLUMN facturacion_jobs.status IS 'Estado: pendiente, enviando, reintentando (n8n no disponible), completado, rechazado (n8n respondió success=false), error';
+
+-- =====================================================
+-- 12. RESUMEN DE FACTURAS POR USUARIO
+-- Contadores del dashboard y de /api/portal/facturas/stats
+-- mantenidos por trigger: leerlos es una búsqueda por PK
+-- en lugar de agregar todas las facturas del usuario.
+-- =====================================================
+CREATE TABLE IF NOT EXISTS facturas_resumen_usuario (
+    usuario_id INTEGER PRIMARY KEY REFERENCES usuarios_portal(id) ON DELETE CASCADE,
+    total_facturas INTEGER NOT NULL DEFAULT 0,
+    monto_total DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    facturas_pendientes INTEGER NOT NULL DEFAULT 0,
+    facturas_pagadas INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS facturas_resumen_mensual (
+    usuario_id INTEGER NOT NULL REFERENCES usuarios_portal(id) ON DELETE CASCADE,
+    mes DATE NOT NULL,  -- Primer día del mes (DATE_TRUNC('month', created_at))
+    total INTEGER NOT NULL DEFAULT 0,
+    monto_total DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    pagadas INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario_id, mes)
+);
+
+-- Suma (signo = 1) o resta (signo = -1) la aportación de una factura a los resúmenes
+CREATE OR REPLACE FUNCTION aplicar_resumen_factura(
+    p_usuario_id INTEGER, p_created_at TIMESTAMP, p_amount DECIMAL, p_payment_status VARCHAR, signo INTEGER
+) RETURNS VOID AS $$
+BEGIN
+    IF p_usuario_id IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO facturas_resumen_usuario AS r
+        (usuario_id, total_facturas, monto_total, facturas_pendientes, facturas_pagadas)
+    VALUES (
+        p_usuario_id,
+        signo,
+        signo * p_amount,
+        CASE WHEN p_payment_status = 'pending' THEN signo ELSE 0 END,
+        CASE WHEN p_payment_status = 'paid' THEN signo ELSE 0 END
+    )
+    ON CONFLICT (usuario_id) DO UPDATE SET
+        total_facturas = r.total_facturas + EXCLUDED.total_facturas,
+        monto_total = r.monto_total + EXCLUDED.monto_total,
+        facturas_pendientes = r.facturas_pendientes + EXCLUDED.facturas_pendientes,
+        facturas_pagadas = r.facturas_pagadas + EXCLUDED.facturas_pagadas,
+        updated_at = NOW();
+
+    IF p_created_at IS NOT NULL THEN
+        INSERT INTO facturas_resumen_mensual AS r (usuario_id, mes, total, monto_total, pagadas)
+        VALUES (
+            p_usuario_id,
+            DATE_TRUNC('month', p_created_at)::date,
+            signo,
+            signo * p_amount,
+            CASE WHEN p_payment_status = 'paid' THEN signo ELSE 0 END
+        )
+        ON CONFLICT (usuario_id, mes) DO UPDATE SET
+            total = r.total + EXCLUDED.total,
+            monto_total = r.monto_total + EXCLUDED.monto_total,
+            pagadas = r.pagadas + EXCLUDED.pagadas;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sync_facturas_resumen()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+       AND NEW.usuario_id IS NOT DISTINCT FROM OLD.usuario_id
+       AND NEW.amount = OLD.amount
+       AND NEW.payment_status IS NOT DISTINCT FROM OLD.payment_status
+       AND NEW.created_at IS NOT DISTINCT FROM OLD.created_at THEN
+        RETURN NULL;  -- Cambio que no afecta los contadores
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM aplicar_resumen_factura(OLD.usuario_id, OLD.created_at, OLD.amount, OLD.payment_status, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM aplicar_resumen_factura(NEW.usuario_id, NEW.created_at, NEW.amount, NEW.payment_status, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Trigger y carga inicial en una transacción: ninguna factura queda fuera ni contada dos veces
+BEGIN;
+LOCK TABLE facturas IN SHARE ROW EXCLUSIVE MODE;
+
+DROP TRIGGER IF EXISTS trigger_facturas_resumen ON facturas;
+CREATE TRIGGER trigger_facturas_resumen
+    AFTER INSERT OR DELETE OR UPDATE OF usuario_id, amount, payment_status, created_at ON facturas
+    FOR EACH ROW
+    EXECUTE FUNCTION sync_facturas_resumen();
+
+DELETE FROM facturas_resumen_usuario;
+INSERT INTO facturas_resumen_usuario (usuario_id, total_facturas, monto_total, facturas_pendientes, facturas_pagadas)
+SELECT
+    usuario_id,
+    COUNT(*),
+    SUM(amount),
+    COUNT(*) FILTER (WHERE payment_status = 'pending'),
+    COUNT(*) FILTER (WHERE payment_status = 'paid')
+FROM facturas
+WHERE usuario_id IS NOT NULL
+GROUP BY usuario_id;
+
+DELETE FROM facturas_resumen_mensual;
+INSERT INTO facturas_resumen_mensual (usuario_id, mes, total, monto_total, pagadas)
+SELECT
+    usuario_id,
+    DATE_TRUNC('month', created_at)::date,
+    COUNT(*),
+    SUM(amount),
+    COUNT(*) FILTER (WHERE payment_status = 'paid')
+FROM facturas
+WHERE usuario_id IS NOT NULL AND created_at IS NOT NULL
+GROUP BY usuario_id, DATE_TRUNC('month', created_at)::date;
+COMMIT;
+
+COMMENT ON TABLE facturas_resumen_usuario IS 'Totales de facturas por usuario (mantenido por trigger_facturas_resumen)';
+COMMENT ON TABLE facturas_resumen_mensual IS 'Totales de facturas por usuario y mes (mantenido por trigger_facturas_resumen)';
+
+-- =====================================================
+-- 13. EVENTOS EN TIEMPO REAL (LISTEN/NOTIFY)
+-- Cada worker de Flask escucha el canal portal_eventos con
+-- una conexión y reenvía los eventos por SSE
+-- (/api/portal/eventos) al usuario indicado en usuario_id.
+-- =====================================================
+
+-- Notificación nueva o marcada como leída: evento con el contador de no leídas
+CREATE OR REPLACE FUNCTION notificar_evento_notificacion()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.usuario_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM pg_notify('portal_eventos', json_build_object(
+        'tipo', 'notificacion',
+        'usuario_id', NEW.usuario_id,
+        'id', NEW.id,
+        'factura_id', NEW.factura_id,
+        'nueva', TG_OP = 'INSERT',
+        'titulo', NEW.titulo,
+        'no_leidas', (SELECT COUNT(*) FROM notificaciones
+                      WHERE usuario_id = NEW.usuario_id AND leida = FALSE)
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_evento_notificacion ON notificaciones;
+CREATE TRIGGER trigger_evento_notificacion
+    AFTER INSERT OR UPDATE OF leida ON notificaciones
+    FOR EACH ROW
+    EXECUTE FUNCTION notificar_evento_notificacion();
+
+-- Cambio visible de una factura (estado, pago, archivos)
+CREATE OR REPLACE FUNCTION notificar_evento_factura()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.usuario_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM pg_notify('portal_eventos', json_build_object(
+        'tipo', 'factura_actualizada',
+        'usuario_id', NEW.usuario_id,
+        'factura_id', NEW.id,
+        'order_id', NEW.order_id,
+        'invoice_name', NEW.invoice_name,
+        'status', NEW.status,
+        'payment_status', NEW.payment_status,
+        'tiene_pdf', NEW.pdf_url IS NOT NULL,
+        'tiene_xml', NEW.xml_url IS NOT NULL
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_evento_factura ON facturas;
+CREATE TRIGGER trigger_evento_factura
+    AFTER UPDATE OF status, payment_status, invoice_name, pdf_url, xml_url ON facturas
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status
+          OR OLD.payment_status IS DISTINCT FROM NEW.payment_status
+          OR OLD.invoice_name IS DISTINCT FROM NEW.invoice_name
+          OR OLD.pdf_url IS DISTINCT FROM NEW.pdf_url
+          OR OLD.xml_url IS DISTINCT FROM NEW.xml_url)
+    EXECUTE FUNCTION notificar_evento_factura();
+
+-- Contador de no leídas (evento de notificación y apertura del stream)
+CREATE INDEX IF NOT EXISTS idx_notificaciones_no_leidas ON notificaciones(usuario_id) WHERE leida = FALSE;
+
+-- =====================================================
+-- 14. HISTORIAL DE ESTADOS DE FACTURACIÓN
+-- Una fila por cada estado que n8n reporta en
+-- /webhook/factura-procesada y /webhook/actualizar-estado.
+-- Se inserta en lotes junto con el UPDATE de facturas.status
+-- en la misma transacción.
+-- =====================================================
+CREATE TABLE IF NOT EXISTS facturacion_estados (
+    id BIGSERIAL PRIMARY KEY,
+    order_id VARCHAR(50) NOT NULL,
+    estado VARCHAR(50) NOT NULL,  -- Tal como lo reporta n8n (procesando, timbrada, success, error...)
+    detalles TEXT,
+    origen VARCHAR(30) NOT NULL,  -- factura-procesada | actualizar-estado
+    status_factura VARCHAR(50),  -- facturas.status resultante, NULL si el estado no lo cambia
+    reportado_at TIMESTAMP,  -- timestamp enviado por n8n, si lo hay
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Línea de tiempo de una orden (detalle de factura y soporte)
+CREATE INDEX IF NOT EXISTS idx_facturacion_estados_orden
+    ON facturacion_estados(order_id, created_at, id);
+
+-- Aviso en vivo al dueño de la factura (un NOTIFY por fila del lote)
+CREATE OR REPLACE FUNCTION notificar_evento_estado()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('portal_eventos', json_build_object(
+        'tipo', 'estado_factura',
+        'usuario_id', f.usuario_id,
+        'factura_id', f.id,
+        'order_id', n.order_id,
+        'estado', n.estado,
+        'detalles', LEFT(n.detalles, 500),
+        'origen', n.origen
+    )::text)
+    FROM nuevos n
+    JOIN facturas f ON f.order_id = n.order_id
+    WHERE f.usuario_id IS NOT NULL;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_evento_estado ON facturacion_estados;
+CREATE TRIGGER trigger_evento_estado
+    AFTER INSERT ON facturacion_estados
+    REFERENCING NEW TABLE AS nuevos
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notificar_evento_estado();
+
+-- =====================================================
+-- 15. LÍMITE DE INTENTOS DE LOGIN
+-- Contadores de fallos por IP ('ip:<ip>') y por email
+-- ('email:<email>') compartidos entre réplicas, en ventanas
+-- de LOGIN_VENTANA segundos (actual + anterior). Cada worker
+-- suma sus fallos aquí en lotes. UNLOGGED: si la BD se cae
+-- solo se pierden contadores de pocos minutos; el bloqueo de
+-- la cuenta vive en usuarios_portal.bloqueado_hasta.
+-- =====================================================
+CREATE UNLOGGED TABLE IF NOT EXISTS login_limites (
+    clave VARCHAR(320) PRIMARY KEY,
+    ventana BIGINT NOT NULL,  -- floor(epoch / LOGIN_VENTANA)
+    actual INTEGER NOT NULL DEFAULT 0,  -- fallos en la ventana actual
+    anterior INTEGER NOT NULL DEFAULT 0,  -- fallos en la ventana anterior
+    bloqueado_hasta TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Purga de claves inactivas (outbox_worker, cada hora)
+CREATE INDEX IF NOT EXISTS idx_login_limites_updated ON login_limites(updated_at);
+
+-- =====================================================
+-- 16. LOTES DE FACTURACIÓN MASIVA
+-- Un CSV de pedidos facturados con una sola CSF. Cada renglón
+-- válido tiene su job en facturacion_jobs (todos con el mismo
+-- csf_sha256); los inválidos guardan el motivo. El avance se
+-- consulta en /api/facturas/lotes/<id>.
+-- =====================================================
+CREATE TABLE IF NOT EXISTS facturacion_lotes (
+    id UUID PRIMARY KEY,
+    email VARCHAR(255),
+    csf_sha256 CHAR(64),
+    total INTEGER NOT NULL,  -- renglones del CSV
+    filas JSONB NOT NULL,  -- [{fila, id, monto, order_id, job_id | motivo}] en el orden del CSV
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+COMMENT ON TABLE facturacion_lotes IS 'Facturación masiva: renglones del CSV y el job de cada uno';
+
+-- =====================================================
+-- 17. PERMISOS (AJUSTAR SEGÚN TU CONFIGURACIÓN)
 -- =====================================================
 
 -- Asegurar que el usuario 'dml' tenga todos los permisos
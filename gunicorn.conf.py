@@ -0,0 +1,44 @@
+"""
+Configuración de gunicorn (se carga sola desde el directorio de trabajo)
+
+Elige el tipo de worker según SERVIDOR_MODO, prepara el directorio de
+métricas multiproceso de Prometheus antes de crear los workers y limpia los
+valores de los workers que terminan. Los flags de la línea de comandos
+(workers, threads, bind...) siguen aplicando y tienen prioridad.
+"""
+import os
+import shutil
+
+# Debe existir antes de que los workers importen prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+# hilos: cada request (y cada stream SSE) ocupa un hilo del worker.
+# async: gevent parcha socket/ssl/threading antes de importar app.py, así que
+# requests, los locks y el executor de envíos a n8n pasan a ser greenlets y
+# app.activar_psycopg2_cooperativo() hace lo mismo con psycopg2.
+if os.getenv('SERVIDOR_MODO', 'hilos').lower() == 'async':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))  # requests simultáneos por worker
+else:
+    worker_class = 'gthread'
+    threads = int(os.getenv('GUNICORN_THREADS', '64'))
+
+
+def on_starting(server):
+    # Valores de una ejecución anterior no deben sumarse a los nuevos
+    directorio = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # p. ej. SERVIDOR_MODO=async pero -k gthread en la línea de comandos
+    if worker_class == 'gevent':
+        from app import PSYCOPG2_COOPERATIVO
+        if not PSYCOPG2_COOPERATIVO:
+            worker.log.warning('SERVIDOR_MODO=async sin gevent activo: las consultas a Postgres bloquean el worker')
@@ -42,25 +42,28 @@ echo ""
 echo "📦 Aplicando manifiestos..."
 echo ""
 
-echo "1/7 - Aplicando ConfigMap..."
+echo "1/8 - Aplicando ConfigMap..."
 kubectl apply -f configmap.yaml
 
-echo "2/7 - Aplicando Secret..."
+echo "2/8 - Aplicando Secret..."
 kubectl apply -f secret.yaml
 
-echo "3/7 - Aplicando PVC..."
+echo "3/8 - Aplicando PVC..."
 kubectl apply -f pvc.yaml
 
-echo "4/7 - Aplicando Deployment..."
+echo "4/8 - Aplicando Deployment..."
 kubectl apply -f deployment.yaml
 
-echo "5/7 - Aplicando Service..."
+echo "5/8 - Aplicando Outbox Worker..."
+kubectl apply -f outbox-worker.yaml
+
+echo "6/8 - Aplicando Service..."
 kubectl apply -f service.yaml
 
-echo "6/7 - Aplicando Ingress (opcional)..."
+echo "7/8 - Aplicando Ingress (opcional)..."
 kubectl apply -f ingress.yaml || echo "⚠️  Ingress no aplicado (puede requerir ingress controller)"
 
-echo "7/7 - Aplicando HPA (opcional)..."
+echo "8/8 - Aplicando HPA (opcional)..."
 kubectl apply -f hpa.yaml || echo "⚠️  HPA no aplicado (puede requerir metrics-server)"
 
 echo ""
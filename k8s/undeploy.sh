@@ -36,6 +36,7 @@ echo ""
 kubectl delete -f hpa.yaml 2>/dev/null || echo "HPA no encontrado"
 kubectl delete -f ingress.yaml 2>/dev/null || echo "Ingress no encontrado"
 kubectl delete -f service.yaml 2>/dev/null || echo "Service no encontrado"
+kubectl delete -f outbox-worker.yaml 2>/dev/null || echo "Outbox worker no encontrado"
 kubectl delete -f deployment.yaml 2>/dev/null || echo "Deployment no encontrado"
 
 # Preguntar si eliminar PVC (datos persistentes)
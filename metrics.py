@@ -0,0 +1,72 @@
+"""
+Métricas Prometheus del portal
+
+Latencia por etapa de la solicitud de factura y por ruta, resultados de los
+envíos a n8n y requests en curso. Con gunicorn cada worker escribe sus
+valores en PROMETHEUS_MULTIPROC_DIR (ver gunicorn.conf.py) y /metrics los
+suma al responder, así que cualquier worker devuelve el total del pod.
+
+Sin PROMETHEUS_MULTIPROC_DIR (python app.py, outbox_worker.py) se usa el
+registro del proceso.
+"""
+import os
+import time
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+)
+from prometheus_client import multiprocess
+
+# Desde milisegundos (sesión, validaciones) hasta N8N_TIMEOUT (n8n + Odoo)
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+ETAPA_SEGUNDOS = Histogram(
+    'portal_etapa_segundos',
+    'Duración de cada etapa del flujo de facturación',
+    ['etapa'],
+    buckets=BUCKETS_SEGUNDOS
+)
+
+REQUEST_SEGUNDOS = Histogram(
+    'portal_request_segundos',
+    'Duración de los requests HTTP por ruta (hasta enviar los headers)',
+    ['endpoint', 'metodo', 'status'],
+    buckets=BUCKETS_SEGUNDOS
+)
+
+REQUESTS_EN_CURSO = Gauge(
+    'portal_requests_en_curso',
+    'Requests HTTP atendiéndose en este momento',
+    ['endpoint'],
+    multiprocess_mode='livesum'
+)
+
+N8N_ENVIOS = Counter(
+    'portal_n8n_envios_total',
+    'Envíos a n8n por resultado',
+    ['resultado']  # exito, timeout, conexion, http_error, json_invalido, error
+)
+
+
+def medir_etapa(etapa):
+    """Context manager que registra la duración del bloque en portal_etapa_segundos"""
+    return ETAPA_SEGUNDOS.labels(etapa=etapa).time()
+
+
+def observar_etapa(etapa, inicio):
+    """
+    Registra la etapa que empezó en `inicio` (time.perf_counter()) y regresa
+    el instante actual, para encadenar etapas en funciones con varios return.
+    """
+    ahora = time.perf_counter()
+    ETAPA_SEGUNDOS.labels(etapa=etapa).observe(ahora - inicio)
+    return ahora
+
+
+def generar_metricas():
+    """Texto de exposición de Prometheus (suma de todos los workers en modo multiproceso)"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+        return generate_latest(registro), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,104 @@
+"""
+Worker del outbox de envíos a n8n
+
+Reclama en lotes los jobs de facturacion_jobs que no se pudieron enviar
+desde el web (n8n caído, executor lleno, pod reiniciado) y los reenvía
+con backoff exponencial. Se pueden correr varias réplicas: cada lote se
+reclama con FOR UPDATE SKIP LOCKED y un lease, así ningún job se envía
+dos veces en paralelo.
+
+Uso:
+    python outbox_worker.py
+"""
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import (
+    logger, reclamar_jobs_outbox, entregar_job, purgar_csf_documentos, purgar_sesiones_expiradas,
+    purgar_limites_login, generar_token_envio
+)
+from config import Config
+
+PURGA_INTERVALO = 3600  # segundos entre purgas de csf_documentos y sesiones_portal
+
+detener = threading.Event()
+
+
+def _senal_detener(signum, frame):
+    logger.info(f"🛑 Señal {signum} recibida; terminando después del lote actual")
+    detener.set()
+
+
+# Nunca se reclaman más jobs de los que se pueden enviar a la vez: un job
+# reclamado que espera turno consumiría su lease (OUTBOX_LEASE) sin enviarse
+TAMANO_LOTE = min(Config.OUTBOX_BATCH_SIZE, Config.OUTBOX_CONCURRENCIA)
+
+
+def procesar_lote(executor):
+    """Reclama y entrega un lote. Retorna cuántos jobs se procesaron."""
+    token = generar_token_envio()
+    jobs = reclamar_jobs_outbox(TAMANO_LOTE, token)
+    if not jobs:
+        return 0
+
+    logger.info(f"📤 Outbox: {len(jobs)} job(s) reclamados ({token})")
+    resultados = list(executor.map(lambda job: _entregar(job, token), jobs))
+
+    resumen = {estado: resultados.count(estado) for estado in set(resultados)}
+    logger.info(f"📤 Outbox: lote terminado {resumen}")
+    return len(jobs)
+
+
+def _entregar(job, token):
+    try:
+        return entregar_job(job, token)
+    except Exception:
+        # El job queda 'enviando' y se retoma cuando venza el lease
+        logger.exception(f"❌ Outbox: error inesperado entregando job {job['id']}")
+        return 'excepcion'
+
+
+def main():
+    signal.signal(signal.SIGTERM, _senal_detener)
+    signal.signal(signal.SIGINT, _senal_detener)
+
+    logger.info("🚚 Outbox worker iniciado", extra={
+        'evento': 'outbox.worker',
+        'lote': TAMANO_LOTE,
+        'concurrencia': Config.OUTBOX_CONCURRENCIA,
+        'max_intentos': Config.OUTBOX_MAX_INTENTOS,
+        'lease_s': Config.OUTBOX_LEASE,
+    })
+
+    ultima_purga = 0.0
+    with ThreadPoolExecutor(max_workers=Config.OUTBOX_CONCURRENCIA, thread_name_prefix='outbox') as executor:
+        while not detener.is_set():
+            try:
+                procesados = procesar_lote(executor)
+
+                if time.monotonic() - ultima_purga > PURGA_INTERVALO:
+                    borrados = purgar_csf_documentos()
+                    if borrados:
+                        logger.info(f"🧹 Outbox: {borrados} CSF purgadas")
+                    sesiones = purgar_sesiones_expiradas()
+                    if sesiones:
+                        logger.info(f"🧹 {sesiones} sesiones vencidas purgadas")
+                    limites = purgar_limites_login()
+                    if limites:
+                        logger.info(f"🧹 {limites} contadores de login purgados")
+                    ultima_purga = time.monotonic()
+            except Exception:
+                logger.exception("❌ Outbox: error consultando la base de datos")
+                procesados = 0
+
+            # Lote lleno: probablemente hay más trabajo, seguir sin esperar
+            if procesados < TAMANO_LOTE:
+                detener.wait(Config.OUTBOX_POLL_INTERVAL)
+
+    logger.info("🚚 Outbox worker detenido")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Configuración común de las pruebas (pytest).
+
+Las pruebas importan app.py directamente. Las que necesitan PostgreSQL
+usan el fixture `db` y se saltan si la base configurada (POSTGRES_*) no
+responde.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Antes de importar app: carpetas temporales y logs solo a stdout
+os.environ.setdefault('UPLOAD_FOLDER', tempfile.mkdtemp(prefix='portal_pruebas_'))
+os.environ.setdefault('LOG_FILE', '')
+os.environ.setdefault('PROXY_X_FOR', '1')  # un ingress delante, como en k8s/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2  # noqa: E402
+
+import app as portal  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """Salta la prueba si no hay PostgreSQL disponible"""
+    try:
+        with portal.db_cursor() as cursor:
+            cursor.execute("SELECT 1")
+    except psycopg2.Error as e:
+        pytest.skip(f'PostgreSQL no disponible: {e}')
+    return portal
+
+
+class StreamEnTrozos:
+    """Stream que entrega a lo más `tamano` bytes por read(), para probar los bordes entre bloques"""
+
+    def __init__(self, datos, tamano):
+        self._datos = datos
+        self._pos = 0
+        self._tamano = tamano
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = len(self._datos)
+        n = min(n, self._tamano)
+        bloque = self._datos[self._pos:self._pos + n]
+        self._pos += len(bloque)
+        return bloque
+
+
+@pytest.fixture
+def en_trozos():
+    return StreamEnTrozos
+
+
+def pdf_de_prueba(tamano=5000, semilla=0):
+    """Bytes con cabecera PDF que validate_pdf_file acepta"""
+    cuerpo = bytes((i * 31 + semilla) % 256 for i in range(tamano))
+    return b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n' + cuerpo + b'\n%%EOF\n'
+
+
+@pytest.fixture
+def pdf():
+    return pdf_de_prueba
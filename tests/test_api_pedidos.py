@@ -0,0 +1,78 @@
+"""Pruebas de POST /api/pedidos/lookup (token Bearer y respuesta por ID)"""
+import pytest
+
+import app as portal
+from app import Config
+
+TOKEN = 'token-de-pruebas'
+PEDIDO = {'order_id': '2000001', 'paid_amount': 100.0, 'receiver_id': 'R1', 'match_kind': 'order'}
+
+
+@pytest.fixture
+def consultas(monkeypatch):
+    """Reemplaza buscar_pedidos y registra los IDs de cada consulta"""
+    llamadas = []
+
+    def buscar_pedidos(search_ids):
+        llamadas.append(list(search_ids))
+        return {'2000001': PEDIDO} if '2000001' in search_ids else {}
+
+    monkeypatch.setattr(portal, 'buscar_pedidos', buscar_pedidos)
+    return llamadas
+
+
+@pytest.fixture
+def cliente():
+    return portal.app.test_client()
+
+
+def buscar(cliente, ids, token=None):
+    headers = {'Authorization': f'Bearer {token}'} if token is not None else {}
+    return cliente.post('/api/pedidos/lookup', json={'ids': ids}, headers=headers)
+
+
+@pytest.mark.parametrize('token', [None, '', TOKEN, 'otro'])
+def test_sin_token_configurado_siempre_rechaza(cliente, consultas, monkeypatch, token):
+    monkeypatch.setattr(Config, 'PEDIDOS_API_TOKEN', '')
+
+    respuesta = buscar(cliente, ['2000001'], token)
+
+    assert respuesta.status_code == 401
+    assert consultas == []
+
+
+@pytest.mark.parametrize('headers', [
+    {},
+    {'Authorization': 'Bearer otro-token'},
+    {'Authorization': f'Bearer {TOKEN}x'},
+    {'Authorization': TOKEN},
+    {'Authorization': f'Basic {TOKEN}'},
+])
+def test_token_faltante_o_incorrecto(cliente, consultas, monkeypatch, headers):
+    monkeypatch.setattr(Config, 'PEDIDOS_API_TOKEN', TOKEN)
+
+    respuesta = cliente.post('/api/pedidos/lookup', json={'ids': ['2000001']}, headers=headers)
+
+    assert respuesta.status_code == 401
+    assert 'pedidos' not in respuesta.json
+    assert consultas == []
+
+
+def test_token_correcto(cliente, consultas, monkeypatch):
+    monkeypatch.setattr(Config, 'PEDIDOS_API_TOKEN', TOKEN)
+
+    respuesta = buscar(cliente, ['2000001', ' 999 ', '2000001', 2000001], TOKEN)
+
+    assert respuesta.status_code == 200
+    assert consultas == [['2000001', '999']]
+    assert respuesta.json['pedidos'] == {'2000001': PEDIDO, '999': None}
+    assert respuesta.json['no_encontrados'] == ['999']
+
+
+@pytest.mark.parametrize('ids', [[], 'x', [True], [None], ['1'] * 501])
+def test_lote_invalido(cliente, consultas, monkeypatch, ids):
+    monkeypatch.setattr(Config, 'PEDIDOS_API_TOKEN', TOKEN)
+    monkeypatch.setattr(Config, 'PEDIDOS_LOOKUP_MAX_LOTE', 500)
+
+    assert buscar(cliente, ids, TOKEN).status_code == 400
+    assert consultas == []
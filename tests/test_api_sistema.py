@@ -0,0 +1,38 @@
+"""Pruebas de GET /api/sistema/stats (métricas internas detrás del token de la API)"""
+import pytest
+
+import app as portal
+from app import Config
+
+TOKEN = 'token-de-pruebas'
+
+
+@pytest.fixture
+def cliente():
+    return portal.app.test_client()
+
+
+@pytest.mark.parametrize('configurado, headers', [
+    ('', {}),
+    ('', {'Authorization': 'Bearer '}),
+    ('', {'Authorization': f'Bearer {TOKEN}'}),
+    (TOKEN, {}),
+    (TOKEN, {'Authorization': 'Bearer otro-token'}),
+])
+def test_sin_autorizacion_no_expone_internos(cliente, monkeypatch, configurado, headers):
+    monkeypatch.setattr(Config, 'PEDIDOS_API_TOKEN', configurado)
+
+    respuesta = cliente.get('/api/sistema/stats', headers=headers)
+
+    assert respuesta.status_code == 401
+    assert respuesta.json == {'success': False, 'error': 'No autorizado'}
+
+
+def test_con_token_correcto(cliente, monkeypatch):
+    monkeypatch.setattr(Config, 'PEDIDOS_API_TOKEN', TOKEN)
+
+    respuesta = cliente.get('/api/sistema/stats', headers={'Authorization': f'Bearer {TOKEN}'})
+
+    assert respuesta.status_code == 200
+    assert respuesta.json['success'] is True
+    assert {'db_pool', 'audit', 'login_limites'} <= respuesta.json.keys()
@@ -0,0 +1,77 @@
+"""Pruebas del cursor de paginación de facturas del portal (keyset sobre created_at, id)"""
+import base64
+import uuid
+from datetime import datetime
+
+import pytest
+from psycopg2.extras import RealDictCursor
+
+from app import codificar_cursor_facturas, decodificar_cursor_facturas, obtener_pagina_facturas
+
+
+@pytest.mark.parametrize('orden_at', [
+    datetime(2024, 3, 1, 12, 30, 5, 123456),
+    datetime(2024, 3, 1),
+    datetime(1970, 1, 1),  # facturas sin created_at (COALESCE a 'epoch')
+])
+def test_codificar_y_decodificar(orden_at):
+    cursor = codificar_cursor_facturas({'orden_at': orden_at, 'id': 42})
+
+    assert '=' not in cursor and '/' not in cursor and '+' not in cursor
+    assert decodificar_cursor_facturas(cursor) == (orden_at, 42)
+
+
+@pytest.mark.parametrize('cursor', [
+    '',
+    'no es base64!',
+    base64.urlsafe_b64encode(b'2024-03-01T00:00:00').decode(),  # sin id
+    base64.urlsafe_b64encode(b'2024-03-01T00:00:00|abc').decode(),
+    base64.urlsafe_b64encode(b'ayer|42').decode(),
+    base64.urlsafe_b64encode(b'2024-03-01|42|7').decode(),
+    base64.urlsafe_b64encode(b'\xff\xfe|42').decode(),
+])
+def test_cursor_invalido(cursor):
+    assert decodificar_cursor_facturas(cursor) is None
+
+
+@pytest.fixture
+def usuario_con_facturas(db):
+    """Usuario con 7 facturas: dos sin created_at y dos con el mismo created_at"""
+    sufijo = uuid.uuid4().hex[:10]
+    fechas = ['2024-01-05', '2024-01-04', '2024-01-04', '2024-01-03', '2024-01-01', None, None]
+    with db.db_cursor() as cursor:
+        cursor.execute("INSERT INTO usuarios_portal (receiver_id, email) VALUES (%s, %s) RETURNING id",
+                       (f'PRUEBA-{sufijo}', f'cursor-{sufijo}@example.com'))
+        usuario_id = cursor.fetchone()[0]
+        for i, fecha in enumerate(fechas):
+            cursor.execute(
+                """
+                INSERT INTO facturas (usuario_id, receiver_id, order_id, email, amount, created_at)
+                VALUES (%s, %s, %s, %s, 1, %s)
+                """,
+                (usuario_id, f'PRUEBA-{sufijo}', f'CUR-{sufijo}-{i}', 'cursor@example.com', fecha)
+            )
+        cursor.connection.commit()
+    yield usuario_id, sufijo
+    with db.db_cursor() as cursor:
+        cursor.execute("DELETE FROM facturas WHERE usuario_id = %s", (usuario_id,))
+        cursor.execute("DELETE FROM usuarios_portal WHERE id = %s", (usuario_id,))
+        cursor.connection.commit()
+
+
+@pytest.mark.parametrize('limite', [1, 2, 3, 7, 50])
+def test_paginas_cubren_todas_las_facturas_una_vez(db, usuario_con_facturas, limite):
+    usuario_id, sufijo = usuario_con_facturas
+    vistas, despues = [], None
+
+    with db.db_cursor(RealDictCursor) as cursor:
+        while True:
+            facturas, siguiente = obtener_pagina_facturas(cursor, usuario_id, despues, limite)
+            assert len(facturas) <= limite
+            vistas += [f['order_id'] for f in facturas]
+            if siguiente is None:
+                break
+            despues = decodificar_cursor_facturas(siguiente)
+
+    # Más recientes primero; las de fecha igual por id; las sin fecha al final
+    assert vistas == [f'CUR-{sufijo}-{i}' for i in (0, 2, 1, 3, 4, 6, 5)]
@@ -0,0 +1,162 @@
+"""Pruebas de LectorDocumentosN8N / DocumentoTemporal (/webhook/enviar-pdf)"""
+import base64
+import hashlib
+import io
+import json
+import os
+
+import pytest
+
+import app as portal
+from app import Config, DocumentoTemporal, LectorDocumentosN8N
+
+
+@pytest.fixture(autouse=True)
+def documentos_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'DOCUMENTOS_FOLDER', str(tmp_path))
+    return tmp_path
+
+
+def temporales(carpeta):
+    return list((carpeta / 'tmp').glob('*.part')) if (carpeta / 'tmp').exists() else []
+
+
+def cuerpo_json(objetos):
+    return json.dumps(objetos, ensure_ascii=False).encode('utf-8')
+
+
+@pytest.fixture
+def leer(en_trozos):
+    """Lee todos los objetos entregando el cuerpo en trozos de `tamano` bytes"""
+    def leer(cuerpo, tamano):
+        return list(LectorDocumentosN8N(en_trozos(cuerpo, tamano)).objetos())
+    return leer
+
+
+def contenido(documento):
+    with open(documento.ruta_temporal, 'rb') as f:
+        return f.read()
+
+
+# Tamaños de trozo que ponen el borde en cada posición de un grupo base64
+# (4 caracteres), de un escape (2) y de un carácter UTF-8 de 2 a 4 bytes
+TAMANOS = [1, 2, 3, 5, 7, 64 * 1024]
+
+
+@pytest.mark.parametrize('tamano', TAMANOS)
+def test_documento_base64_en_cualquier_borde(tamano, pdf, leer):
+    datos = pdf(3001)
+    cuerpo = cuerpo_json({'order_id': '123', 'pdf_content': base64.b64encode(datos).decode()})
+
+    [(campos, [documento])] = leer(cuerpo, tamano)
+
+    assert campos == {'order_id': '123'}
+    assert documento.campo == 'pdf_content'
+    assert documento.size == len(datos)
+    assert documento.sha256.hexdigest() == hashlib.sha256(datos).hexdigest()
+    assert contenido(documento) == datos
+    documento.descartar()
+
+
+@pytest.mark.parametrize('tamano', TAMANOS)
+def test_escapes_de_n8n_partidos_entre_bloques(tamano, pdf, leer):
+    datos = pdf(2000, semilla=7)
+    b64 = base64.b64encode(datos).decode()
+    assert '/' in b64
+    # n8n puede escapar '/' y partir el base64 en líneas de 76 caracteres
+    escapado = '\\n'.join(b64[i:i + 76] for i in range(0, len(b64), 76)).replace('/', '\\/')
+    cuerpo = ('{"order_id": "9", "pdf_content": "' + escapado + '"}').encode()
+
+    [(_, [documento])] = leer(cuerpo, tamano)
+
+    assert contenido(documento) == datos
+    documento.descartar()
+
+
+@pytest.mark.parametrize('tamano', TAMANOS)
+def test_utf8_multibyte_partido_entre_bloques(tamano, pdf, leer):
+    nombre = 'factura_ñandú_€_𝄞.pdf'
+    cuerpo = cuerpo_json([
+        {'order_id': 'Ω-1', 'filename': nombre, 'pdf_content': base64.b64encode(pdf(10)).decode()},
+        {'order_id': 'Ω-2', 'filename': nombre, 'pdf_content': base64.b64encode(pdf(20)).decode()},
+    ])
+
+    objetos = leer(cuerpo, tamano)
+
+    assert [campos for campos, _ in objetos] == [
+        {'order_id': 'Ω-1', 'filename': nombre},
+        {'order_id': 'Ω-2', 'filename': nombre},
+    ]
+    for _, documentos in objetos:
+        for documento in documentos:
+            documento.descartar()
+
+
+@pytest.mark.parametrize('valor', ['JVBER!0x', 'JVBERi0', 'JVB\\u0045Ri0x'])
+def test_base64_invalido_no_deja_temporales(valor, documentos_folder, leer):
+    cuerpo = ('{"order_id": "1", "pdf_content": "' + valor + '"}').encode()
+
+    with pytest.raises(ValueError):
+        leer(cuerpo, 3)
+
+    assert temporales(documentos_folder) == []
+
+
+def test_pdf_invalido_no_deja_temporales(documentos_folder, leer):
+    cuerpo = cuerpo_json({'order_id': '1', 'pdf_content': base64.b64encode(b'no soy un pdf' * 50).decode()})
+
+    with pytest.raises(ValueError, match='PDF'):
+        leer(cuerpo, 64 * 1024)
+
+    assert temporales(documentos_folder) == []
+
+
+def test_cadena_sin_terminar(documentos_folder, pdf, leer):
+    cuerpo = b'{"order_id": "1", "pdf_content": "' + base64.b64encode(pdf(100))
+
+    with pytest.raises(ValueError, match='sin terminar'):
+        leer(cuerpo, 16)
+
+    assert temporales(documentos_folder) == []
+
+
+def test_mismo_contenido_reutiliza_el_archivo(documentos_folder, pdf):
+    datos = pdf(4000, semilla=3)
+    guardados = []
+    for _ in range(2):
+        documento = DocumentoTemporal('pdf_content')
+        documento.escribir_base64(base64.b64encode(datos))
+        documento.cerrar()
+        guardados.append(documento.guardar())
+
+    (ruta, duplicado), (ruta_repetida, duplicado_repetido) = guardados
+    digest = hashlib.sha256(datos).hexdigest()
+    assert ruta == ruta_repetida == os.path.join(str(documentos_folder), digest[:2], digest[2:4], f'{digest}.pdf')
+    assert (duplicado, duplicado_repetido) == (False, True)
+    assert temporales(documentos_folder) == []
+    with open(ruta, 'rb') as f:
+        assert f.read() == datos
+
+
+def test_cuerpo_mayor_al_limite_responde_413(monkeypatch, documentos_folder, pdf):
+    monkeypatch.setitem(portal.app.config, 'MAX_CONTENT_LENGTH', 1024)
+    cuerpo = cuerpo_json({'order_id': '1', 'pdf_content': base64.b64encode(pdf(5000)).decode()})
+
+    respuesta = portal.app.test_client().post('/webhook/enviar-pdf', data=cuerpo,
+                                               content_type='application/json')
+
+    assert respuesta.status_code == 413
+    assert temporales(documentos_folder) == []
+
+
+def test_cuerpo_chunked_que_excede_el_limite_a_medio_documento(monkeypatch, documentos_folder, pdf):
+    monkeypatch.setitem(portal.app.config, 'MAX_CONTENT_LENGTH', 4096)
+    cuerpo = cuerpo_json({'order_id': '1', 'pdf_content': base64.b64encode(pdf(20000)).decode()})
+
+    # Sin Content-Length el límite se detecta mientras se decodifica el documento
+    respuesta = portal.app.test_client().post(
+        '/webhook/enviar-pdf', input_stream=io.BytesIO(cuerpo), content_type='application/json',
+        headers={'Transfer-Encoding': 'chunked'}, environ_overrides={'wsgi.input_terminated': True})
+
+    assert respuesta.status_code == 413
+    assert temporales(documentos_folder) == []
@@ -0,0 +1,171 @@
+"""Pruebas de la lectura y validación del CSV de facturación masiva"""
+import hashlib
+import io
+import uuid
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import app as portal
+from app import Config, _parsear_monto, leer_csv_pedidos, validar_filas_masiva
+
+
+def csv_de(texto, codificacion='utf-8'):
+    return FileStorage(stream=io.BytesIO(texto.encode(codificacion)), filename='pedidos.csv')
+
+
+def leer(texto, codificacion='utf-8'):
+    return list(leer_csv_pedidos(csv_de(texto, codificacion)))
+
+
+@pytest.mark.parametrize('texto, monto', [
+    ('1499.00', 1499.0),
+    ('$1,234.50', 1234.5),
+    (' 350.5 ', 350.5),
+    ('0', 0.0),
+    ('', None),
+    ('mil', None),
+    ('nan', None),
+    ('inf', None),
+    ('1e309', None),
+])
+def test_parsear_monto(texto, monto):
+    assert _parsear_monto(texto) == monto
+
+
+def test_con_encabezado_y_bom():
+    texto = '﻿order_id,monto\r\n2000001,1499.00\r\n2000002,"$1,350.50"\r\n'
+
+    assert leer(texto) == [(2, '2000001', 1499.0), (3, '2000002', 1350.5)]
+
+
+def test_sin_encabezado():
+    assert leer('2000001,10\n2000002,20\n') == [(1, '2000001', 10.0), (2, '2000002', 20.0)]
+
+
+def test_renglones_vacios_se_saltan_sin_perder_el_numero():
+    texto = 'id,monto\n\n2000001,10\n , \n2000002,20\n'
+
+    assert leer(texto) == [(3, '2000001', 10.0), (5, '2000002', 20.0)]
+
+
+def test_monto_invalido_o_faltante_es_none():
+    texto = 'id,monto\n2000001,diez\n2000002\n,30\n'
+
+    assert leer(texto) == [(2, '2000001', None), (3, '2000002', None), (4, '', 30.0)]
+
+
+def test_mas_renglones_que_el_maximo(monkeypatch):
+    monkeypatch.setattr(Config, 'MASIVA_MAX_FILAS', 3)
+    renglones = leer_csv_pedidos(csv_de(''.join(f'{i},1\n' for i in range(10))))
+
+    # Es un generador: los primeros renglones se entregan antes de fallar
+    assert [next(renglones) for _ in range(3)] == [(1, '0', 1.0), (2, '1', 1.0), (3, '2', 1.0)]
+    with pytest.raises(ValueError, match='más de 3'):
+        next(renglones)
+
+
+def test_encabezado_no_cuenta_para_el_maximo(monkeypatch):
+    monkeypatch.setattr(Config, 'MASIVA_MAX_FILAS', 2)
+
+    assert len(leer('id,monto\n1,1\n2,2\n')) == 2
+
+
+def test_archivo_que_no_es_utf8():
+    with pytest.raises(ValueError, match='UTF-8'):
+        leer('id,monto\nPEDIDO-ÑANDÚ,10\n', codificacion='latin-1')
+
+
+def test_csv_invalido():
+    # Una comilla sin cerrar se traga el resto del archivo en un solo campo
+    with pytest.raises(ValueError, match='no es válido'):
+        leer('id,monto\n"2000001,10\n' + '2000002,10\n' * 20_000)
+
+
+# --- validación contra orden_ml (buscar_pedidos simulado) -----------------
+
+PEDIDOS = {
+    '2000001': {'order_id': '2000001', 'paid_amount': 100.0, 'currency_id': 'MXN'},
+    'PACK-1': {'order_id': '2000001', 'paid_amount': 100.0, 'currency_id': 'MXN'},
+    '2000002': {'order_id': '2000002', 'paid_amount': 50.5, 'currency_id': 'MXN'},
+}
+DATOS = {'email': 'a@example.com', 'phone': '', 'cfdi_usage': 'G03', 'payment_method': '04'}
+CSF = {'size': 10, 'sha256': '0' * 64}
+
+
+@pytest.fixture
+def consultas(monkeypatch):
+    """Reemplaza buscar_pedidos y registra los IDs de cada consulta"""
+    llamadas = []
+
+    def buscar_pedidos(search_ids):
+        llamadas.append(set(search_ids))
+        return {i: PEDIDOS[i] for i in search_ids if i in PEDIDOS}
+
+    monkeypatch.setattr(portal, 'buscar_pedidos', buscar_pedidos)
+    return llamadas
+
+
+def test_motivos_por_renglon(consultas):
+    renglones = [
+        (1, '2000001', 100.0),
+        (2, '2000002', 50.0),     # monto distinto
+        (3, 'PACK-1', 100.0),     # mismo pedido por pack_id
+        (4, '9999999', 10.0),
+        (5, '2000002', None),
+        (6, '2000002', 50.505),   # dentro de la tolerancia
+    ]
+
+    filas = validar_filas_masiva(renglones, DATOS, CSF, 'csf.pdf')
+
+    assert [f.get('motivo') for f in filas] == [None, 'monto', 'duplicado', 'no_encontrado', 'formato', None]
+    assert filas[0]['payload']['order_id'] == '2000001'
+    assert filas[0]['payload']['monto_pagado'] == 100.0
+    assert filas[0]['payload']['csf_pdf']['filename'] == '2000001_csf.pdf'
+    assert filas[2]['order_id'] == '2000001'
+    assert 'payload' not in filas[1]
+
+
+def test_una_consulta_por_bloque(consultas, monkeypatch):
+    monkeypatch.setattr(Config, 'MASIVA_LOTE_VALIDACION', 4)
+    renglones = ((i, f'X{i}', 1.0) for i in range(1, 11))
+
+    filas = validar_filas_masiva(renglones, DATOS, CSF, 'csf.pdf')
+
+    assert len(filas) == 10
+    assert [len(ids) for ids in consultas] == [4, 4, 2]
+
+
+# --- encolado del lote (PostgreSQL) -----------------------------------------
+
+def test_jobs_del_lote_escalonados(db, monkeypatch, pdf):
+    monkeypatch.setattr(Config, 'MASIVA_CONCURRENCIA', 2)
+    monkeypatch.setattr(Config, 'MASIVA_INTERVALO', 5)
+    contenido = pdf(500, semilla=25)
+    csf = {'mime_type': 'application/pdf', 'size': len(contenido),
+           'sha256': hashlib.sha256(contenido).hexdigest()}
+    lote_id = str(uuid.uuid4())
+    prefijo = f'LOTE-{lote_id[:8]}'
+    filas = [{'fila': i, 'id': f'{prefijo}-{i}',
+              'payload': {'order_id': f'{prefijo}-{i}', 'email': 'a@example.com', 'csf_pdf': csf}}
+             for i in range(1, 6)]
+
+    try:
+        db.encolar_lote_n8n(lote_id, 'a@example.com', csf, io.BytesIO(contenido), filas)
+        with db.db_cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT status, EXTRACT(EPOCH FROM proximo_intento_at - created_at)::int
+                FROM facturacion_jobs WHERE order_id LIKE %s ORDER BY order_id
+                """,
+                (f'{prefijo}-%',)
+            )
+            jobs = cursor.fetchall()
+    finally:
+        with db.db_cursor() as cursor:
+            cursor.execute("DELETE FROM facturacion_jobs WHERE order_id LIKE %s", (f'{prefijo}-%',))
+            cursor.execute("DELETE FROM facturacion_lotes WHERE id = %s", (lote_id,))
+            cursor.connection.commit()
+
+    # Nadie los envía desde el web; outbox_worker los toma de dos en dos cada 5 s
+    assert jobs == [('pendiente', 0), ('pendiente', 0), ('pendiente', 5), ('pendiente', 5), ('pendiente', 10)]
@@ -0,0 +1,270 @@
+"""Pruebas de LimitadorLogin (ventana deslizante en memoria y sincronización en login_limites)"""
+import uuid
+
+import psycopg2
+import pytest
+
+import app as portal
+from app import LimitadorLogin
+
+
+@pytest.fixture
+def crear_limitador():
+    """Limitadores sin hilo de sincronización activo: las pruebas llaman _sincronizar()"""
+    creados = []
+
+    def crear(ventana=100, max_por_ip=4, max_por_email=3, bloqueo=30, max_claves=1000):
+        limitador = LimitadorLogin(ventana, max_por_ip, max_por_email, bloqueo,
+                                   sync_interval=3600, max_claves=max_claves)
+        creados.append(limitador)
+        return limitador
+
+    yield crear
+    for limitador in creados:
+        limitador._detener.set()
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    """time.time() controlado por la prueba"""
+    ahora = [1_000_000.0]
+    monkeypatch.setattr(portal.time, 'time', lambda: ahora[0])
+    return ahora
+
+
+def fallar(limitador, veces, ip='10.0.0.1', email='a@example.com'):
+    for _ in range(veces):
+        limitador.registrar_fallo(ip, email)
+
+
+# --- en memoria -----------------------------------------------------------
+
+def test_bloquea_al_llegar_al_limite_por_email(crear_limitador, reloj):
+    limitador = crear_limitador(max_por_email=3)
+
+    fallar(limitador, 2)
+    assert limitador.permitir('10.0.0.1', 'a@example.com') == (True, 0)
+
+    fallar(limitador, 1)
+    permitido, espera = limitador.permitir('10.0.0.2', 'a@example.com')
+    assert not permitido and espera == 30
+    # Otro email desde otra IP no se ve afectado
+    assert limitador.permitir('10.0.0.2', 'b@example.com') == (True, 0)
+
+
+def test_bloquea_por_ip_aunque_cambie_el_email(crear_limitador, reloj):
+    limitador = crear_limitador(max_por_ip=4, max_por_email=100)
+
+    for i in range(4):
+        limitador.registrar_fallo('10.0.0.1', f'u{i}@example.com')
+
+    assert not limitador.permitir('10.0.0.1', 'nuevo@example.com')[0]
+    assert limitador.permitir('10.0.0.9', 'nuevo@example.com') == (True, 0)
+
+
+def test_el_bloqueo_vence(crear_limitador, reloj):
+    limitador = crear_limitador(ventana=100, max_por_email=3, bloqueo=30)
+    fallar(limitador, 3)
+    assert not limitador.permitir('10.0.0.1', 'a@example.com')[0]
+
+    reloj[0] += 29
+    assert not limitador.permitir('10.0.0.1', 'a@example.com')[0]
+    # Vencido el bloqueo, los fallos siguen en la ventana: vuelve a bloquearse
+    reloj[0] += 2
+    assert not limitador.permitir('10.0.0.1', 'a@example.com')[0]
+    # Dos ventanas después ya no cuentan
+    reloj[0] += 200
+    assert limitador.permitir('10.0.0.1', 'a@example.com') == (True, 0)
+
+
+def test_ventana_deslizante_pondera_la_anterior(crear_limitador, reloj):
+    limitador = crear_limitador(ventana=100, max_por_ip=4, max_por_email=100)
+    reloj[0] = 100 * 10_000 + 50  # mitad de una ventana
+    fallar(limitador, 3)
+
+    # 10% dentro de la siguiente ventana: 3 * 0.9 + 0 = 2.7
+    reloj[0] = 100 * 10_001 + 10
+    assert limitador.permitir('10.0.0.1', 'a@example.com') == (True, 0)
+    fallar(limitador, 1)  # 2.7 + 1 = 3.7
+    assert limitador.permitir('10.0.0.1', 'a@example.com') == (True, 0)
+
+    # 80% dentro: 3 * 0.2 + 1 = 1.6; caben dos fallos más antes de 4
+    reloj[0] = 100 * 10_001 + 80
+    fallar(limitador, 2)
+    assert limitador.permitir('10.0.0.1', 'a@example.com') == (True, 0)
+    fallar(limitador, 1)  # 0.6 + 4 = 4.6
+    assert not limitador.permitir('10.0.0.1', 'a@example.com')[0]
+
+
+def test_login_exitoso_reinicia_el_email_pero_no_la_ip(crear_limitador, reloj):
+    limitador = crear_limitador(max_por_ip=5, max_por_email=3)
+    fallar(limitador, 3)
+    assert not limitador.permitir('10.0.0.2', 'a@example.com')[0]
+
+    limitador.registrar_exito('a@example.com')
+
+    assert limitador.permitir('10.0.0.2', 'a@example.com') == (True, 0)
+    fallar(limitador, 2, ip='10.0.0.1', email='otro@example.com')
+    assert not limitador.permitir('10.0.0.1', 'a@example.com')[0]
+
+
+def test_cuenta_bloqueada_en_bd_se_rechaza_en_memoria(crear_limitador, reloj):
+    limitador = crear_limitador()
+    limitador.marcar_bloqueado('a@example.com', 600)
+
+    permitido, espera = limitador.permitir('10.0.0.1', 'a@example.com')
+    assert not permitido and espera == 600
+
+
+def test_claves_limitadas_en_memoria(crear_limitador, reloj):
+    limitador = crear_limitador(max_claves=10)
+    for i in range(20):
+        limitador.registrar_fallo(f'10.0.0.{i}', f'u{i}@example.com')
+
+    assert limitador.stats()['claves'] == 10
+
+
+# --- sincronización entre réplicas (PostgreSQL) ---------------------------
+
+@pytest.fixture
+def claves(db):
+    sufijo = uuid.uuid4().hex[:10]
+    ip, email = f'prueba-{sufijo}', f'limite-{sufijo}@example.com'
+    yield ip, email
+    with db.db_cursor() as cursor:
+        cursor.execute("DELETE FROM login_limites WHERE clave = ANY(%s)", ([f'ip:{ip}', f'email:{email}'],))
+        cursor.execute("DELETE FROM usuarios_portal WHERE email = %s", (email,))
+        cursor.connection.commit()
+
+
+def fila_limite(clave):
+    with portal.db_cursor() as cursor:
+        cursor.execute("SELECT actual, anterior, bloqueado_hasta FROM login_limites WHERE clave = %s", (clave,))
+        return cursor.fetchone()
+
+
+def test_las_replicas_suman_sus_fallos_y_bloquean_una_vez(crear_limitador, claves, db):
+    ip, email = claves
+    with db.db_cursor() as cursor:
+        cursor.execute("INSERT INTO usuarios_portal (receiver_id, email) VALUES (%s, %s)", (email[:40], email))
+        cursor.connection.commit()
+
+    replica_a = crear_limitador(ventana=3600, max_por_ip=100, max_por_email=5)
+    replica_b = crear_limitador(ventana=3600, max_por_ip=100, max_por_email=5)
+
+    fallar(replica_a, 3, ip, email)
+    replica_a._sincronizar()
+    fallar(replica_b, 2, ip, email)
+    replica_b._sincronizar()
+
+    # Ninguna réplica vio 5 fallos por sí sola; el total compartido sí
+    assert fila_limite(f'email:{email}')[0] == 5
+    assert not replica_b.permitir(ip, email)[0]
+    assert replica_b.stats()['bloqueos'] == 1
+
+    with db.db_cursor() as cursor:
+        cursor.execute("SELECT intentos_fallidos, bloqueado_hasta IS NOT NULL FROM usuarios_portal WHERE email = %s",
+                       (email,))
+        assert cursor.fetchone() == (5, True)
+
+    # Una réplica nueva se entera del bloqueo en su primera sincronización
+    replica_c = crear_limitador(ventana=3600, max_por_ip=100, max_por_email=5)
+    fallar(replica_c, 1, ip, email)
+    replica_c._sincronizar()
+    assert not replica_c.permitir(ip, email)[0]
+    assert replica_c.stats()['bloqueos'] == 0
+
+
+def test_login_exitoso_borra_el_contador_compartido(crear_limitador, claves):
+    ip, email = claves
+    limitador = crear_limitador(ventana=3600)
+    fallar(limitador, 2, ip, email)
+    limitador._sincronizar()
+    assert fila_limite(f'email:{email}') is not None
+
+    limitador.registrar_exito(email)
+    limitador._sincronizar()
+
+    assert fila_limite(f'email:{email}') is None
+    assert fila_limite(f'ip:{ip}')[0] == 2
+
+
+def test_error_al_sincronizar_conserva_los_pendientes(crear_limitador, claves, monkeypatch):
+    ip, email = claves
+    limitador = crear_limitador(ventana=3600)
+    fallar(limitador, 3, ip, email)
+
+    class BDCaida:
+        def __enter__(self):
+            raise psycopg2.OperationalError('BD caída')
+
+        def __exit__(self, *args):
+            return False
+
+    with monkeypatch.context() as m:
+        m.setattr(portal, 'db_cursor', lambda *args, **kwargs: BDCaida())
+        limitador._sincronizar()
+    assert limitador.stats()['errores'] == 1
+    # Las dos claves (ip y email) siguen pendientes para la siguiente vuelta
+    assert limitador.stats()['pendientes'] == 2
+
+    limitador._sincronizar()
+    assert fila_limite(f'email:{email}')[0] == 3
+    assert limitador.stats()['pendientes'] == 0
+
+
+# --- IP del cliente detrás del proxy (ProxyFix) -----------------------------
+
+@pytest.fixture
+def login(crear_limitador, reloj, monkeypatch):
+    """POST /portal/login con limitador propio y autenticación simulada (siempre falla)"""
+    from flask.sessions import SecureCookieSessionInterface
+
+    limitador = crear_limitador(max_por_ip=3, max_por_email=100)
+    intentos = []
+
+    class CursorFalso:
+        def __enter__(self):
+            return None
+
+        def __exit__(self, *args):
+            return False
+
+    def autenticar_usuario(cursor, email, receiver_id, ip_address, user_agent):
+        intentos.append(ip_address)
+        return {'resultado': 'no_encontrado', 'id': None, 'bloqueado_hasta': None}
+
+    monkeypatch.setattr(portal.app, 'session_interface', SecureCookieSessionInterface())
+    monkeypatch.setattr(portal, 'get_limitador_login', lambda: limitador)
+    monkeypatch.setattr(portal, 'db_cursor', lambda *args, **kwargs: CursorFalso())
+    monkeypatch.setattr(portal, 'autenticar_usuario', autenticar_usuario)
+
+    def enviar(ip_cliente, email):
+        # Todos llegan desde la misma IP: la del ingress
+        portal.app.test_client().post(
+            '/portal/login', data={'email': email, 'receiver_id': 'R0'},
+            headers={'X-Forwarded-For': ip_cliente}, environ_base={'REMOTE_ADDR': '10.1.0.7'}
+        )
+
+    return enviar, intentos
+
+
+def test_clientes_detras_del_proxy_no_comparten_limite(login):
+    enviar, intentos = login
+
+    for i in range(5):
+        enviar('203.0.113.10', f'u{i}@example.com')
+    enviar('198.51.100.20', 'otro@example.com')
+
+    # El atacante se bloquea tras 3 fallos; el otro cliente sí llega a autenticarse
+    assert intentos == ['203.0.113.10'] * 3 + ['198.51.100.20']
+
+
+def test_solo_se_confia_en_el_ultimo_salto(login):
+    enviar, intentos = login
+
+    # Un X-Forwarded-For falsificado por el cliente queda a la izquierda del que agrega el proxy
+    for i in range(5):
+        enviar(f'192.0.2.{i}, 203.0.113.10', f'u{i}@example.com')
+
+    assert intentos == ['203.0.113.10'] * 3
@@ -0,0 +1,164 @@
+"""Pruebas del login del portal (autenticar_usuario y POST /portal/login)"""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from flask.sessions import SecureCookieSessionInterface
+from psycopg2.extras import RealDictCursor
+
+import app as portal
+
+
+# --- autenticar_usuario (PostgreSQL) ----------------------------------------
+
+@pytest.fixture
+def cuenta(db):
+    """Crea un usuario con los valores de activo/bloqueado_hasta indicados"""
+    creados = []
+
+    def crear(activo=True, bloqueado_hasta=None):
+        sufijo = uuid.uuid4().hex[:10]
+        email, receiver_id = f'login-{sufijo}@example.com', f'PRUEBA-{sufijo}'
+        with db.db_cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO usuarios_portal (receiver_id, email, nombre, activo, bloqueado_hasta, intentos_fallidos)
+                VALUES (%s, %s, 'Prueba', %s, %s, 3)
+                """,
+                (receiver_id, email, activo, bloqueado_hasta)
+            )
+            cursor.connection.commit()
+        creados.append(email)
+        return email, receiver_id
+
+    yield crear
+    with db.db_cursor() as cursor:
+        cursor.execute("DELETE FROM usuarios_portal WHERE email = ANY(%s)", (creados,))
+        cursor.execute("DELETE FROM historial_accesos WHERE email = ANY(%s)", (creados,))
+        cursor.connection.commit()
+
+
+def autenticar(db, email, receiver_id):
+    with db.db_cursor(RealDictCursor, autocommit=True) as cursor:
+        return portal.autenticar_usuario(cursor, email, receiver_id, '10.0.0.1', 'pytest')
+
+
+def ultimo_acceso(db, email):
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "SELECT tipo_evento, exitoso, mensaje FROM historial_accesos WHERE email = %s ORDER BY id DESC LIMIT 1",
+            (email,)
+        )
+        return cursor.fetchone()
+
+
+def test_exitoso_reinicia_intentos(db, cuenta):
+    email, receiver_id = cuenta()
+
+    usuario = autenticar(db, email, receiver_id)
+
+    assert usuario['resultado'] == 'exitoso' and usuario['email'] == email
+    assert ultimo_acceso(db, email) == ('login_exitoso', True, 'Login exitoso')
+    with db.db_cursor() as cursor:
+        cursor.execute("SELECT intentos_fallidos FROM usuarios_portal WHERE email = %s", (email,))
+        assert cursor.fetchone()[0] == 0
+
+
+def test_no_encontrado(db, cuenta):
+    email, _ = cuenta()
+
+    assert autenticar(db, email, 'OTRO')['resultado'] == 'no_encontrado'
+    assert ultimo_acceso(db, email) == ('login_fallido', False, 'Credenciales incorrectas')
+
+
+@pytest.mark.parametrize('activo', [False, None])
+def test_inactivo_incluye_activo_null(db, cuenta, activo):
+    email, receiver_id = cuenta(activo=activo)
+
+    usuario = autenticar(db, email, receiver_id)
+
+    assert usuario['resultado'] == 'inactivo'
+    assert ultimo_acceso(db, email) == ('login_fallido', False, 'Cuenta inactiva')
+
+
+def test_bloqueado_trae_fecha_futura(db, cuenta):
+    email, receiver_id = cuenta(bloqueado_hasta=datetime.now() + timedelta(hours=1))
+
+    usuario = autenticar(db, email, receiver_id)
+
+    assert usuario['resultado'] == 'bloqueado'
+    assert usuario['bloqueado_hasta'] > datetime.now()
+    assert ultimo_acceso(db, email) == ('login_fallido', False, 'Cuenta bloqueada')
+
+
+def test_bloqueo_vencido_permite_entrar(db, cuenta):
+    email, receiver_id = cuenta(bloqueado_hasta=datetime.now() - timedelta(hours=1))
+
+    assert autenticar(db, email, receiver_id)['resultado'] == 'exitoso'
+
+
+# --- POST /portal/login (autenticación simulada) ----------------------------
+
+@pytest.fixture
+def login(monkeypatch):
+    """Envía el formulario con autenticar_usuario devolviendo `usuario`"""
+    limitador = portal.LimitadorLogin(900, 100, 100, 900, sync_interval=3600, max_claves=1000)
+
+    class CursorFalso:
+        def __enter__(self):
+            return None
+
+        def __exit__(self, *args):
+            return False
+
+    monkeypatch.setattr(portal.app, 'session_interface', SecureCookieSessionInterface())
+    monkeypatch.setattr(portal, 'get_limitador_login', lambda: limitador)
+    monkeypatch.setattr(portal, 'db_cursor', lambda *args, **kwargs: CursorFalso())
+
+    def enviar(usuario):
+        monkeypatch.setattr(portal, 'autenticar_usuario', lambda *args: usuario)
+        cliente = portal.app.test_client()
+        respuesta = cliente.post('/portal/login', data={'email': 'a@example.com', 'receiver_id': 'R1'})
+        with cliente.session_transaction() as sesion:
+            mensajes = [mensaje for _, mensaje in sesion.get('_flashes', [])]
+        return respuesta, mensajes, limitador
+
+    yield enviar
+    limitador._detener.set()
+
+
+def usuario_con(resultado, bloqueado_hasta=None):
+    return {'resultado': resultado, 'id': 1, 'receiver_id': None, 'email': None, 'nombre': None,
+            'bloqueado_hasta': bloqueado_hasta}
+
+
+def test_bloqueado_con_fecha(login):
+    respuesta, mensajes, limitador = login(usuario_con('bloqueado', datetime.now() + timedelta(minutes=10)))
+
+    assert respuesta.status_code == 302
+    assert mensajes == ['Cuenta bloqueada temporalmente. Intenta en 10 minutos.']
+    assert not limitador.permitir('10.0.0.1', 'a@example.com')[0]
+
+
+@pytest.mark.parametrize('bloqueado_hasta', [None, datetime.now() - timedelta(minutes=1)])
+def test_bloqueado_sin_fecha_futura_no_falla(login, bloqueado_hasta):
+    respuesta, mensajes, limitador = login(usuario_con('bloqueado', bloqueado_hasta))
+
+    assert respuesta.status_code == 302
+    assert mensajes == ['Cuenta bloqueada temporalmente. Intenta en 1 minutos.']
+    assert limitador.permitir('10.0.0.1', 'a@example.com') == (True, 0)
+
+
+def test_inactivo(login):
+    respuesta, mensajes, _ = login(usuario_con('inactivo'))
+
+    assert respuesta.status_code == 302
+    assert mensajes == ['Tu cuenta ha sido desactivada. Contacta a soporte.']
+
+
+def test_cambio_concurrente_pide_reintentar(login):
+    respuesta, mensajes, _ = login(usuario_con('reintentar'))
+
+    assert respuesta.status_code == 302
+    assert respuesta.location.endswith('/portal/login')
+    assert mensajes == ['No se pudo iniciar sesión. Intenta nuevamente.']
@@ -0,0 +1,121 @@
+"""Pruebas de MultipartBody / construir_cuerpo_n8n (transporte multipart hacia n8n)"""
+import gzip
+import io
+import json
+
+import pytest
+import requests
+from werkzeug.formparser import parse_form_data
+from werkzeug.test import EnvironBuilder
+
+from app import Config, MultipartBody, construir_cuerpo_n8n
+
+
+class ArchivoVigilado(io.BytesIO):
+    """BytesIO que registra el tamaño de cada read()"""
+
+    def __init__(self, datos):
+        super().__init__(datos)
+        self.lecturas = []
+
+    def read(self, size=-1):
+        self.lecturas.append(size)
+        return super().read(size)
+
+
+def leer_todo(body, tamano):
+    partes = []
+    while True:
+        trozo = body.read(tamano)
+        if not trozo:
+            return b''.join(partes)
+        assert len(trozo) <= tamano
+        partes.append(trozo)
+
+
+def parsear(body, content_type):
+    """Parte el cuerpo como lo haría el webhook de n8n: {nombre: (filename, headers, bytes)}"""
+    entorno = EnvironBuilder(method='POST', input_stream=io.BytesIO(body),
+                             content_type=content_type, content_length=len(body)).get_environ()
+    _, form, archivos = parse_form_data(entorno)
+    partes = {nombre: (None, None, valor.encode('utf-8')) for nombre, valor in form.items()}
+    for nombre, archivo in archivos.items():
+        partes[nombre] = (archivo.filename, archivo.headers, archivo.read())
+    return partes
+
+
+@pytest.fixture
+def body(pdf):
+    archivo = ArchivoVigilado(pdf(100_000))
+    return MultipartBody([
+        ('metadata', None, 'application/json', b'{"order_id": "1"}', None),
+        ('csf_pdf', 'csf.pdf', 'application/pdf', archivo, None),
+    ]), archivo
+
+
+@pytest.mark.parametrize('tamano', [1, 7, 8192, 1 << 20])
+def test_longitud_coincide_con_lo_leido(body, tamano):
+    multipart, _ = body
+    assert len(leer_todo(multipart, tamano)) == len(multipart)
+    assert multipart.tell() == len(multipart)
+
+
+def test_el_pdf_se_lee_por_bloques(body):
+    multipart, archivo = body
+    leer_todo(multipart, 8192)
+    # Nunca se pide el archivo completo de una vez
+    assert archivo.lecturas and max(archivo.lecturas) <= 8192
+
+
+def test_seek_cero_permite_releer(body):
+    multipart, _ = body
+    primero = multipart.read()
+    multipart.seek(0)
+    assert multipart.read() == primero
+
+    with pytest.raises(io.UnsupportedOperation):
+        multipart.seek(10)
+
+
+def test_cuerpo_es_multipart_valido(body, pdf):
+    multipart, _ = body
+    partes = parsear(multipart.read(), multipart.content_type)
+
+    assert partes['metadata'][2] == b'{"order_id": "1"}'
+    filename, _, contenido = partes['csf_pdf']
+    assert filename == 'csf.pdf'
+    assert contenido == pdf(100_000)
+
+
+def test_requests_envia_content_length_sin_chunked(body):
+    multipart, _ = body
+    preparado = requests.Request('POST', 'http://n8n.invalid/webhook', data=multipart,
+                                 headers={'Content-Type': multipart.content_type}).prepare()
+
+    assert preparado.headers['Content-Length'] == str(len(multipart))
+    assert 'Transfer-Encoding' not in preparado.headers
+
+
+@pytest.mark.parametrize('gzip_metadata', [False, True])
+def test_construir_cuerpo_n8n_multipart(monkeypatch, pdf, gzip_metadata):
+    monkeypatch.setattr(Config, 'N8N_TRANSPORT', 'multipart')
+    monkeypatch.setattr(Config, 'N8N_GZIP_METADATA', gzip_metadata)
+    datos = pdf(30_000)
+    payload = {
+        'order_id': '2000001234',
+        'email': 'cliente@example.com',
+        'csf_pdf': {'filename': 'csf.pdf', 'mime_type': 'application/pdf', 'size': len(datos),
+                    'sha256': '0' * 64, 'stream': io.BytesIO(datos)},
+    }
+
+    cuerpo, headers = construir_cuerpo_n8n(payload)
+    partes = parsear(cuerpo.read(), headers['Content-Type'])
+
+    metadata = partes['metadata'][2]
+    if gzip_metadata:
+        assert partes['metadata'][1]['Content-Encoding'] == 'gzip'
+        metadata = gzip.decompress(metadata)
+    metadata = json.loads(metadata)
+    assert metadata['order_id'] == '2000001234'
+    assert 'stream' not in metadata['csf_pdf']
+    assert partes['csf_pdf'][2] == datos
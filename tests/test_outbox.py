@@ -0,0 +1,379 @@
+"""Pruebas del outbox de envíos a n8n (facturacion_jobs + csf_documentos); requieren PostgreSQL"""
+import hashlib
+import io
+import uuid
+
+import pytest
+
+import app as portal
+from app import CSF_BLOQUE_BD, Config
+
+
+class ArchivoVigilado(io.BytesIO):
+    """BytesIO que registra el tamaño de cada read()"""
+
+    def __init__(self, datos):
+        super().__init__(datos)
+        self.lecturas = []
+
+    def read(self, size=-1):
+        self.lecturas.append(size)
+        return super().read(size)
+
+
+class ExecutorFalso:
+    """Registra los envíos inmediatos en vez de llamar a n8n"""
+
+    def __init__(self):
+        self.enviados = []
+
+    def submit(self, funcion, job_id, contenido, cupos):
+        self.enviados.append((job_id, contenido))
+        cupos.release()
+
+
+@pytest.fixture
+def executor(db, monkeypatch):
+    falso = ExecutorFalso()
+    cupos = portal.threading.BoundedSemaphore(10)
+    monkeypatch.setattr(portal, 'get_n8n_executor', lambda: (falso, cupos))
+    return falso
+
+
+@pytest.fixture
+def outbox(db):
+    """Payloads de prueba; al terminar borra sus jobs y sus CSF (con el large object)"""
+    ordenes, csfs = [], []
+
+    def payload(contenido, order_id=None):
+        order_id = order_id or f'OUTBOX-{uuid.uuid4().hex[:10]}'
+        sha256 = hashlib.sha256(contenido).hexdigest()
+        ordenes.append(order_id)
+        csfs.append(sha256)
+        return {'order_id': order_id, 'email': 'a@example.com',
+                'csf_pdf': {'filename': 'csf.pdf', 'mime_type': 'application/pdf',
+                            'size': len(contenido), 'sha256': sha256}}
+
+    yield payload
+    with db.db_cursor() as cursor:
+        cursor.execute("DELETE FROM facturacion_jobs WHERE order_id = ANY(%s)", (ordenes,))
+        cursor.execute(
+            """
+            WITH borrados AS (DELETE FROM csf_documentos WHERE sha256 = ANY(%s) RETURNING contenido_oid)
+            SELECT lo_unlink(contenido_oid) FROM borrados WHERE contenido_oid IS NOT NULL
+            """,
+            (csfs,)
+        )
+        cursor.connection.commit()
+
+
+def fila_csf(sha256):
+    with portal.db_cursor() as cursor:
+        cursor.execute("SELECT contenido_oid, contenido IS NULL, size FROM csf_documentos WHERE sha256 = %s",
+                       (sha256,))
+        return cursor.fetchone()
+
+
+# --- CSF en el outbox -------------------------------------------------------
+
+def test_csf_grande_se_copia_por_bloques(executor, outbox, pdf):
+    contenido = pdf(3 * CSF_BLOQUE_BD + 123, semilla=4)
+    archivo = ArchivoVigilado(contenido)
+    payload = outbox(contenido)
+
+    job_id, existente = portal.encolar_envio_n8n(payload, archivo)
+
+    # Nunca se lee la subida completa: a lo más un bloque por lo_put
+    assert existente is None
+    assert archivo.lecturas and all(0 < n <= CSF_BLOQUE_BD for n in archivo.lecturas)
+    oid, sin_bytea, size = fila_csf(payload['csf_pdf']['sha256'])
+    assert oid is not None and sin_bytea and size == len(contenido)
+    assert portal._cargar_csf(payload['csf_pdf']['sha256']) == contenido
+    # Mayor que CSF_SPOOL_MAX_MEMORY: el envío inmediato la relee de la BD
+    assert executor.enviados == [(job_id, None)]
+
+
+def test_csf_chica_se_envia_desde_memoria(executor, outbox, pdf):
+    contenido = pdf(2000, semilla=5)
+    payload = outbox(contenido)
+
+    job_id, _ = portal.encolar_envio_n8n(payload, io.BytesIO(contenido))
+
+    assert executor.enviados == [(job_id, contenido)]
+    assert portal._cargar_csf(payload['csf_pdf']['sha256']) == contenido
+
+
+def test_misma_csf_se_guarda_una_vez(executor, outbox, pdf):
+    contenido = pdf(5000, semilla=6)
+    primero, segundo = outbox(contenido), outbox(contenido)
+
+    portal.encolar_envio_n8n(primero, io.BytesIO(contenido))
+    oid = fila_csf(primero['csf_pdf']['sha256'])[0]
+    archivo = ArchivoVigilado(contenido)
+    portal.encolar_envio_n8n(segundo, archivo)
+
+    # Ya guardada: ni se vuelve a leer la subida (solo para el envío inmediato) ni se crea otro large object
+    assert archivo.lecturas == [-1]
+    assert fila_csf(primero['csf_pdf']['sha256'])[0] == oid
+
+
+def test_purga_borra_el_large_object(db, executor, outbox, pdf, monkeypatch):
+    contenido = pdf(5000, semilla=7)
+    payload = outbox(contenido)
+    portal.encolar_envio_n8n(payload, io.BytesIO(contenido))
+    oid = fila_csf(payload['csf_pdf']['sha256'])[0]
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "UPDATE facturacion_jobs SET status = 'completado', finished_at = NOW() - INTERVAL '30 days' "
+            "WHERE order_id = %s",
+            (payload['order_id'],)
+        )
+        cursor.execute("UPDATE csf_documentos SET ultimo_uso_at = NOW() - INTERVAL '30 days' WHERE sha256 = %s",
+                       (payload['csf_pdf']['sha256'],))
+        cursor.connection.commit()
+    monkeypatch.setattr(Config, 'OUTBOX_RETENCION_CSF_DIAS', 7)
+
+    assert portal.purgar_csf_documentos() >= 1
+
+    assert fila_csf(payload['csf_pdf']['sha256']) is None
+    with db.db_cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_largeobject_metadata WHERE oid = %s", (oid,))
+        assert cursor.fetchone() is None
+
+
+# --- idempotencia (misma orden + misma CSF) ---------------------------------
+
+def jobs_de(order_id):
+    with portal.db_cursor() as cursor:
+        cursor.execute("SELECT id::text, status FROM facturacion_jobs WHERE order_id = %s ORDER BY created_at",
+                       (order_id,))
+        return cursor.fetchall()
+
+
+def terminar(job_id, status, hace_segundos=0):
+    with portal.db_cursor() as cursor:
+        cursor.execute(
+            "UPDATE facturacion_jobs SET status = %s, finished_at = NOW() - make_interval(secs => %s) WHERE id = %s",
+            (status, hace_segundos, job_id)
+        )
+        cursor.connection.commit()
+
+
+def test_duplicado_regresa_el_job_existente(executor, outbox, pdf):
+    contenido = pdf(3000, semilla=8)
+    payload = outbox(contenido)
+
+    job_id, existente = portal.encolar_envio_n8n(payload, io.BytesIO(contenido))
+    otra_vez = portal.encolar_envio_n8n(dict(payload), io.BytesIO(contenido))
+
+    assert existente is None
+    assert otra_vez == (job_id, 'pendiente')
+    assert jobs_de(payload['order_id']) == [(job_id, 'pendiente')]
+    # El duplicado no se manda a n8n
+    assert [j for j, _ in executor.enviados] == [job_id]
+
+
+def test_otra_csf_es_otra_solicitud(executor, outbox, pdf):
+    primera = pdf(3000, semilla=9)
+    payload = outbox(primera)
+    segunda = pdf(3000, semilla=10)
+    otro = outbox(segunda, order_id=payload['order_id'])
+
+    uno, _ = portal.encolar_envio_n8n(payload, io.BytesIO(primera))
+    dos, existente = portal.encolar_envio_n8n(otro, io.BytesIO(segunda))
+
+    assert existente is None and dos != uno
+
+
+@pytest.mark.parametrize('status, hace, reutiliza', [
+    ('completado', 60, True),
+    ('completado', 7200, False),   # fuera de IDEMPOTENCIA_VENTANA
+    ('rechazado', 60, False),      # el cliente puede corregir y reenviar
+    ('error', 60, False),
+])
+def test_jobs_terminados(executor, outbox, pdf, monkeypatch, status, hace, reutiliza):
+    monkeypatch.setattr(Config, 'IDEMPOTENCIA_VENTANA', 3600)
+    contenido = pdf(3000, semilla=11)
+    payload = outbox(contenido)
+    job_id, _ = portal.encolar_envio_n8n(payload, io.BytesIO(contenido))
+    terminar(job_id, status, hace)
+
+    nuevo, existente = portal.encolar_envio_n8n(dict(payload), io.BytesIO(contenido))
+
+    if reutiliza:
+        assert (nuevo, existente) == (job_id, 'completado')
+    else:
+        assert existente is None and nuevo != job_id
+
+
+def test_duplicados_simultaneos_crean_un_solo_job(executor, outbox, pdf):
+    contenido = pdf(3000, semilla=12)
+    payload = outbox(contenido)
+    barrera = portal.threading.Barrier(4)
+    resultados = []
+
+    def enviar():
+        barrera.wait()
+        resultados.append(portal.encolar_envio_n8n(dict(payload), io.BytesIO(contenido)))
+
+    hilos = [portal.threading.Thread(target=enviar) for _ in range(4)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert len(jobs_de(payload['order_id'])) == 1
+    assert len({job_id for job_id, _ in resultados}) == 1
+    assert sorted(existente is None for _, existente in resultados) == [False, False, False, True]
+
+
+def test_lote_se_liga_al_job_existente(db, executor, outbox, pdf):
+    contenido = pdf(3000, semilla=13)
+    payload = outbox(contenido)
+    job_id, _ = portal.encolar_envio_n8n(payload, io.BytesIO(contenido))
+    nuevo = outbox(contenido)
+    lote_id = str(uuid.uuid4())
+    filas = [{'fila': 1, 'id': payload['order_id'], 'payload': dict(payload)},
+             {'fila': 2, 'id': nuevo['order_id'], 'payload': nuevo}]
+
+    try:
+        filas = portal.encolar_lote_n8n(lote_id, 'a@example.com', payload['csf_pdf'], io.BytesIO(contenido), filas)
+    finally:
+        with db.db_cursor() as cursor:
+            cursor.execute("DELETE FROM facturacion_lotes WHERE id = %s", (lote_id,))
+            cursor.connection.commit()
+
+    assert (filas[0]['job_id'], filas[0]['existente']) == (job_id, 'pendiente')
+    assert 'existente' not in filas[1] and filas[1]['job_id'] != job_id
+    assert len(jobs_de(payload['order_id'])) == 1
+
+
+# --- entrega: lease y reintentos --------------------------------------------
+
+@pytest.fixture
+def n8n(monkeypatch):
+    """enviar_a_n8n simulado: regresa `respuesta` y registra cada POST"""
+    llamada = {'respuesta': (True, {'success': True, 'message': 'ok'}), 'envios': []}
+
+    def enviar_a_n8n(payload):
+        llamada['envios'].append(payload['order_id'])
+        return llamada['respuesta']
+
+    monkeypatch.setattr(portal, 'enviar_a_n8n', enviar_a_n8n)
+    return llamada
+
+
+@pytest.fixture
+def job(executor, outbox, pdf):
+    """Un job pendiente y listo para el worker (proximo_intento_at en el pasado)"""
+    contenido = pdf(3000, semilla=14)
+    payload = outbox(contenido)
+    job_id, _ = portal.encolar_envio_n8n(payload, io.BytesIO(contenido))
+    with portal.db_cursor() as cursor:
+        cursor.execute("UPDATE facturacion_jobs SET proximo_intento_at = '2000-01-01' WHERE id = %s", (job_id,))
+        cursor.connection.commit()
+    return job_id, payload
+
+
+def estado_job(job_id):
+    with portal.db_cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT status, intentos, bloqueado_por,
+                   EXTRACT(EPOCH FROM proximo_intento_at - NOW())::int
+            FROM facturacion_jobs WHERE id = %s
+            """,
+            (job_id,)
+        )
+        return cursor.fetchone()
+
+
+def vencer_lease(job_id):
+    with portal.db_cursor() as cursor:
+        cursor.execute("UPDATE facturacion_jobs SET bloqueado_hasta = NOW() - INTERVAL '1 second' WHERE id = %s",
+                       (job_id,))
+        cursor.connection.commit()
+
+
+def test_reclamado_no_lo_toma_otro_worker(job):
+    job_id, _ = job
+
+    primero = portal.reclamar_jobs_outbox(1, 'worker-a')
+    assert [str(j['id']) for j in primero] == [job_id]
+
+    # El envío inmediato del web tampoco lo toma mientras el lease está vigente
+    assert portal.reclamar_job(job_id, 'web') is None
+    assert estado_job(job_id)[:3] == ('enviando', 1, 'worker-a')
+
+
+def test_lease_perdido_no_envia(job, n8n):
+    job_id, _ = job
+    reclamado = portal.reclamar_job(job_id, 'worker-a')
+    vencer_lease(job_id)
+    [retomado] = portal.reclamar_jobs_outbox(1, 'worker-b')
+
+    # worker-a despierta tarde: no debe mandar el job que ya tiene worker-b
+    assert portal.entregar_job(reclamado, 'worker-a') == 'lease_perdido'
+    assert n8n['envios'] == []
+
+    assert portal.entregar_job(retomado, 'worker-b') == 'completado'
+    assert n8n['envios'] == [job[1]['order_id']]
+    assert estado_job(job_id)[:3] == ('completado', 2, None)
+
+
+def test_resultado_de_un_lease_vencido_se_descarta(job):
+    job_id, _ = job
+    portal.reclamar_job(job_id, 'worker-a')
+    vencer_lease(job_id)
+    portal.reclamar_jobs_outbox(1, 'worker-b')
+
+    assert not portal._finalizar_entrega(job_id, 'worker-a', 'error', 'tarde')
+    assert estado_job(job_id)[:3] == ('enviando', 2, 'worker-b')
+
+
+def test_indeterminado_espera_y_no_reenvia_si_ya_hay_factura(db, job, n8n, monkeypatch):
+    monkeypatch.setattr(Config, 'OUTBOX_ESPERA_INDETERMINADO', 600)
+    job_id, payload = job
+    n8n['respuesta'] = (False, {'error': 'Timeout', 'reintentable': True, 'indeterminado': True})
+
+    assert portal.entregar_job(portal.reclamar_job(job_id, 'worker-a'), 'worker-a') == 'reintentando'
+    status, intentos, _, espera = estado_job(job_id)
+    assert (status, intentos) == ('reintentando', 1) and 590 <= espera <= 600
+
+    # n8n sí creó la factura: el reintento la encuentra y no vuelve a llamar
+    with db.db_cursor() as cursor:
+        cursor.execute("INSERT INTO facturas (receiver_id, order_id, email, amount) VALUES ('R', %s, 'a@example.com', 1)",
+                       (payload['order_id'],))
+        cursor.execute("UPDATE facturacion_jobs SET proximo_intento_at = '2000-01-01' WHERE id = %s", (job_id,))
+        cursor.connection.commit()
+    try:
+        [reintento] = portal.reclamar_jobs_outbox(1, 'worker-b')
+        assert portal.entregar_job(reintento, 'worker-b') == 'completado'
+    finally:
+        with db.db_cursor() as cursor:
+            cursor.execute("DELETE FROM facturas WHERE order_id = %s", (payload['order_id'],))
+            cursor.connection.commit()
+
+    assert n8n['envios'] == [payload['order_id']]
+    assert estado_job(job_id)[:2] == ('completado', 2)
+
+
+def test_error_de_conexion_reintenta_con_backoff(job, n8n, monkeypatch):
+    monkeypatch.setattr(Config, 'OUTBOX_BACKOFF_BASE', 30)
+    monkeypatch.setattr(Config, 'OUTBOX_ESPERA_INDETERMINADO', 600)
+    job_id, _ = job
+    n8n['respuesta'] = (False, {'error': 'Connection refused', 'reintentable': True})
+
+    assert portal.entregar_job(portal.reclamar_job(job_id, 'worker-a'), 'worker-a') == 'reintentando'
+
+    # n8n nunca recibió el POST: basta el backoff normal (15-30 s en el primer intento)
+    assert 14 <= estado_job(job_id)[3] <= 30
+
+
+def test_ultimo_intento_queda_en_error(job, n8n, monkeypatch):
+    monkeypatch.setattr(Config, 'OUTBOX_MAX_INTENTOS', 1)
+    job_id, _ = job
+    n8n['respuesta'] = (False, {'error': 'HTTP 502', 'reintentable': True, 'indeterminado': True})
+
+    assert portal.entregar_job(portal.reclamar_job(job_id, 'worker-a'), 'worker-a') == 'error'
+    assert estado_job(job_id)[:3] == ('error', 1, None)
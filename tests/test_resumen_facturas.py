@@ -0,0 +1,152 @@
+"""Pruebas de trigger_facturas_resumen (facturas_resumen_usuario y facturas_resumen_mensual)"""
+import uuid
+from datetime import date
+from decimal import Decimal
+
+import pytest
+from psycopg2.extras import RealDictCursor
+
+from app import obtener_resumen_facturas
+
+
+@pytest.fixture
+def usuarios(db):
+    """Dos usuarios sin facturas; al terminar se borran (con sus facturas y resúmenes en cascada)"""
+    sufijo = uuid.uuid4().hex[:10]
+    ids = []
+    with db.db_cursor() as cursor:
+        for i in range(2):
+            cursor.execute("INSERT INTO usuarios_portal (receiver_id, email) VALUES (%s, %s) RETURNING id",
+                           (f'RES{i}-{sufijo}', f'resumen{i}-{sufijo}@example.com'))
+            ids.append(cursor.fetchone()[0])
+        cursor.connection.commit()
+    yield ids
+    with db.db_cursor() as cursor:
+        cursor.execute("DELETE FROM facturas WHERE usuario_id = ANY(%s)", (ids,))
+        cursor.execute("DELETE FROM usuarios_portal WHERE id = ANY(%s)", (ids,))
+        cursor.connection.commit()
+
+
+def ejecutar(db, sql, params=()):
+    with db.db_cursor() as cursor:
+        cursor.execute(sql, params)
+        cursor.connection.commit()
+
+
+def facturar(db, usuario_id, amount, created_at, payment_status='pending'):
+    order_id = f'RES-{uuid.uuid4().hex[:12]}'
+    ejecutar(db,
+             """
+             INSERT INTO facturas (usuario_id, receiver_id, order_id, email, amount, created_at, payment_status)
+             VALUES (%s, 'R', %s, 'resumen@example.com', %s, %s, %s)
+             """,
+             (usuario_id, order_id, amount, created_at, payment_status))
+    return order_id
+
+
+def resumen(db, usuario_id):
+    with db.db_cursor(RealDictCursor) as cursor:
+        return dict(obtener_resumen_facturas(cursor, usuario_id))
+
+
+def meses(db, usuario_id):
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "SELECT mes, total, monto_total, pagadas FROM facturas_resumen_mensual "
+            "WHERE usuario_id = %s AND total <> 0 ORDER BY mes",
+            (usuario_id,)
+        )
+        return cursor.fetchall()
+
+
+def agregado(db, usuario_id):
+    """Lo mismo calculado desde facturas, para comparar con los contadores"""
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT COUNT(*), COALESCE(SUM(amount), 0),
+                   COUNT(*) FILTER (WHERE payment_status = 'pending'),
+                   COUNT(*) FILTER (WHERE payment_status = 'paid')
+            FROM facturas WHERE usuario_id = %s
+            """,
+            (usuario_id,)
+        )
+        return cursor.fetchone()
+
+
+def test_usuario_sin_facturas(db, usuarios):
+    assert resumen(db, usuarios[0]) == {'total_facturas': 0, 'monto_total': 0,
+                                        'facturas_pendientes': 0, 'facturas_pagadas': 0}
+
+
+def test_insertar_suma_por_usuario_y_mes(db, usuarios):
+    usuario = usuarios[0]
+    facturar(db, usuario, 100, '2024-01-10')
+    facturar(db, usuario, 50.5, '2024-01-20', 'paid')
+    facturar(db, usuario, 20, '2024-02-01')
+
+    assert resumen(db, usuario) == {'total_facturas': 3, 'monto_total': Decimal('170.50'),
+                                    'facturas_pendientes': 2, 'facturas_pagadas': 1}
+    assert meses(db, usuario) == [(date(2024, 1, 1), 2, Decimal('150.50'), 1),
+                                  (date(2024, 2, 1), 1, Decimal('20.00'), 0)]
+
+
+def test_cambios_de_pago_monto_y_fecha(db, usuarios):
+    usuario = usuarios[0]
+    order_id = facturar(db, usuario, 100, '2024-01-10')
+
+    ejecutar(db, "UPDATE facturas SET payment_status = 'paid' WHERE order_id = %s", (order_id,))
+    ejecutar(db, "UPDATE facturas SET amount = 80 WHERE order_id = %s", (order_id,))
+    ejecutar(db, "UPDATE facturas SET created_at = '2024-03-05' WHERE order_id = %s", (order_id,))
+
+    assert resumen(db, usuario) == {'total_facturas': 1, 'monto_total': Decimal('80.00'),
+                                    'facturas_pendientes': 0, 'facturas_pagadas': 1}
+    assert meses(db, usuario) == [(date(2024, 3, 1), 1, Decimal('80.00'), 1)]
+
+
+def test_reasignar_y_borrar(db, usuarios):
+    uno, dos = usuarios
+    order_id = facturar(db, uno, 100, '2024-01-10', 'paid')
+    facturar(db, uno, 30, '2024-01-11')
+
+    ejecutar(db, "UPDATE facturas SET usuario_id = %s WHERE order_id = %s", (dos, order_id))
+    assert resumen(db, uno)['total_facturas'] == 1
+    assert resumen(db, dos) == {'total_facturas': 1, 'monto_total': Decimal('100.00'),
+                                'facturas_pendientes': 0, 'facturas_pagadas': 1}
+
+    ejecutar(db, "DELETE FROM facturas WHERE order_id = %s", (order_id,))
+    assert resumen(db, dos)['total_facturas'] == 0
+    assert meses(db, dos) == []
+
+
+def test_factura_sin_fecha_solo_cuenta_en_el_total(db, usuarios):
+    usuario = usuarios[0]
+    facturar(db, usuario, 10, None)
+
+    assert resumen(db, usuario)['total_facturas'] == 1
+    assert meses(db, usuario) == []
+
+
+def test_cambio_que_no_afecta_los_contadores(db, usuarios):
+    usuario = usuarios[0]
+    order_id = facturar(db, usuario, 100, '2024-01-10')
+    antes = resumen(db, usuario)
+
+    ejecutar(db, "UPDATE facturas SET invoice_name = 'INV/2024/001', status = 'facturado' WHERE order_id = %s",
+             (order_id,))
+
+    assert resumen(db, usuario) == antes
+
+
+def test_coinciden_con_agregar_facturas(db, usuarios):
+    uno, dos = usuarios
+    ordenes = [facturar(db, uno, 10 * i, f'2024-0{1 + i % 3}-15', ('pending', 'paid', 'overdue')[i % 3])
+               for i in range(1, 10)]
+    ejecutar(db, "UPDATE facturas SET payment_status = 'paid' WHERE order_id = ANY(%s)", (ordenes[:3],))
+    ejecutar(db, "UPDATE facturas SET usuario_id = %s WHERE order_id = ANY(%s)", (dos, ordenes[3:5]))
+    ejecutar(db, "DELETE FROM facturas WHERE order_id = ANY(%s)", (ordenes[5:7],))
+
+    for usuario in usuarios:
+        total = resumen(db, usuario)
+        assert (total['total_facturas'], total['monto_total'], total['facturas_pendientes'],
+                total['facturas_pagadas']) == agregado(db, usuario)
@@ -0,0 +1,209 @@
+"""Pruebas de SesionesPostgres (sesiones de Flask en sesiones_portal); requieren PostgreSQL"""
+import hashlib
+import uuid
+
+import psycopg2
+import pytest
+from flask import Flask, jsonify, request, session
+
+import app as portal
+from app import Config, SesionesPostgres
+
+
+@pytest.fixture
+def sesiones(db, monkeypatch):
+    # Sin cache: cada request lee la BD, como un worker distinto
+    monkeypatch.setattr(Config, 'SESION_CACHE_TTL', 0)
+    return SesionesPostgres()
+
+
+def crear_app(interfaz):
+    mini = Flask(__name__)
+    mini.secret_key = 'pruebas'
+    mini.session_interface = interfaz
+
+    @mini.route('/poner')
+    def poner():
+        session.update(request.args)
+        return 'ok'
+
+    @mini.route('/entrar/<int:usuario_id>')
+    def entrar(usuario_id):
+        session['usuario_id'] = usuario_id
+        return 'ok'
+
+    @mini.route('/ver')
+    def ver():
+        return jsonify(dict(session))
+
+    @mini.route('/salir')
+    def salir():
+        session.clear()
+        return 'ok'
+
+    return mini
+
+
+@pytest.fixture
+def cliente(sesiones):
+    return crear_app(sesiones).test_client()
+
+
+@pytest.fixture
+def usuario(db):
+    sufijo = uuid.uuid4().hex[:10]
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO usuarios_portal (receiver_id, email) VALUES (%s, %s) RETURNING id",
+            (f'PRUEBA-{sufijo}', f'prueba-{sufijo}@example.com')
+        )
+        usuario_id = cursor.fetchone()[0]
+        cursor.connection.commit()
+    yield usuario_id
+    with db.db_cursor() as cursor:
+        cursor.execute("DELETE FROM usuarios_portal WHERE id = %s", (usuario_id,))
+        cursor.connection.commit()
+
+
+def cookie(cliente):
+    galleta = cliente.get_cookie('session')
+    return galleta.value if galleta else None
+
+
+def fila(token_cookie):
+    token = hashlib.sha256(token_cookie.encode()).hexdigest()
+    with portal.db_cursor() as cursor:
+        cursor.execute("SELECT datos, usuario_id, activa FROM sesiones_portal WHERE session_token = %s", (token,))
+        return cursor.fetchone()
+
+
+@pytest.fixture(autouse=True)
+def limpiar_sesiones(request):
+    tokens = []
+    request.node.tokens = tokens
+    yield
+    if tokens:
+        with portal.db_cursor() as cursor:
+            cursor.execute("DELETE FROM sesiones_portal WHERE session_token = ANY(%s)",
+                           ([hashlib.sha256(t.encode()).hexdigest() for t in tokens],))
+            cursor.connection.commit()
+
+
+def test_la_cookie_solo_lleva_token_y_version(cliente, request):
+    cliente.get('/poner?pedido=O1')
+    valor = cookie(cliente)
+    token_cookie, version = valor.split('.', 1)
+    request.node.tokens.append(token_cookie)
+
+    datos, usuario_id, activa = fila(token_cookie)
+    assert 'O1' not in valor
+    assert datos == {'pedido': 'O1'}
+    assert usuario_id is None and activa
+    assert cliente.get('/ver').json == {'pedido': 'O1'}
+
+
+def test_sin_cambios_no_escribe(cliente, sesiones, request):
+    cliente.get('/poner?pedido=O1')
+    request.node.tokens.append(cookie(cliente).split('.')[0])
+    escrituras = sesiones.stats()['escrituras']
+    antes = cookie(cliente)
+
+    for _ in range(3):
+        cliente.get('/ver')
+
+    assert sesiones.stats()['escrituras'] == escrituras
+    assert cookie(cliente) == antes
+
+
+def test_cada_escritura_cambia_la_version(cliente, request):
+    cliente.get('/poner?pedido=O1')
+    token_cookie, version = cookie(cliente).split('.', 1)
+    request.node.tokens.append(token_cookie)
+
+    cliente.get('/poner?pedido=O2')
+    mismo_token, otra_version = cookie(cliente).split('.', 1)
+
+    assert mismo_token == token_cookie
+    assert otra_version != version
+    assert fila(token_cookie)[0] == {'pedido': 'O2'}
+
+
+def test_el_cache_no_entrega_una_version_reemplazada(db, sesiones, monkeypatch, request):
+    monkeypatch.setattr(Config, 'SESION_CACHE_TTL', 3600)
+    otro_worker = SesionesPostgres()
+    mini = crear_app(sesiones)
+    cliente_a = mini.test_client()
+    cliente_a.get('/poner?pedido=O1')
+    cliente_a.get('/ver')  # queda en el cache de `sesiones`
+    request.node.tokens.append(cookie(cliente_a).split('.')[0])
+
+    # Otro worker escribe la sesión del mismo cliente
+    mini.session_interface = otro_worker
+    cliente_a.get('/poner?pedido=O2')
+
+    # De vuelta en el primero: la cookie trae otra versión, el cache no sirve
+    mini.session_interface = sesiones
+    assert cliente_a.get('/ver').json == {'pedido': 'O2'}
+
+
+def test_login_emite_token_nuevo(cliente, usuario, request):
+    cliente.get('/poner?pedido=O1')
+    anterior = cookie(cliente).split('.')[0]
+
+    cliente.get(f'/entrar/{usuario}')
+    nuevo = cookie(cliente).split('.')[0]
+    request.node.tokens += [anterior, nuevo]
+
+    assert nuevo != anterior
+    assert fila(anterior) is None
+    assert fila(nuevo)[1] == usuario
+
+
+def test_revocada_se_pierde_y_borra_la_cookie(cliente, usuario, request):
+    cliente.get(f'/entrar/{usuario}')
+    token_cookie = cookie(cliente).split('.')[0]
+    request.node.tokens.append(token_cookie)
+
+    with portal.db_cursor() as cursor:
+        cursor.execute("UPDATE sesiones_portal SET activa = FALSE WHERE usuario_id = %s", (usuario,))
+        cursor.connection.commit()
+
+    assert cliente.get('/ver').json == {}
+    assert cookie(cliente) is None
+
+
+def test_logout_borra_la_fila(cliente, usuario, request):
+    cliente.get(f'/entrar/{usuario}')
+    token_cookie = cookie(cliente).split('.')[0]
+    request.node.tokens.append(token_cookie)
+
+    cliente.get('/salir')
+
+    assert fila(token_cookie) is None
+    assert cookie(cliente) is None
+
+
+def test_error_de_bd_conserva_la_cookie(cliente, usuario, monkeypatch, request):
+    cliente.get(f'/entrar/{usuario}')
+    antes = cookie(cliente)
+    request.node.tokens.append(antes.split('.')[0])
+
+    class LecturaFallida:
+        def __enter__(self):
+            raise psycopg2.OperationalError('BD caída')
+
+        def __exit__(self, *args):
+            return False
+
+    db_cursor = portal.db_cursor
+    fallas = [LecturaFallida()]
+
+    with monkeypatch.context() as m:
+        # Falla solo la lectura de la sesión; la BD vuelve antes de guardar
+        m.setattr(portal, 'db_cursor', lambda *args, **kwargs: fallas.pop() if fallas else db_cursor(*args, **kwargs))
+        # Un request que escribe en la sesión no debe emitir un token nuevo
+        respuesta = cliente.get('/poner?flash=1')
+        assert 'Set-Cookie' not in respuesta.headers
+
+    assert cookie(cliente) == antes
+    assert cliente.get('/ver').json == {'usuario_id': usuario}